@@ -1,25 +1,32 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import collections
 import enum
-import json
 import logging
 import random
+import struct
 import time
-import uuid
+import zlib
 from typing import *
 
-import aiohttp
+import msgpack
+import tornado.iostream
+import tornado.web
 import tornado.websocket
-import yarl
 
 import api.base
+import blcsdk.models as sdk_models
 import blivedm.blivedm.clients.web as dm_web_cli
 import config
 import services.avatar
 import services.chat
+import services.room_info
 import services.translate
+import services.worker
 import utils.async_io
-import utils.request
+import utils.id_gen
+import utils.json_codec
+import utils.timing_wheel
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +41,7 @@ class Command(enum.IntEnum):
     DEL_SUPER_CHAT = 6
     UPDATE_TRANSLATION = 7
     FATAL_ERROR = 8
+    BUNDLE = 9
 
 
 class ContentType(enum.IntEnum):
@@ -45,15 +53,194 @@ class FatalErrorType(enum.IntEnum):
     AUTH_CODE_ERROR = 1
     TOO_MANY_RETRIES = 2
     TOO_MANY_CONNECTIONS = 3
+    SLOW_CLIENT = 4
+    # 服务器暂时拒绝连接，客户端过一会儿重连就行
+    TRY_AGAIN_LATER = 5
 
 
-def make_message_body(cmd, data):
-    return json.dumps(
+# 发送队列满时可以丢弃的消息，礼物、醒目留言、上舰等不能丢弃
+DROPPABLE_COMMANDS = frozenset((Command.HEARTBEAT, Command.ADD_TEXT))
+# 客户端不订阅也会收到的消息
+ALWAYS_SUBSCRIBED_COMMANDS = frozenset((Command.HEARTBEAT, Command.FATAL_ERROR))
+# 客户端重连时可以重放的消息
+REPLAYABLE_COMMANDS = frozenset((
+    Command.ADD_TEXT, Command.ADD_GIFT, Command.ADD_MEMBER, Command.ADD_SUPER_CHAT, Command.DEL_SUPER_CHAT
+))
+
+
+class Encoding(enum.Enum):
+    """消息体的编码，由客户端加入房间时选择"""
+    JSON = 'json'
+    MSGPACK = 'msgpack'
+
+
+# 用二进制帧发送的编码
+BINARY_ENCODINGS = frozenset((Encoding.MSGPACK,))
+
+
+class HeartbeatMode(enum.Enum):
+    """检测连接存活的方式，由客户端加入房间时选择"""
+    # 服务器和客户端互相发HEARTBEAT消息，兼容旧版客户端
+    JSON = 'json'
+    # 服务器发WebSocket ping，收到pong就算存活，不收发HEARTBEAT消息。浏览器看不到ping，所以只适合非浏览器的客户端
+    PING = 'ping'
+
+
+def make_message_body(cmd, data, encoding=Encoding.JSON):
+    if encoding == Encoding.MSGPACK:
+        return msgpack.packb({'cmd': int(cmd), 'data': data})
+    return utils.json_codec.dumps(
         {
             'cmd': cmd,
             'data': data
         }
-    ).encode('utf-8')
+    )
+
+
+def make_bundle_message_body(bodies: Sequence[bytes], encoding=Encoding.JSON):
+    """把多条已经编码的消息体拼成一条BUNDLE消息，不需要重新序列化"""
+    if encoding == Encoding.MSGPACK:
+        packer = msgpack.Packer()
+        header = (
+            packer.pack_map_header(2)
+            + packer.pack('cmd') + packer.pack(int(Command.BUNDLE))
+            + packer.pack('data') + packer.pack_array_header(len(bodies))
+        )
+        return header + b''.join(bodies)
+    return b'{"cmd": %d, "data": [%s]}' % (Command.BUNDLE, b', '.join(bodies))
+
+
+# 压缩等级，和tornado默认的一样
+COMPRESSION_LEVEL = 6
+
+
+def make_frame(body: bytes, binary=False, compress=False) -> bytes:
+    """
+    把消息体打包成WebSocket帧
+
+    服务器发的帧不用掩码，压缩时也不使用上下文接管，所以同一条消息发给所有客户端的帧都是一样的，广播时只需要打包一次
+
+    :param body: 消息体
+    :param binary: 是否用二进制帧，否则用文本帧
+    :param compress: 是否用permessage-deflate压缩，只能发给协商了压缩的客户端
+    """
+    # FIN
+    first_byte = 0x80
+    # opcode
+    first_byte |= 0x2 if binary else 0x1
+    if compress:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        body = compressor.compress(body) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        # 去掉结尾的0x00 0x00 0xff 0xff
+        body = body[:-4]
+        # RSV1
+        first_byte |= 0x40
+
+    data_len = len(body)
+    if data_len < 126:
+        header = struct.pack('!BB', first_byte, data_len)
+    elif data_len <= 0xFFFF:
+        header = struct.pack('!BBH', first_byte, 126, data_len)
+    else:
+        header = struct.pack('!BBQ', first_byte, 127, data_len)
+    return header + body
+
+
+# 房间内消息对应的插件消息
+_CMD_TO_PLUGIN_CMD = {
+    Command.ADD_TEXT: sdk_models.Command.ADD_TEXT,
+    Command.ADD_GIFT: sdk_models.Command.ADD_GIFT,
+    Command.ADD_MEMBER: sdk_models.Command.ADD_MEMBER,
+    Command.ADD_SUPER_CHAT: sdk_models.Command.ADD_SUPER_CHAT,
+    Command.DEL_SUPER_CHAT: sdk_models.Command.DEL_SUPER_CHAT,
+    Command.UPDATE_TRANSLATION: sdk_models.Command.UPDATE_TRANSLATION,
+}
+
+
+class OutgoingMessage:
+    """
+    一条直播消息，发给房间的客户端、插件等
+
+    各种格式都是用到时才序列化，并且只序列化一次，每种帧只打包一次。创建后不要再修改data
+    """
+    __slots__ = ('cmd', 'data', 'droppable', 'plugin_extra', '_data_json', '_bodies', '_frames', '_plugin_body')
+
+    def __init__(self, cmd, data, plugin_extra: Optional[dict] = None):
+        self.cmd = cmd
+        self.data = data
+        self.droppable = cmd in DROPPABLE_COMMANDS
+        # 发给插件时的附加信息
+        self.plugin_extra = plugin_extra
+        # JSON格式的data，客户端和插件的消息体共用
+        self._data_json: Optional[bytes] = None
+        self._bodies: Dict[Encoding, bytes] = {}
+        self._frames: Dict[Tuple[Encoding, bool], bytes] = {}
+        self._plugin_body: Optional[bytes] = None
+
+    @classmethod
+    def from_msgpack_body(cls, body: bytes):
+        """从其他进程转发来的消息体恢复，已经有的编码不用再序列化"""
+        msg = msgpack.unpackb(body)
+        res = cls(Command(msg['cmd']), msg['data'])
+        res._bodies[Encoding.MSGPACK] = body
+        return res
+
+    @property
+    def msg_id(self) -> Optional[str]:
+        if self.cmd == Command.ADD_TEXT:
+            return self.data[11]
+        if self.cmd in (Command.ADD_GIFT, Command.ADD_MEMBER, Command.ADD_SUPER_CHAT):
+            return self.data['id']
+        return None
+
+    def _get_data_json(self) -> bytes:
+        if self._data_json is None:
+            self._data_json = utils.json_codec.dumps(self.data)
+        return self._data_json
+
+    def get_body(self, encoding: Encoding) -> bytes:
+        body = self._bodies.get(encoding, None)
+        if body is None:
+            if encoding == Encoding.JSON:
+                # 内容和make_message_body的结果等价，用标准库json时字节也一样
+                body = b'{"cmd": %d, "data": %s}' % (self.cmd, self._get_data_json())
+            else:
+                body = make_message_body(self.cmd, self.data, encoding)
+            self._bodies[encoding] = body
+        return body
+
+    def get_plugin_body(self, extra: Optional[dict] = None) -> bytes:
+        """
+        发给插件的消息体，内容和api.plugin.make_message_body的结果等价，用标准库json时字节也一样
+
+        :param extra: 不为None时代替plugin_extra，这时不缓存
+        """
+        if extra is None:
+            if self._plugin_body is None:
+                self._plugin_body = self._make_plugin_body(self.plugin_extra)
+            return self._plugin_body
+        return self._make_plugin_body(extra)
+
+    def _make_plugin_body(self, extra: Optional[dict]) -> bytes:
+        plugin_cmd = _CMD_TO_PLUGIN_CMD[self.cmd]
+        if not extra:
+            return b'{"cmd": %d, "data": %s}' % (plugin_cmd, self._get_data_json())
+        return b'{"cmd": %d, "data": %s, "extra": %s}' % (
+            plugin_cmd, self._get_data_json(), utils.json_codec.dumps(extra)
+        )
+
+    def get_frame(self, encoding: Encoding, compress: bool) -> bytes:
+        key = (encoding, compress)
+        frame = self._frames.get(key, None)
+        if frame is None:
+            self._frames[key] = frame = make_frame(
+                self.get_body(encoding), encoding in BINARY_ENCODINGS, compress
+            )
+        return frame
+
+
+# 所有客户端的心跳消息都一样，共用一个对象，每种帧只打包一次
+_HEARTBEAT_MESSAGE = OutgoingMessage(Command.HEARTBEAT, {})
 
 
 def make_text_message_data(
@@ -100,7 +287,7 @@ def make_text_message_data(
         # 10: medalLevel
         medal_level,
         # 11: id
-        id_ if id_ is not None else uuid.uuid4().hex,
+        id_ if id_ is not None else utils.id_gen.new_id(),
         # 12: translation
         translation,
         # 13: contentType
@@ -141,26 +328,83 @@ class ChatHandler(tornado.websocket.WebSocketHandler):
         self._heartbeat_timer_handle = None
         self._receive_timeout_timer_handle = None
 
+        # 正在写的消息还没发出去时，后面的消息先放在这里，防止网络差的客户端让tornado无限缓存
+        self._send_queue: Deque[Tuple[bytes, bool]] = collections.deque()
+        self._send_queue_bytes = 0
+        self._is_writing = False
+        # 发送队列开始持续超过上限的时间
+        self._send_queue_overflow_time: Optional[float] = None
+        self.dropped_msg_count = 0
+
         self.room_key: Optional[services.chat.RoomKey] = None
         self.auto_translate = False
+        # 客户端支持BUNDLE消息，房间会把一段时间内的消息合并后再发
+        self.enable_bundle = False
+        # 握手时协商了permessage-deflate，房间会发压缩后的帧
+        self.enable_compression = False
+        self.encoding = Encoding.JSON
+        # 客户端需要的消息类型，房间只会发这些消息
+        self.subscribed_cmds: FrozenSet[Command] = frozenset(Command)
+        # 在服务器过滤消息的规则
+        self.message_filter = services.chat.MessageFilter()
+        # 每秒最多发送多少条普通弹幕，0表示不限制
+        self.max_text_rate = 0.0
+        # 是集群中其他节点转发消息用的连接
+        self.is_relay = False
+        self.heartbeat_mode = HeartbeatMode.JSON
+
+    def get_compression_options(self):
+        cfg = config.get_config()
+        if not cfg.enable_websocket_compression:
+            return None
+
+        # tornado只会用第一个permessage-deflate
+        extensions = self.request.headers.get('Sec-WebSocket-Extensions', '')
+        offers = [offer.strip() for offer in extensions.split(',')]
+        for index, offer in enumerate(offers):
+            params = [param.strip() for param in offer.split(';')]
+            if params[0] != 'permessage-deflate':
+                continue
+            # 客户端限制了服务器的窗口大小，没法用房间共用的压缩帧
+            if any(param.startswith('server_max_window_bits') for param in params[1:]):
+                return None
+
+            # 要求服务器不使用上下文接管，这样每条消息都是单独压缩的，压缩后的帧才能给所有客户端共用
+            if 'server_no_context_takeover' not in params:
+                offers[index] = offer + '; server_no_context_takeover'
+                self.request.headers['Sec-WebSocket-Extensions'] = ', '.join(offers)
+            self.enable_compression = True
+            return {'compression_level': COMPRESSION_LEVEL}
+        return None
 
     def open(self):
         logger.info('client=%s connected', self.request.remote_ip)
-        self._heartbeat_timer_handle = asyncio.get_running_loop().call_later(
+        self._heartbeat_timer_handle = utils.timing_wheel.call_later(
             self.HEARTBEAT_INTERVAL, self._on_send_heartbeat
         )
         self._refresh_receive_timeout_timer()
 
     def _on_send_heartbeat(self):
-        self.send_cmd_data(Command.HEARTBEAT, {})
-        self._heartbeat_timer_handle = asyncio.get_running_loop().call_later(
+        # 房间没有新消息时不会再往发送队列放消息，卡住的客户端要在这里检查
+        if self._is_slow_client():
+            self._close_slow_client()
+            return
+
+        if self.heartbeat_mode == HeartbeatMode.PING:
+            try:
+                self.ping()
+            except tornado.websocket.WebSocketClosedError:
+                pass
+        else:
+            self.send_message_no_raise(_HEARTBEAT_MESSAGE)
+        self._heartbeat_timer_handle = utils.timing_wheel.call_later(
             self.HEARTBEAT_INTERVAL, self._on_send_heartbeat
         )
 
     def _refresh_receive_timeout_timer(self):
         if self._receive_timeout_timer_handle is not None:
             self._receive_timeout_timer_handle.cancel()
-        self._receive_timeout_timer_handle = asyncio.get_running_loop().call_later(
+        self._receive_timeout_timer_handle = utils.timing_wheel.call_later(
             self.RECEIVE_TIMEOUT, self._on_receive_timeout
         )
 
@@ -179,10 +423,16 @@ class ChatHandler(tornado.websocket.WebSocketHandler):
         if self._receive_timeout_timer_handle is not None:
             self._receive_timeout_timer_handle.cancel()
             self._receive_timeout_timer_handle = None
+        self._clear_send_queue()
+
+    def on_pong(self, data):
+        # 超时没有加入房间也断开
+        if self.has_joined_room:
+            self._refresh_receive_timeout_timer()
 
     def on_message(self, message):
         try:
-            body = json.loads(message)
+            body = utils.json_codec.loads(message)
             cmd = int(body['cmd'])
 
             if cmd == Command.HEARTBEAT:
@@ -204,6 +454,25 @@ class ChatHandler(tornado.websocket.WebSocketHandler):
             return
         data = body['data']
 
+        # 先解析配置，出错时不会加入房间
+        cfg = data.get('config', {})
+        self.encoding = Encoding(cfg.get('encoding', Encoding.JSON.value))
+        self.auto_translate = bool(cfg.get('autoTranslate', False))
+        self.enable_bundle = bool(cfg.get('enableBundle', False))
+        subscribed_cmds = cfg.get('subscribedCmds', None)
+        if subscribed_cmds is not None:
+            self.subscribed_cmds = frozenset(map(Command, subscribed_cmds)) | ALWAYS_SUBSCRIBED_COMMANDS
+        self.message_filter = services.chat.MessageFilter.from_dict(cfg.get('filter', {}))
+        self.max_text_rate = max(float(cfg.get('maxTextRate', 0.0)), 0.0)
+        self.is_relay = bool(cfg.get('isRelay', False))
+        if self.is_relay and not config.get_config().is_trusted_cluster_peer(
+            self.request.remote_ip, str(cfg.get('relaySecret', ''))
+        ):
+            # 防止普通客户端冒充其他节点，绕过IP连接数限制，或者让不负责的节点连接B站
+            logger.warning('client=%s is not a trusted cluster node, ignoring isRelay', self.request.remote_ip)
+            self.is_relay = False
+        self.heartbeat_mode = HeartbeatMode(cfg.get('heartbeatMode', HeartbeatMode.JSON.value))
+
         room_key_dict = data.get('roomKey', None)
         if room_key_dict is not None:
             self.room_key = services.chat.RoomKey.from_dict(room_key_dict)
@@ -213,13 +482,24 @@ class ChatHandler(tornado.websocket.WebSocketHandler):
         logger.info('client=%s joining room %s', self.request.remote_ip, self.room_key)
 
         try:
-            cfg = data['config']
-            self.auto_translate = bool(cfg['autoTranslate'])
-        except KeyError:
-            pass
+            services.chat.client_room_manager.add_client(self.room_key, self)
+        except services.chat.AdmissionRejected as e:
+            logger.warning('client=%s room=%s rejected: %s', self.request.remote_ip, self.room_key, e)
+            self.room_key = None
+            self._close_with_fatal_error(
+                FatalErrorType.TRY_AGAIN_LATER if e.is_temporary else FatalErrorType.TOO_MANY_CONNECTIONS, str(e)
+            )
+            return
+        if not self.is_relay:
+            utils.async_io.create_task_with_ref(self._on_joined_room())
 
-        services.chat.client_room_manager.add_client(self.room_key, self)
-        utils.async_io.create_task_with_ref(self._on_joined_room())
+        # 重连时补发断开期间错过的消息
+        last_msg_id = data.get('lastMsgId', None)
+        if last_msg_id is not None:
+            room = services.chat.client_room_manager.get_room(self.room_key)
+            replay_count = room.replay_messages(self, str(last_msg_id))
+            logger.info('client=%s room=%s replayed %d messages', self.request.remote_ip, self.room_key,
+                        replay_count)
 
         self._refresh_receive_timeout_timer()
 
@@ -235,14 +515,154 @@ class ChatHandler(tornado.websocket.WebSocketHandler):
     def has_joined_room(self):
         return self.room_key is not None
 
+    @property
+    def send_queue_size(self):
+        return len(self._send_queue)
+
+    @property
+    def send_queue_bytes(self):
+        return self._send_queue_bytes
+
     def send_cmd_data(self, cmd, data):
-        self.send_body_no_raise(make_message_body(cmd, data))
+        self.send_message_no_raise(OutgoingMessage(cmd, data))
 
-    def send_body_no_raise(self, body: Union[bytes, str, Dict[str, Any]]):
+    def send_message_no_raise(self, message: OutgoingMessage):
+        self.send_frame_no_raise(message.get_frame(self.encoding, self.enable_compression), message.droppable)
+
+    def send_frame_no_raise(self, frame: bytes, droppable=False):
+        """
+        发送已经打包好的WebSocket帧，如果上一次写还没完成则先放到发送队列
+
+        :param frame: make_frame打包的帧，编码要和self.encoding一样，压缩的帧只能发给enable_compression的客户端
+        :param droppable: 发送队列满时是否可以丢弃这条消息
+        """
+        if self._is_writing:
+            self._push_to_send_queue(frame, droppable)
+            return
+        self._write_frames((frame,))
+
+    def _write_frames(self, frames: Iterable[bytes]):
+        ws_connection = self.ws_connection
+        if ws_connection is None or ws_connection.is_closing():
+            self._clear_send_queue()
+            self.close()
+            return
+
+        # 直接写到底层的stream，跳过tornado每次打包帧、压缩的开销
+        future = None
         try:
-            self.write_message(body)
-        except tornado.websocket.WebSocketClosedError:
+            for frame in frames:
+                future = ws_connection.stream.write(frame)
+        except tornado.iostream.StreamClosedError:
+            self._clear_send_queue()
             self.close()
+            return
+        if future is None:
+            return
+
+        self._is_writing = True
+        future.add_done_callback(self._on_write_done)
+
+    def _on_write_done(self, future: asyncio.Future):
+        self._is_writing = False
+        if future.cancelled() or future.exception() is not None:
+            # 连接已断开
+            self._clear_send_queue()
+            return
+        if not self._send_queue:
+            return
+
+        # 一次把积压的消息都交给tornado
+        frames = [frame for frame, _droppable in self._send_queue]
+        self._clear_send_queue()
+        self._write_frames(frames)
+
+    def _push_to_send_queue(self, frame: bytes, droppable):
+        self._send_queue.append((frame, droppable))
+        self._send_queue_bytes += len(frame)
+        if not self._is_send_queue_full():
+            self._send_queue_overflow_time = None
+            return
+
+        self._drop_from_send_queue()
+        if not self._is_send_queue_full():
+            self._send_queue_overflow_time = None
+            return
+
+        # 剩下的都是不能丢弃的消息，持续超过上限太久则断开
+        if self._send_queue_overflow_time is None:
+            self._send_queue_overflow_time = time.monotonic()
+        elif self._is_slow_client():
+            self._close_slow_client()
+
+    def _is_send_queue_full(self):
+        cfg = config.get_config()
+        return (
+            len(self._send_queue) > cfg.client_send_queue_max_size
+            or self._send_queue_bytes > cfg.client_send_queue_max_bytes
+        )
+
+    def _is_slow_client(self):
+        """发送队列是否持续超过上限太久"""
+        return (
+            self._send_queue_overflow_time is not None
+            and time.monotonic() - self._send_queue_overflow_time > config.get_config().slow_client_timeout
+        )
+
+    def _drop_from_send_queue(self):
+        cfg = config.get_config()
+        if cfg.client_send_queue_drop_policy == 'drop_oldest':
+            indices = range(len(self._send_queue))
+        elif cfg.client_send_queue_drop_policy == 'drop_newest':
+            indices = range(len(self._send_queue) - 1, -1, -1)
+        else:
+            return
+
+        indices_to_drop = []
+        bytes_after_drop = self._send_queue_bytes
+        size_after_drop = len(self._send_queue)
+        for index in indices:
+            if (
+                size_after_drop <= cfg.client_send_queue_max_size
+                and bytes_after_drop <= cfg.client_send_queue_max_bytes
+            ):
+                break
+            frame, droppable = self._send_queue[index]
+            if not droppable:
+                continue
+            indices_to_drop.append(index)
+            bytes_after_drop -= len(frame)
+            size_after_drop -= 1
+        if not indices_to_drop:
+            return
+
+        # 从后往前删，防止索引变化
+        for index in sorted(indices_to_drop, reverse=True):
+            del self._send_queue[index]
+        self._send_queue_bytes = bytes_after_drop
+        self.dropped_msg_count += len(indices_to_drop)
+
+    def _clear_send_queue(self):
+        self._send_queue.clear()
+        self._send_queue_bytes = 0
+        self._send_queue_overflow_time = None
+
+    def _close_slow_client(self):
+        logger.warning('client=%s room=%s is too slow, send_queue_size=%d, send_queue_bytes=%d, closing',
+                       self.request.remote_ip, self.room_key, len(self._send_queue), self._send_queue_bytes)
+        self._clear_send_queue()
+        self._close_with_fatal_error(FatalErrorType.SLOW_CLIENT, 'The client is too slow to receive messages')
+
+    def _close_with_fatal_error(self, type_: FatalErrorType, msg: str):
+        # 不经过发送队列，直接交给tornado
+        try:
+            self.write_message(make_message_body(Command.FATAL_ERROR, {
+                'type': type_,
+                'msg': msg
+            }, self.encoding), self.encoding in BINARY_ENCODINGS)
+        except tornado.websocket.WebSocketClosedError:
+            pass
+        self.close()
 
     async def _on_joined_room(self):
         cfg = config.get_config()
@@ -280,12 +700,12 @@ class ChatHandler(tornado.websocket.WebSocketHandler):
         )
         member_data = {
             **base_data,
-            'id': uuid.uuid4().hex,
+            'id': utils.id_gen.new_id(),
             'privilegeType': 3
         }
         gift_data = {
             **base_data,
-            'id': uuid.uuid4().hex,
+            'id': utils.id_gen.new_id(),
             'totalCoin': 450000,
             'giftName': '摩天大楼',
             'num': 1
@@ -299,12 +719,12 @@ class ChatHandler(tornado.websocket.WebSocketHandler):
         }
         self.send_cmd_data(Command.ADD_TEXT, text_data)
         text_data[4] = 'te[dog]st'
-        text_data[11] = uuid.uuid4().hex
+        text_data[11] = utils.id_gen.new_id()
         self.send_cmd_data(Command.ADD_TEXT, text_data)
         text_data[2] = '主播'
         text_data[3] = 3
         text_data[4] = "I can eat glass, it doesn't hurt me."
-        text_data[11] = uuid.uuid4().hex
+        text_data[11] = utils.id_gen.new_id()
         self.send_cmd_data(Command.ADD_TEXT, text_data)
         self.send_cmd_data(Command.ADD_MEMBER, member_data)
         self.send_cmd_data(Command.ADD_SUPER_CHAT, sc_data)
@@ -314,11 +734,11 @@ class ChatHandler(tornado.websocket.WebSocketHandler):
         self.send_cmd_data(Command.ADD_SUPER_CHAT, sc_data)
         # self.send_cmd_data(Command.DEL_SUPER_CHAT, {'ids': [sc_data['id']]})
         self.send_cmd_data(Command.ADD_GIFT, gift_data)
-        gift_data['id'] = uuid.uuid4().hex
+        gift_data['id'] = utils.id_gen.new_id()
         gift_data['totalCoin'] = 1245000
         gift_data['giftName'] = '小电视飞船'
         self.send_cmd_data(Command.ADD_GIFT, gift_data)
-        gift_data['id'] = uuid.uuid4().hex
+        gift_data['id'] = utils.id_gen.new_id()
         gift_data['totalCoin'] = 0
         gift_data['totalFreeCoin'] = 1000
         gift_data['giftName'] = '辣条'
@@ -326,16 +746,41 @@ class ChatHandler(tornado.websocket.WebSocketHandler):
         self.send_cmd_data(Command.ADD_GIFT, gift_data)
 
 
+class StatsHandler(api.base.ApiHandler):
+    async def get(self):
+        cfg = config.get_config()
+        if not cfg.enable_stats_api:
+            raise tornado.web.HTTPError(403)
+
+        self.write({
+            # 多进程模式下只有处理这个请求的worker的统计
+            'workerId': services.worker.worker_id,
+            **services.chat.client_room_manager.get_stats(),
+            **services.chat.get_live_client_stats(),
+            **services.chat.get_sequencer_stats(),
+            'rooms': [room.get_stats() for room in services.chat.client_room_manager.iter_rooms()],
+        })
+
+
 class RoomInfoHandler(api.base.ApiHandler):
     async def get(self):
         room_id = int(self.get_query_argument('roomId'))
         logger.info('client=%s getting room info, room=%d', self.request.remote_ip, room_id)
 
-        (room_id, owner_uid), (host_server_list, host_server_token), buvid = await asyncio.gather(
-            self._get_room_info(room_id),
-            self._get_server_host_list_and_token(room_id),
-            self._get_buvid()
+        room_info, host_server_list_and_token, buvid = await asyncio.gather(
+            services.room_info.get_room_info(room_id),
+            # token会对UA签名，要使用和客户端一样的UA
+            services.room_info.get_host_server_list_and_token(room_id, self.request.headers.get('User-Agent', '')),
+            services.room_info.get_buvid()
         )
+        if room_info is not None:
+            room_id, owner_uid = room_info
+        else:
+            owner_uid = 0
+        if host_server_list_and_token is not None:
+            host_server_list, host_server_token = host_server_list_and_token
+        else:
+            host_server_list, host_server_token = dm_web_cli.DEFAULT_DANMAKU_SERVER_LIST, None
 
         # 缓存1分钟
         self.set_header('Cache-Control', 'private, max-age=60')
@@ -348,91 +793,6 @@ class RoomInfoHandler(api.base.ApiHandler):
             'buvid': buvid,
         })
 
-    @staticmethod
-    async def _get_room_info(room_id) -> Tuple[int, int]:
-        try:
-            async with utils.request.http_session.get(
-                dm_web_cli.ROOM_INIT_URL,
-                headers={
-                    **utils.request.BILIBILI_COMMON_HEADERS,
-                    'Origin': 'https://live.bilibili.com',
-                    'Referer': f'https://live.bilibili.com/{room_id}'
-                },
-                params={
-                    'room_id': room_id
-                }
-            ) as res:
-                if res.status != 200:
-                    logger.warning('room=%d _get_room_info failed: %d %s', room_id,
-                                   res.status, res.reason)
-                    return room_id, 0
-                data = await res.json()
-        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
-            logger.exception('room=%d _get_room_info failed', room_id)
-            return room_id, 0
-
-        if data['code'] != 0:
-            logger.warning('room=%d _get_room_info failed: %s', room_id, data['message'])
-            return room_id, 0
-
-        data = data['data']
-        return data['room_id'], data['uid']
-
-    async def _get_server_host_list_and_token(self, room_id) -> Tuple[dict, Optional[str]]:
-        try:
-            async with utils.request.http_session.get(
-                dm_web_cli.DANMAKU_SERVER_CONF_URL,
-                headers={
-                    # token会对UA签名，要使用和客户端一样的UA
-                    'User-Agent': self.request.headers.get('User-Agent', '')
-                },
-                params={
-                    'id': room_id,
-                    'type': 0
-                }
-            ) as res:
-                if res.status != 200:
-                    logger.warning('room %d _get_server_host_list failed: %d %s', room_id,
-                                   res.status, res.reason)
-                    return dm_web_cli.DEFAULT_DANMAKU_SERVER_LIST, None
-                data = await res.json()
-        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
-            logger.exception('room %d _get_server_host_list failed', room_id)
-            return dm_web_cli.DEFAULT_DANMAKU_SERVER_LIST, None
-
-        if data['code'] != 0:
-            logger.warning('room %d _get_server_host_list failed: %s', room_id, data['message'])
-            return dm_web_cli.DEFAULT_DANMAKU_SERVER_LIST, None
-
-        data = data['data']
-        host_server_list = data['host_list']
-        if not host_server_list:
-            logger.warning('room %d _get_server_host_list failed: host_server_list is empty')
-            return dm_web_cli.DEFAULT_DANMAKU_SERVER_LIST, None
-
-        host_server_token = data.get('token', None)
-        return host_server_list, host_server_token
-
-    async def _get_buvid(self):
-        buvid = self._do_get_buvid()
-        if buvid != '':
-            return buvid
-
-        try:
-            async with utils.request.http_session.get(dm_web_cli.BUVID_INIT_URL):
-                pass
-        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
-            pass
-        return self._do_get_buvid()
-
-    @staticmethod
-    def _do_get_buvid():
-        cookies = utils.request.http_session.cookie_jar.filter_cookies(yarl.URL(dm_web_cli.BUVID_INIT_URL))
-        buvid_cookie = cookies.get('buvid3', None)
-        if buvid_cookie is None:
-            return ''
-        return buvid_cookie.value
-
 
 class AvatarHandler(api.base.ApiHandler):
     async def get(self):
@@ -462,4 +822,5 @@ ROUTES = [
     (r'/api/room_info', RoomInfoHandler),
     (r'/api/avatar_url', AvatarHandler),
     (r'/api/text_emoticon_mappings', TextEmoticonMappingsHandler),
+    (r'/api/stats', StatsHandler),
 ]
@@ -1,6 +1,4 @@
 # -*- coding: utf-8 -*-
-import asyncio
-import json
 import logging
 from typing import *
 
@@ -14,6 +12,8 @@ import config
 import services.avatar
 import services.chat
 import services.plugin
+import utils.json_codec
+import utils.timing_wheel
 
 logger = logging.getLogger(__name__)
 
@@ -116,7 +116,7 @@ def make_message_body(cmd, data, extra: Optional[dict] = None):
     body = {'cmd': cmd, 'data': data}
     if extra:
         body['extra'] = extra
-    return json.dumps(body).encode('utf-8')
+    return utils.json_codec.dumps(body)
 
 
 class PluginWsHandler(_PluginApiHandlerBase, tornado.websocket.WebSocketHandler):
@@ -130,7 +130,7 @@ class PluginWsHandler(_PluginApiHandlerBase, tornado.websocket.WebSocketHandler)
 
     def open(self):
         logger.info('plugin=%s connected, client=%s', self.plugin.id, self.request.remote_ip)
-        self._heartbeat_timer_handle = asyncio.get_running_loop().call_later(
+        self._heartbeat_timer_handle = utils.timing_wheel.call_later(
             self.HEARTBEAT_INTERVAL, self._on_send_heartbeat
         )
         self._refresh_receive_timeout_timer()
@@ -139,14 +139,14 @@ class PluginWsHandler(_PluginApiHandlerBase, tornado.websocket.WebSocketHandler)
 
     def _on_send_heartbeat(self):
         self.send_cmd_data(models.Command.HEARTBEAT, {})
-        self._heartbeat_timer_handle = asyncio.get_running_loop().call_later(
+        self._heartbeat_timer_handle = utils.timing_wheel.call_later(
             self.HEARTBEAT_INTERVAL, self._on_send_heartbeat
         )
 
     def _refresh_receive_timeout_timer(self):
         if self._receive_timeout_timer_handle is not None:
             self._receive_timeout_timer_handle.cancel()
-        self._receive_timeout_timer_handle = asyncio.get_running_loop().call_later(
+        self._receive_timeout_timer_handle = utils.timing_wheel.call_later(
             self.RECEIVE_TIMEOUT, self._on_receive_timeout
         )
 
@@ -167,7 +167,7 @@ class PluginWsHandler(_PluginApiHandlerBase, tornado.websocket.WebSocketHandler)
 
     def on_message(self, message):
         try:
-            body = json.loads(message)
+            body = utils.json_codec.loads(message)
             cmd = int(body['cmd'])
             data = body['data']
 
@@ -216,13 +216,14 @@ class PluginWsHandler(_PluginApiHandlerBase, tornado.websocket.WebSocketHandler)
             translation=str(data['translation']),
         )
 
-        body_for_room = api.chat.make_message_body(api.chat.Command.ADD_TEXT, data_to_send)
+        message_for_room = api.chat.OutgoingMessage(api.chat.Command.ADD_TEXT, data_to_send)
         for room in rooms:
-            room.send_body_no_raise(body_for_room)
+            room.send_message_no_raise(message_for_room)
 
+            # 每个房间的附加信息不一样，data只序列化一次
             extra = services.chat.make_plugin_msg_extra_from_client_room(room)
             extra['isFromPlugin'] = True
-            services.plugin.broadcast_cmd_data(models.Command.ADD_TEXT, data_to_send, extra)
+            services.plugin.broadcast_message(message_for_room, extra)
 
     def send_cmd_data(self, cmd, data, extra: Optional[dict] = None):
         self.send_body_no_raise(make_message_body(cmd, data, extra))
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+基准测试共用的工具
+
+在项目根目录运行，比如 python -m benchmarks.broadcast。需要先安装requirements.txt中的依赖
+"""
+import argparse
+import collections
+import random
+import timeit
+import types
+from typing import *
+
+import api.chat
+import config
+import services.chat
+import utils.id_gen
+
+
+def init_config():
+    config.init(argparse.Namespace(host=None, port=None, debug=False))
+
+
+def bench(func: Callable[[], Any], repeat=5) -> float:
+    """返回每次调用的最短耗时（秒），和timeit一样自动决定调用次数"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def format_time(seconds: float) -> str:
+    if seconds < 1e-6:
+        return f'{seconds * 1e9:.1f} ns'
+    if seconds < 1e-3:
+        return f'{seconds * 1e6:.2f} us'
+    if seconds < 1:
+        return f'{seconds * 1e3:.2f} ms'
+    return f'{seconds:.2f} s'
+
+
+#
+# 模拟的直播消息，字段和services.chat中生成的一样
+#
+
+_NAMES = ['bilibili用户', '路人甲', 'xfgryujk', '一只小猫咪', 'VeryLongUserName_12345', '弹幕姬']
+_CONTENTS = [
+    '草', '666', '哈哈哈哈哈哈', '主播好厉害', '这是什么操作啊？？？', 'awsl',
+    '晚上好！今天的直播也很有意思，期待下一次', '[dog][dog][dog]', 'hello world',
+]
+_AVATAR_URL = '//i0.hdslb.com/bfs/face/0123456789abcdef0123456789abcdef01234567.jpg'
+
+
+def make_sample_messages(num=1000, seed=0) -> List[Tuple[api.chat.Command, Any]]:
+    """
+    按常见直播间的比例生成消息：大部分是弹幕，少量礼物、上舰和醒目留言
+
+    :return: [(cmd, data)]
+    """
+    rand = random.Random(seed)
+    res = []
+    for _ in range(num):
+        uid = rand.randrange(1, 10 ** 9)
+        name = rand.choice(_NAMES)
+        r = rand.random()
+        if r < 0.9:
+            data = api.chat.make_text_message_data(
+                avatar_url=_AVATAR_URL,
+                author_name=name,
+                content=rand.choice(_CONTENTS),
+                author_level=rand.randrange(1, 60),
+                medal_level=rand.randrange(0, 30),
+                uid=str(uid),
+                medal_name='粉丝牌',
+            )
+            res.append((api.chat.Command.ADD_TEXT, data))
+        elif r < 0.96:
+            data = {
+                'id': utils.id_gen.new_id(),
+                'avatarUrl': _AVATAR_URL,
+                'timestamp': 1700000000,
+                'authorName': name,
+                'totalCoin': rand.choice((0, 100, 1000, 5200)),
+                'totalFreeCoin': 0,
+                'giftName': '小花花',
+                'num': rand.randrange(1, 10),
+                'giftId': 31036,
+                'giftIconUrl': 'https://s1.hdslb.com/bfs/live/8b40d0470890e7d573995383af8a8ae074d485d9.png',
+                'uid': str(uid),
+                'privilegeType': 0,
+                'medalLevel': 0,
+                'medalName': '',
+            }
+            res.append((api.chat.Command.ADD_GIFT, data))
+        elif r < 0.98:
+            data = {
+                'id': utils.id_gen.new_id(),
+                'avatarUrl': _AVATAR_URL,
+                'timestamp': 1700000000,
+                'authorName': name,
+                'privilegeType': 3,
+                'num': 1,
+                'unit': '月',
+                'total_coin': 198000,
+                'uid': str(uid),
+                'medalLevel': 0,
+                'medalName': '',
+            }
+            res.append((api.chat.Command.ADD_MEMBER, data))
+        else:
+            data = {
+                'id': str(rand.randrange(10 ** 7)),
+                'avatarUrl': _AVATAR_URL,
+                'timestamp': 1700000000,
+                'authorName': name,
+                'price': rand.choice((30, 50, 100)),
+                'content': rand.choice(_CONTENTS),
+                'translation': '',
+                'uid': str(uid),
+                'privilegeType': 0,
+                'medalLevel': 0,
+                'medalName': '',
+            }
+            res.append((api.chat.Command.ADD_SUPER_CHAT, data))
+    return res
+
+
+#
+# 不经过网络的ChatHandler，帧写到内存里，只统计字节数
+#
+
+class FakeStream:
+    def __init__(self):
+        self.written_bytes = 0
+        self.write_count = 0
+
+    def write(self, data: bytes):
+        self.written_bytes += len(data)
+        self.write_count += 1
+        # 相当于写入立即完成，不会进入发送队列
+        return None
+
+
+class FakeWebSocketConnection:
+    def __init__(self):
+        self.stream = FakeStream()
+
+    @staticmethod
+    def is_closing():
+        return False
+
+
+def make_fake_chat_handler(
+    room_key: 'services.chat.RoomKey', encoding=api.chat.Encoding.JSON, enable_compression=False,
+    auto_translate=False, remote_ip='127.0.0.1'
+) -> 'api.chat.ChatHandler':
+    """创建不用tornado初始化的ChatHandler，属性和ChatHandler.__init__中的一样"""
+    client: api.chat.ChatHandler = api.chat.ChatHandler.__new__(api.chat.ChatHandler)
+    client._heartbeat_timer_handle = None
+    client._receive_timeout_timer_handle = None
+    client._send_queue = collections.deque()
+    client._send_queue_bytes = 0
+    client._is_writing = False
+    client._send_queue_overflow_time = None
+    client.dropped_msg_count = 0
+
+    client.room_key = room_key
+    client.auto_translate = auto_translate
+    client.enable_bundle = False
+    client.enable_compression = enable_compression
+    client.encoding = encoding
+    client.subscribed_cmds = frozenset(api.chat.Command)
+    client.message_filter = services.chat.MessageFilter()
+    client.max_text_rate = 0.0
+    client.is_relay = False
+    client.heartbeat_mode = api.chat.HeartbeatMode.JSON
+
+    client.ws_connection = FakeWebSocketConnection()
+    client.request = types.SimpleNamespace(remote_ip=remote_ip)
+    return client
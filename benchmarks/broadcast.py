@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+广播一条消息的每客户端开销
+
+旧的做法是每个客户端调用一次write_message，tornado给每个客户端打包一次帧，开启压缩时还要每个客户端压缩一次。
+现在每种格式只打包一次，所有客户端共用同一个帧
+
+python -m benchmarks.broadcast
+"""
+import api.chat
+import services.chat
+from benchmarks import _common
+
+CLIENT_NUMS = (1000, 5000)
+
+
+def main():
+    _common.init_config()
+    messages = [api.chat.OutgoingMessage(cmd, data) for cmd, data in _common.make_sample_messages(100)]
+
+    print(f'{"clients":>8} {"compress":>8} {"per-client frame":>18} {"shared frame":>14} {"speedup":>8}')
+    for client_num in CLIENT_NUMS:
+        for compress in (False, True):
+            per_client_time = _bench_per_client_frame(messages, client_num, compress)
+            shared_time = _bench_shared_frame(messages, client_num, compress)
+            print(
+                f'{client_num:>8} {str(compress):>8}'
+                f' {_common.format_time(per_client_time / client_num) + "/client":>18}'
+                f' {_common.format_time(shared_time / client_num) + "/client":>14}'
+                f' {per_client_time / shared_time:>7.1f}x'
+            )
+
+
+def _make_room(client_num, compress):
+    room_key = services.chat.RoomKey(services.chat.RoomKeyType.ROOM_ID, 1)
+    room = services.chat.ClientRoom(room_key)
+    for _ in range(client_num):
+        room.add_client(_common.make_fake_chat_handler(room_key, enable_compression=compress))
+    return room
+
+
+def _bench_per_client_frame(messages, client_num, compress):
+    """模拟旧的做法，消息体只序列化一次，但是每个客户端都打包一次帧"""
+    room = _make_room(client_num, compress)
+    bodies = [message.get_body(api.chat.Encoding.JSON) for message in messages]
+
+    def send_all():
+        for body in bodies:
+            for client in room.clients:
+                client.ws_connection.stream.write(api.chat.make_frame(body, False, compress))
+
+    return _common.bench(send_all, repeat=3) / len(bodies)
+
+
+def _bench_shared_frame(messages, client_num, compress):
+    """现在的做法，经过ClientRoom.send_message_no_raise，包括补发缓冲区等开销"""
+    room = _make_room(client_num, compress)
+
+    def send_all():
+        for message in messages:
+            # 每次用新的对象，不能用上一次缓存的帧
+            room.send_message_no_raise(api.chat.OutgoingMessage(message.cmd, message.data))
+
+    return _common.bench(send_all, repeat=3) / len(messages)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+处理弹幕时每条消息创建协程和task的开销
+
+旧的做法是每条弹幕都创建一个协程和task再发送，现在自带头像的弹幕直接同步发送。
+blivedm一次收到一批消息，这里也按批处理，统计每条消息的耗时和处理一批时内存峰值的增长
+
+python -m benchmarks.danmaku
+"""
+import asyncio
+import time
+import tracemalloc
+
+import api.chat
+import services.chat
+import utils.async_io
+from benchmarks import _common
+
+MESSAGE_NUM = 10000
+# 一个WebSocket包中的消息数
+BATCH_SIZE = 100
+CLIENT_NUM = 10
+
+
+def main():
+    _common.init_config()
+    services.chat.init()
+    asyncio.run(_main())
+
+
+async def _main():
+    room_key = services.chat.RoomKey(services.chat.RoomKeyType.ROOM_ID, 1)
+    room = services.chat.ClientRoom(room_key)
+    for _ in range(CLIENT_NUM):
+        room.add_client(_common.make_fake_chat_handler(room_key))
+    samples = _common.make_sample_messages(BATCH_SIZE)
+    batches = [samples] * (MESSAGE_NUM // BATCH_SIZE)
+
+    def send_danmaku(cmd, data):
+        room.send_message_no_raise(api.chat.OutgoingMessage(cmd, data))
+
+    async def on_danmaku_async(cmd, data):
+        send_danmaku(cmd, data)
+
+    def on_danmaku_with_task(cmd, data):
+        utils.async_io.create_task_with_ref(on_danmaku_async(cmd, data))
+
+    print(f'{CLIENT_NUM} clients, {BATCH_SIZE} messages per batch')
+    print(f'{"path":>12} {"time":>12} {"peak bytes":>11}')
+    for name, on_danmaku in (
+        ('create_task', on_danmaku_with_task),
+        ('sync', send_danmaku),
+    ):
+        # 预热
+        await _run_batches(batches[:10], on_danmaku)
+        start_time = time.perf_counter()
+        await _run_batches(batches, on_danmaku)
+        elapsed = time.perf_counter() - start_time
+
+        tracemalloc.start()
+        await _run_batches(batches[:10], on_danmaku)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            f'{name:>12} {_common.format_time(elapsed / MESSAGE_NUM) + "/msg":>12}'
+            f' {peak / BATCH_SIZE:>7.0f}/msg'
+        )
+
+
+async def _run_batches(batches, on_danmaku):
+    for batch in batches:
+        for cmd, data in batch:
+            on_danmaku(cmd, data)
+        # 让task执行完，相当于处理下一个包之前
+        while utils.async_io._task_refs:  # noqa
+            await asyncio.sleep(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+JSON和MessagePack消息体的编码耗时和大小
+
+python -m benchmarks.encoding
+"""
+import api.chat
+from benchmarks import _common
+
+
+def main():
+    _common.init_config()
+    samples = _common.make_sample_messages(1000)
+
+    print(f'{"encoding":>8} {"encode":>12} {"body bytes":>11} {"compressed frame bytes":>23}')
+    for encoding in api.chat.Encoding:
+        def encode_all():
+            for cmd, data in samples:
+                api.chat.make_message_body(cmd, data, encoding)
+
+        encode_time = _common.bench(encode_all) / len(samples)
+        body_bytes = frame_bytes = 0
+        for cmd, data in samples:
+            message = api.chat.OutgoingMessage(cmd, data)
+            body_bytes += len(message.get_body(encoding))
+            frame_bytes += len(message.get_frame(encoding, True))
+        print(
+            f'{encoding.value:>8} {_common.format_time(encode_time) + "/msg":>12}'
+            f' {body_bytes / len(samples):>11.1f} {frame_bytes / len(samples):>23.1f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
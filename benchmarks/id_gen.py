@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+消息ID的生成耗时和消息体大小，uuid4().hex和utils.id_gen比较
+
+python -m benchmarks.id_gen
+"""
+import copy
+import uuid
+
+import api.chat
+import utils.id_gen
+from benchmarks import _common
+
+
+def main():
+    _common.init_config()
+
+    print(f'{"generator":>12} {"new id":>10} {"id chars":>9} {"json body bytes":>16} {"msgpack body bytes":>19}')
+    samples = _common.make_sample_messages(1000)
+    for name, new_id in (
+        ('uuid4().hex', lambda: uuid.uuid4().hex),
+        ('id_gen', utils.id_gen.new_id),
+    ):
+        new_id_time = _common.bench(new_id)
+        json_bytes = msgpack_bytes = 0
+        for cmd, data in _replace_ids(samples, new_id):
+            json_bytes += len(api.chat.make_message_body(cmd, data, api.chat.Encoding.JSON))
+            msgpack_bytes += len(api.chat.make_message_body(cmd, data, api.chat.Encoding.MSGPACK))
+        print(
+            f'{name:>12} {_common.format_time(new_id_time):>10} {len(new_id()):>9}'
+            f' {json_bytes / len(samples):>16.1f} {msgpack_bytes / len(samples):>19.1f}'
+        )
+
+
+def _replace_ids(samples, new_id):
+    res = []
+    for cmd, data in samples:
+        data = copy.copy(data)
+        if cmd == api.chat.Command.ADD_TEXT:
+            data[11] = new_id()
+        elif cmd in (api.chat.Command.ADD_GIFT, api.chat.Command.ADD_MEMBER):
+            data['id'] = new_id()
+        res.append((cmd, data))
+    return res
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+热点路径上JSON序列化的耗时，分别测utils.json_codec可以用的每种后端
+
+python -m benchmarks.json_codec
+"""
+import json
+
+import utils.json_codec
+from benchmarks import _common
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def main():
+    samples = [{'cmd': cmd, 'data': data} for cmd, data in _common.make_sample_messages(1000)]
+    encoded_samples = [json.dumps(sample).encode('utf-8') for sample in samples]
+
+    backends = [('json', lambda obj: json.dumps(obj).encode('utf-8'), json.loads)]
+    if orjson is not None:
+        backends.append(('orjson', lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS), orjson.loads))
+
+    print(f'utils.json_codec is using: {utils.json_codec.BACKEND_NAME}')
+    print(f'{"backend":>8} {"dumps":>12} {"loads":>12} {"bytes":>8}')
+    for name, dumps, loads in backends:
+        def dumps_all():
+            for sample in samples:
+                dumps(sample)
+
+        def loads_all():
+            for encoded in encoded_samples:
+                loads(encoded)
+
+        dumps_time = _common.bench(dumps_all) / len(samples)
+        loads_time = _common.bench(loads_all) / len(samples)
+        bytes_ = sum(len(dumps(sample)) for sample in samples) / len(samples)
+        print(
+            f'{name:>8} {_common.format_time(dumps_time) + "/msg":>12}'
+            f' {_common.format_time(loads_time) + "/msg":>12} {bytes_:>8.1f}'
+        )
+    if orjson is None:
+        print('orjson is not installed, nothing to compare with. Run pip install orjson and try again')
+
+
+if __name__ == '__main__':
+    main()
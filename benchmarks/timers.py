@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+大量空闲连接时心跳、超时定时器占用的事件循环开销
+
+每个连接和ChatHandler一样有两个定时器：每HEARTBEAT_INTERVAL秒发一次心跳，收到客户端的心跳后重新设置接收超时。
+比较每次都用loop.call_later和用时间轮，统计一个心跳周期内事件循环用的CPU时间
+
+python -m benchmarks.timers
+"""
+import asyncio
+import random
+import time
+
+import api.chat
+import utils.timing_wheel
+from benchmarks import _common
+
+CONNECTION_NUMS = (10000, 50000)
+HEARTBEAT_INTERVAL = api.chat.ChatHandler.HEARTBEAT_INTERVAL
+RECEIVE_TIMEOUT = api.chat.ChatHandler.RECEIVE_TIMEOUT
+
+
+class _IdleConnection:
+    def __init__(self, call_later):
+        self._call_later = call_later
+        self._heartbeat_timer_handle = None
+        self._receive_timeout_timer_handle = None
+
+    def open(self, first_heartbeat_delay):
+        self._heartbeat_timer_handle = self._call_later(first_heartbeat_delay, self._on_send_heartbeat)
+        self._refresh_receive_timeout_timer()
+
+    def close(self):
+        self._heartbeat_timer_handle.cancel()
+        self._receive_timeout_timer_handle.cancel()
+
+    def _on_send_heartbeat(self):
+        self._heartbeat_timer_handle = self._call_later(HEARTBEAT_INTERVAL, self._on_send_heartbeat)
+        # 相当于立即收到了客户端的心跳
+        self._refresh_receive_timeout_timer()
+
+    def _refresh_receive_timeout_timer(self):
+        if self._receive_timeout_timer_handle is not None:
+            self._receive_timeout_timer_handle.cancel()
+        self._receive_timeout_timer_handle = self._call_later(RECEIVE_TIMEOUT, self._on_receive_timeout)
+
+    @staticmethod
+    def _on_receive_timeout():
+        raise AssertionError('Idle connections should not time out')
+
+
+def main():
+    print(f'{"connections":>11} {"timers":>12} {"CPU time/period":>16} {"loop heap size":>15}')
+    for connection_num in CONNECTION_NUMS:
+        for name in ('call_later', 'timing_wheel'):
+            cpu_time, heap_size = asyncio.run(_bench(connection_num, name))
+            print(f'{connection_num:>11} {name:>12} {_common.format_time(cpu_time):>16} {heap_size:>15}')
+
+
+async def _bench(connection_num, name):
+    loop = asyncio.get_running_loop()
+    if name == 'call_later':
+        call_later = loop.call_later
+    else:
+        call_later = utils.timing_wheel.TimingWheel().call_later
+
+    # 连接是陆续建立的，心跳均匀分布在一个周期内
+    rand = random.Random(0)
+    connections = [_IdleConnection(call_later) for _ in range(connection_num)]
+    for connection in connections:
+        connection.open(rand.uniform(0, HEARTBEAT_INTERVAL))
+
+    start_time = time.process_time()
+    await asyncio.sleep(HEARTBEAT_INTERVAL)
+    cpu_time = time.process_time() - start_time
+    # 包括已取消但还没弹出的定时器
+    heap_size = len(loop._scheduled)  # noqa
+
+    for connection in connections:
+        connection.close()
+    return cpu_time, heap_size
+
+
+if __name__ == '__main__':
+    main()
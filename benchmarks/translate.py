@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+发送翻译消息的开销，房间中客户端很多但是只有少数开启了自动翻译
+
+旧的做法是遍历所有客户端判断auto_translate，现在每个客户端组维护开启了自动翻译的客户端列表
+
+python -m benchmarks.translate
+"""
+import api.chat
+import services.chat
+from benchmarks import _common
+
+CLIENT_NUM = 10000
+AUTO_TRANSLATE_CLIENT_NUMS = (0, 10, 100)
+
+
+def main():
+    _common.init_config()
+    room_key = services.chat.RoomKey(services.chat.RoomKeyType.ROOM_ID, 1)
+    message = api.chat.OutgoingMessage(
+        api.chat.Command.UPDATE_TRANSLATION, api.chat.make_translation_message_data('0' * 14, '翻译')
+    )
+
+    print(f'{CLIENT_NUM} clients')
+    print(f'{"auto translate":>14} {"filter all":>12} {"index":>12} {"speedup":>8}')
+    for auto_translate_num in AUTO_TRANSLATE_CLIENT_NUMS:
+        room = services.chat.ClientRoom(room_key)
+        for index in range(CLIENT_NUM):
+            room.add_client(_common.make_fake_chat_handler(room_key, auto_translate=index < auto_translate_num))
+
+        def filter_all():
+            frame = message.get_frame(api.chat.Encoding.JSON, False)
+            for client in room.clients:
+                if client.auto_translate:
+                    client.send_frame_no_raise(frame, message.droppable)
+
+        filter_all_time = _common.bench(filter_all)
+        index_time = _common.bench(lambda: room.send_auto_translate_message_no_raise(message))
+        print(
+            f'{auto_translate_num:>14} {_common.format_time(filter_all_time):>12}'
+            f' {_common.format_time(index_time):>12} {filter_all_time / index_time:>7.1f}x'
+        )
+
+
+if __name__ == '__main__':
+    main()
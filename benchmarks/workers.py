@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+多进程模式的吞吐量随worker数的变化
+
+一个房间的客户端平均分到N个worker，当前进程相当于主进程，用真实的IPC转发消息给其他worker。
+统计从开始广播到所有worker都发完的时间，吞吐量是每秒发给客户端的消息数。CPU核数少于N时不会有提升
+
+python -m benchmarks.workers
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import api.chat
+import services.chat
+import services.worker
+from benchmarks import _common
+
+WORKER_NUMS = (1, 2, 4)
+CLIENT_NUM = 8000
+MESSAGE_NUM = 1000
+
+ROOM_KEY = services.chat.RoomKey(services.chat.RoomKeyType.ROOM_ID, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--worker-id', type=int, default=0)
+    parser.add_argument('--ipc-path')
+    parser.add_argument('--clients', type=int)
+    args = parser.parse_args()
+
+    _common.init_config()
+    services.chat.init()
+    if args.worker_id == 0:
+        asyncio.run(_run_master())
+    else:
+        asyncio.run(_run_worker(args.worker_id, args.ipc_path, args.clients))
+
+
+async def _run_master():
+    print(f'CPU count: {os.cpu_count()}, {CLIENT_NUM} clients, {MESSAGE_NUM} messages')
+    print(f'{"workers":>7} {"elapsed":>10} {"deliveries/s":>13} {"scaling":>8}')
+    # 测的是吞吐量，不丢弃消息，主进程发得比worker快时积压在发送缓冲区
+    services.worker.WorkerConnection.MAX_WRITE_BUFFER_SIZE = sys.maxsize
+
+    base_throughput = None
+    for worker_num in WORKER_NUMS:
+        elapsed = await _bench_master(worker_num)
+        throughput = CLIENT_NUM * MESSAGE_NUM / elapsed
+        if base_throughput is None:
+            base_throughput = throughput
+        print(
+            f'{worker_num:>7} {_common.format_time(elapsed):>10} {throughput:>13.0f}'
+            f' {throughput / base_throughput:>7.2f}x'
+        )
+
+
+async def _bench_master(worker_num):
+    messages = [api.chat.OutgoingMessage(cmd, data) for cmd, data in _common.make_sample_messages(MESSAGE_NUM)]
+    client_nums = [CLIENT_NUM // worker_num] * worker_num
+    client_nums[0] += CLIENT_NUM % worker_num
+
+    # 不经过client_room_manager.add_client，否则会创建到B站的连接
+    room = services.chat.ClientRoom(ROOM_KEY)
+    services.chat.client_room_manager._rooms[ROOM_KEY] = room  # noqa
+    for _ in range(client_nums[0]):
+        room.add_client(_common.make_fake_chat_handler(ROOM_KEY))
+
+    worker_manager = services.worker._worker_manager = services.worker.WorkerManager()  # noqa
+    ipc_dir = tempfile.mkdtemp(prefix='blivechat-bench-')
+    ipc_path = os.path.join(ipc_dir, 'master.sock')
+    server = await asyncio.start_unix_server(worker_manager._on_worker_connect, ipc_path)  # noqa
+    processes = []
+    try:
+        for worker_id in range(1, worker_num):
+            processes.append(await asyncio.create_subprocess_exec(
+                sys.executable, '-m', 'benchmarks.workers',
+                '--worker-id', str(worker_id), '--ipc-path', ipc_path, '--clients', str(client_nums[worker_id]),
+                stdout=asyncio.subprocess.PIPE,
+            ))
+        # 等所有worker订阅房间
+        while room.remote_worker_count < worker_num - 1:
+            await asyncio.sleep(0.1)
+
+        start_time = time.perf_counter()
+        for index, message in enumerate(messages):
+            room.send_message_no_raise(message)
+            if index % 100 == 0:
+                # 让出时间片，IPC的数据才能写出去
+                await asyncio.sleep(0)
+        for process in processes:
+            line = await process.stdout.readline()
+            if line.strip() != b'done':
+                raise RuntimeError(f'Worker exited unexpectedly: {line!r}')
+        return time.perf_counter() - start_time
+    finally:
+        server.close()
+        await worker_manager.shut_down()
+        for process in processes:
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+        os.remove(ipc_path)
+        os.rmdir(ipc_dir)
+        services.worker._worker_manager = None  # noqa
+        services.chat.client_room_manager._rooms.pop(ROOM_KEY, None)  # noqa
+
+
+async def _run_worker(worker_id, ipc_path, client_num):
+    loop = asyncio.get_running_loop()
+    master_lost_future = loop.create_future()
+    if not await services.worker.init_worker(worker_id, ipc_path, lambda: master_lost_future.set_result(None)):
+        return
+
+    clients = [_common.make_fake_chat_handler(ROOM_KEY) for _ in range(client_num)]
+    # 加入房间时会订阅主进程的消息
+    for client in clients:
+        services.chat.client_room_manager.add_client(ROOM_KEY, client)
+
+    stream = clients[0].ws_connection.stream
+    while stream.write_count < MESSAGE_NUM:
+        if master_lost_future.done():
+            return
+        await asyncio.sleep(0.005)
+    print('done', flush=True)
+    await master_lost_future
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ from typing import *
 import aiohttp
 
 from . import handlers
+from . import json_codec
 from . import models
 
 __all__ = (
@@ -121,7 +122,7 @@ class BlcPluginClient:
             raise ConnectionResetError('websocket is closed')
 
         body = {'cmd': cmd, 'data': data}
-        await self._websocket.send_json(body)
+        await self._websocket.send_json(body, dumps=json_codec.dumps_str)
 
     async def _network_coroutine_wrapper(self):
         """负责处理网络协程的异常，网络协程具体逻辑在_network_coroutine里"""
@@ -204,7 +205,7 @@ class BlcPluginClient:
             return
 
         try:
-            body = message.json()
+            body = message.json(loads=json_codec.loads)
             self._handle_command(body)
         except Exception:
             logger.error('body=%s', message.data)
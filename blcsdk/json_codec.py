@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+JSON序列化，和blivechat的utils.json_codec一样，因为插件里不能导入blivechat的模块
+
+安装了orjson时用orjson，否则用标准库json
+
+修改时要同步修改blivechat的utils/json_codec.py
+"""
+import json
+from typing import *
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(obj) -> bytes:
+    return json.dumps(obj).encode('utf-8')
+
+
+def _json_loads(s: Union[str, bytes]):
+    return json.loads(s)
+
+
+if orjson is not None:
+    BACKEND_NAME = 'orjson'
+
+    def dumps(obj) -> bytes:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # 比如超过64位的整数，orjson不支持
+            return _json_dumps(obj)
+
+    def loads(s: Union[str, bytes]):
+        return orjson.loads(s)
+else:
+    BACKEND_NAME = 'json'
+    dumps = _json_dumps
+    loads = _json_loads
+
+
+def dumps_str(obj) -> str:
+    """给需要str的接口用，比如aiohttp的send_json"""
+    return dumps(obj).decode('utf-8')
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import configparser
+import hmac
 import logging
 import os
 import re
@@ -65,8 +66,33 @@ class AppConfig:
         self.open_browser_at_startup = True
         self.enable_upload_file = True
         self.enable_admin_plugins = True
+        self.enable_stats_api = False
+        self.enable_handoff = False
+
+        self.client_send_queue_max_size = 1000
+        self.client_send_queue_max_bytes = 1024 * 1024
+        self.client_send_queue_drop_policy = 'drop_oldest'
+        self.slow_client_timeout = 10.0
+        self.enable_websocket_compression = False
+        self.replay_buffer_size = 200
+
+        self.max_total_clients = 0
+        self.max_clients_per_room = 0
+        self.max_clients_per_ip = 0
+        self.max_new_rooms_per_minute = 0
+
+        self.warm_live_client_pool_size = 0
+        self.warm_live_client_ttl = 300.0
+        self.max_reconnects_per_second = 10.0
+
+        self.cluster_nodes: List[str] = []
+        self.cluster_self_node = ''
+        self.cluster_secret = ''
+        # cluster_nodes中的host部分，用来判断转发用的连接是否来自其他节点
+        self.cluster_node_hosts: FrozenSet[str] = frozenset()
 
         self.fetch_avatar_max_queue_size = 4
+        self.fetch_avatar_timeout = 1.0
         self.avatar_cache_size = 10000
 
         self.open_live_access_key_id = ''
@@ -84,6 +110,18 @@ class AppConfig:
         self.registered_endpoints: List[str] = []
         self.cors_origins: List[re.Pattern[str]] = []
 
+    @property
+    def is_cluster_enabled(self):
+        return len(self.cluster_nodes) > 1
+
+    def is_trusted_cluster_peer(self, remote_ip, secret):
+        """转发用的连接是否来自集群的其他节点。配置了cluster_secret时只认密钥，否则只认cluster_nodes中的IP"""
+        if not self.is_cluster_enabled:
+            return False
+        if self.cluster_secret != '':
+            return hmac.compare_digest(secret.encode('utf-8'), self.cluster_secret.encode('utf-8'))
+        return remote_ip in self.cluster_node_hosts
+
     @property
     def is_open_live_configured(self):
         return (
@@ -126,10 +164,53 @@ class AppConfig:
         self.open_browser_at_startup = app_section.getboolean('open_browser_at_startup', self.open_browser_at_startup)
         self.enable_upload_file = app_section.getboolean('enable_upload_file', self.enable_upload_file)
         self.enable_admin_plugins = app_section.getboolean('enable_admin_plugins', self.enable_admin_plugins)
+        self.enable_stats_api = app_section.getboolean('enable_stats_api', self.enable_stats_api)
+        self.enable_handoff = app_section.getboolean('enable_handoff', self.enable_handoff)
+
+        self.client_send_queue_max_size = app_section.getint(
+            'client_send_queue_max_size', self.client_send_queue_max_size
+        )
+        self.client_send_queue_max_bytes = app_section.getint(
+            'client_send_queue_max_bytes', self.client_send_queue_max_bytes
+        )
+        drop_policy = app_section.get('client_send_queue_drop_policy', self.client_send_queue_drop_policy)
+        if drop_policy in ('drop_oldest', 'drop_newest', 'none'):
+            self.client_send_queue_drop_policy = drop_policy
+        else:
+            logger.warning('Invalid client_send_queue_drop_policy=%s, using %s', drop_policy,
+                           self.client_send_queue_drop_policy)
+        self.slow_client_timeout = app_section.getfloat('slow_client_timeout', self.slow_client_timeout)
+        self.enable_websocket_compression = app_section.getboolean(
+            'enable_websocket_compression', self.enable_websocket_compression
+        )
+        self.replay_buffer_size = app_section.getint('replay_buffer_size', self.replay_buffer_size)
+
+        self.max_total_clients = app_section.getint('max_total_clients', self.max_total_clients)
+        self.max_clients_per_room = app_section.getint('max_clients_per_room', self.max_clients_per_room)
+        self.max_clients_per_ip = app_section.getint('max_clients_per_ip', self.max_clients_per_ip)
+        self.max_new_rooms_per_minute = app_section.getint('max_new_rooms_per_minute', self.max_new_rooms_per_minute)
+
+        self.warm_live_client_pool_size = app_section.getint(
+            'warm_live_client_pool_size', self.warm_live_client_pool_size
+        )
+        self.warm_live_client_ttl = app_section.getfloat('warm_live_client_ttl', self.warm_live_client_ttl)
+        self.max_reconnects_per_second = app_section.getfloat(
+            'max_reconnects_per_second', self.max_reconnects_per_second
+        )
+
+        self.cluster_nodes = _str_to_list(app_section.get('cluster_nodes', ''))
+        self.cluster_self_node = app_section.get('cluster_self_node', self.cluster_self_node)
+        if self.cluster_nodes and self.cluster_self_node not in self.cluster_nodes:
+            logger.warning('cluster_self_node=%s is not in cluster_nodes, disabling cluster mode',
+                           self.cluster_self_node)
+            self.cluster_nodes = []
+        self.cluster_secret = app_section.get('cluster_secret', self.cluster_secret)
+        self.cluster_node_hosts = frozenset(node.rsplit(':', 1)[0].strip('[]') for node in self.cluster_nodes)
 
         self.fetch_avatar_max_queue_size = app_section.getint(
             'fetch_avatar_max_queue_size', self.fetch_avatar_max_queue_size
         )
+        self.fetch_avatar_timeout = app_section.getfloat('fetch_avatar_timeout', self.fetch_avatar_timeout)
         self.avatar_cache_size = app_section.getint('avatar_cache_size', self.avatar_cache_size)
 
         self.open_live_access_key_id = app_section.get('open_live_access_key_id', self.open_live_access_key_id)
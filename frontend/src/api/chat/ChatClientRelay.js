@@ -11,6 +11,7 @@ const COMMAND_ADD_SUPER_CHAT = 5
 const COMMAND_DEL_SUPER_CHAT = 6
 const COMMAND_UPDATE_TRANSLATION = 7
 const COMMAND_FATAL_ERROR = 8
+const COMMAND_BUNDLE = 9
 
 // const CONTENT_TYPE_TEXT = 0
 const CONTENT_TYPE_EMOTICON = 1
@@ -29,6 +30,8 @@ export default class ChatClientRelay {
     this.totalRetryCount = 0
     this.isDestroying = false
     this.receiveTimeoutTimerId = null
+    // 重连时服务器会补发这条消息之后的消息
+    this.lastMsgId = null
   }
 
   start() {
@@ -75,8 +78,10 @@ export default class ChatClientRelay {
       cmd: COMMAND_JOIN_ROOM,
       data: {
         roomKey: this.roomKey,
+        lastMsgId: this.lastMsgId,
         config: {
-          autoTranslate: this.autoTranslate
+          autoTranslate: this.autoTranslate,
+          enableBundle: true
         }
       }
     }))
@@ -147,6 +152,22 @@ export default class ChatClientRelay {
 
   onWsMessage(event) {
     let { cmd, data } = JSON.parse(event.data)
+    if (cmd === COMMAND_BUNDLE) {
+      // 服务器把一段时间内的多条消息合并成一条发送
+      for (let msg of data) {
+        this.handleMessage(msg.cmd, msg.data)
+      }
+    } else {
+      this.handleMessage(cmd, data)
+    }
+
+    // 至少成功处理1条消息
+    if (cmd !== COMMAND_FATAL_ERROR) {
+      this.retryCount = 0
+    }
+  }
+
+  handleMessage(cmd, data) {
     switch (cmd) {
     case COMMAND_HEARTBEAT: {
       this.refreshReceiveTimeoutTimer()
@@ -184,21 +205,25 @@ export default class ChatClientRelay {
         uid: data[16],
         medalName: data[17],
       })
+      this.lastMsgId = data.id
       this.msgHandler.onAddText(data)
       break
     }
     case COMMAND_ADD_GIFT: {
       data = new chatModels.AddGiftMsg(data)
+      this.lastMsgId = data.id
       this.msgHandler.onAddGift(data)
       break
     }
     case COMMAND_ADD_MEMBER: {
       data = new chatModels.AddMemberMsg(data)
+      this.lastMsgId = data.id
       this.msgHandler.onAddMember(data)
       break
     }
     case COMMAND_ADD_SUPER_CHAT: {
       data = new chatModels.AddSuperChatMsg(data)
+      this.lastMsgId = data.id
       this.msgHandler.onAddSuperChat(data)
       break
     }
@@ -216,16 +241,19 @@ export default class ChatClientRelay {
       break
     }
     case COMMAND_FATAL_ERROR: {
+      if (
+        data.type === chatModels.FATAL_ERROR_TYPE_SLOW_CLIENT
+        || data.type === chatModels.FATAL_ERROR_TYPE_TRY_AGAIN_LATER
+      ) {
+        // 网络太差被服务器断开，或者服务器暂时拒绝连接，重连就好
+        this.addDebugMsg(data.msg)
+        break
+      }
       this.stop()
       let error = new chatModels.ChatClientFatalError(data.type, data.msg)
       this.msgHandler.onFatalError(error)
       break
     }
     }
-
-    // 至少成功处理1条消息
-    if (cmd !== COMMAND_FATAL_ERROR) {
-      this.retryCount = 0
-    }
   }
 }
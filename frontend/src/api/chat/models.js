@@ -159,6 +159,8 @@ export class UpdateTranslationMsg {
 export const FATAL_ERROR_TYPE_AUTH_CODE_ERROR = 1
 export const FATAL_ERROR_TYPE_TOO_MANY_RETRIES = 2
 export const FATAL_ERROR_TYPE_TOO_MANY_CONNECTIONS = 3
+export const FATAL_ERROR_TYPE_SLOW_CLIENT = 4
+export const FATAL_ERROR_TYPE_TRY_AGAIN_LATER = 5
 
 export class ChatClientFatalError extends Error {
   constructor(type, message) {
@@ -6,11 +6,14 @@ import logging
 import logging.handlers
 import os
 import signal
+import socket
 import sys
 import webbrowser
 from typing import *
 
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.web
 
 import api.chat
@@ -21,9 +24,12 @@ import config
 import models.database
 import services.avatar
 import services.chat
+import services.handoff
 import services.open_live
 import services.plugin
+import services.room_info
 import services.translate
+import services.worker
 import update
 import utils.request
 
@@ -38,13 +44,17 @@ ROUTES = [
 ]
 
 server: Optional[tornado.httpserver.HTTPServer] = None
+# 对外的监听socket，平滑重启时交给新进程
+listen_sockets: List[socket.socket] = []
+# 多进程模式下主进程额外监听的本地端口，给插件连接用，因为共用的端口会被分配到任意一个worker
+plugin_port: Optional[int] = None
 
 cmd_args = None
 shut_down_event: Optional[asyncio.Event] = None
 
 
 async def main():
-    if not init():
+    if not await init():
         return 1
     try:
         await run()
@@ -53,13 +63,20 @@ async def main():
     return 0
 
 
-def init():
+async def init():
     init_signal_handlers()
 
     global cmd_args
     cmd_args = parse_args()
-
-    init_logging(cmd_args.debug)
+    is_worker = cmd_args.worker_id != 0
+    if cmd_args.workers > 1 and sys.platform == 'win32':
+        logger.warning('Multi-process mode is not supported on Windows')
+        cmd_args.workers = 1
+    if cmd_args.handoff and (cmd_args.workers > 1 or is_worker):
+        logger.warning('Handoff is not supported in multi-process mode')
+        cmd_args.handoff = False
+
+    init_logging(cmd_args.debug, cmd_args.worker_id)
     logger.info('App started, initializing')
     config.init(cmd_args)
 
@@ -67,15 +84,52 @@ def init():
     models.database.init()
 
     services.avatar.init()
-    services.translate.init()
+    services.room_info.init()
+    if not is_worker:
+        services.translate.init()
     services.open_live.init()
     services.chat.init()
 
-    init_server()
+    inherited_sockets = None
+    if cmd_args.handoff:
+        inherited_sockets = await services.handoff.receive_listen_sockets()
+
+    is_multi_process = cmd_args.workers > 1 or is_worker
+    init_server(
+        reuse_port=is_multi_process,
+        listen_plugin_port=is_multi_process and not is_worker,
+        open_browser=not is_worker and not cmd_args.handoff,
+        inherited_sockets=inherited_sockets,
+    )
     if server is None:
         return False
 
-    services.plugin.init()
+    if is_worker:
+        return await services.worker.init_worker(
+            cmd_args.worker_id, cmd_args.worker_ipc_path, on_shut_down_signal
+        )
+
+    services.plugin.init(plugin_port)
+
+    if cmd_args.workers > 1:
+        worker_args = ['--workers', str(cmd_args.workers)]
+        if cmd_args.host is not None:
+            worker_args += ['--host', cmd_args.host]
+        if cmd_args.port is not None:
+            worker_args += ['--port', str(cmd_args.port)]
+        if cmd_args.debug:
+            worker_args.append('--debug')
+        if not await services.worker.init_master(cmd_args.workers, worker_args):
+            return False
+    else:
+        if inherited_sockets is not None:
+            try:
+                await services.handoff.take_over_rooms()
+            finally:
+                # 旧进程停止接受连接后才开始接受，防止预先连接房间时客户端就连到新进程
+                server.add_sockets(listen_sockets)
+        if config.get_config().enable_handoff:
+            services.handoff.init_source(listen_sockets, server.stop, on_shut_down_signal)
 
     update.check_update()
     return True
@@ -120,11 +174,23 @@ def parse_args():
     parser.add_argument('--host', help='服务器host，默认和配置中的一样', default=None)
     parser.add_argument('--port', help='服务器端口，默认和配置中的一样', type=int, default=None)
     parser.add_argument('--debug', help='调试模式', action='store_true')
+    parser.add_argument('--workers', help='worker进程数，大于1时多个进程共用监听端口，不支持Windows', type=int, default=1)
+    parser.add_argument(
+        '--handoff', help='平滑重启，从正在运行的旧进程继承监听端口和房间，之后旧进程会退出。不支持Windows和多进程模式',
+        action='store_true'
+    )
+    # 以下是主进程启动其他worker时用的
+    parser.add_argument('--worker-id', help=argparse.SUPPRESS, type=int, default=0)
+    parser.add_argument('--worker-ipc-path', help=argparse.SUPPRESS, default=None)
     return parser.parse_args()
 
 
-def init_logging(debug):
-    filename = os.path.join(config.BASE_PATH, 'log', 'blivechat.log')
+def init_logging(debug, worker_id=0):
+    if worker_id == 0:
+        filename = os.path.join(config.BASE_PATH, 'log', 'blivechat.log')
+    else:
+        # 多个进程同时写一个文件，切割日志时会冲突
+        filename = os.path.join(config.BASE_PATH, 'log', f'blivechat.worker{worker_id}.log')
     stream_handler = logging.StreamHandler()
     file_handler = logging.handlers.TimedRotatingFileHandler(
         filename, encoding='utf-8', when='midnight', backupCount=7, delay=True
@@ -140,28 +206,41 @@ def init_logging(debug):
     logging.getLogger('tornado.access').setLevel(logging.WARNING)
 
 
-def init_server():
+def init_server(
+    reuse_port=False, listen_plugin_port=False, open_browser=True,
+    inherited_sockets: Optional[List[socket.socket]] = None
+):
     cfg = config.get_config()
+    # 不用tornado的websocket_ping_interval，它给每个连接一个定时器。连接存活由各handler的心跳和接收超时检测
     app = tornado.web.Application(
         ROUTES,
-        websocket_ping_interval=10,
         debug=cfg.debug,
         autoreload=False
     )
     try:
-        global server
-        server = app.listen(
-            cfg.port,
-            cfg.host,
+        global server, plugin_port, listen_sockets
+        server = tornado.httpserver.HTTPServer(
+            app,
             xheaders=cfg.tornado_xheaders,
             max_body_size=1024 * 1024,
             max_buffer_size=1024 * 1024
         )
+        if inherited_sockets is not None:
+            # 交接完成后才开始接受连接，见init()
+            listen_sockets = inherited_sockets
+        else:
+            listen_sockets = tornado.netutil.bind_sockets(cfg.port, cfg.host, reuse_port=reuse_port)
+            server.add_sockets(listen_sockets)
+        if listen_plugin_port:
+            plugin_sockets = tornado.netutil.bind_sockets(0, 'localhost')
+            plugin_port = plugin_sockets[0].getsockname()[1]
+            server.add_sockets(plugin_sockets)
     except OSError:
         logger.warning('Address is used %s:%d', cfg.host, cfg.port)
+        server = None
         return
     finally:
-        if cfg.open_browser_at_startup:
+        if cfg.open_browser_at_startup and open_browser:
             url = 'http://localhost/' if cfg.port == 80 else f'http://localhost:{cfg.port}/'
             webbrowser.open(url)
     logger.info('Server started: %s:%d', cfg.host, cfg.port)
@@ -174,7 +253,9 @@ async def run():
 
 
 async def shut_down():
+    services.handoff.shut_down()
     services.plugin.shut_down()
+    await services.worker.shut_down()
 
     logger.info('Closing server')
     server.stop()
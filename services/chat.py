@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import collections
 import enum
+import heapq
+import itertools
 import logging
+import math
 import random
-import uuid
+import time
 from typing import *
 
+import aiohttp
+import cachetools
+
 import api.chat
 import api.open_live as api_open_live
 import blcsdk.models as sdk_models
@@ -15,8 +22,14 @@ import blivedm.blivedm.models.web as dm_web_models
 import config
 import services.avatar
 import services.plugin
+import services.room_info
 import services.translate
+import services.worker
+import utils.aho_corasick
 import utils.async_io
+import utils.consistent_hash
+import utils.id_gen
+import utils.rate_limit
 import utils.request
 
 logger = logging.getLogger(__name__)
@@ -57,7 +70,7 @@ class RoomKey(NamedTuple):
 
 
 # 用于类型标注的类型别名
-LiveClientType = Union['WebLiveClient', 'OpenLiveClient']
+LiveClientType = Union['WebLiveClient', 'OpenLiveClient', 'RelayLiveClient']
 
 # 到B站的连接管理
 _live_client_manager: Optional['LiveClientManager'] = None
@@ -65,6 +78,8 @@ _live_client_manager: Optional['LiveClientManager'] = None
 client_room_manager: Optional['ClientRoomManager'] = None
 # 直播消息处理器
 _live_msg_handler: Optional['LiveMsgHandler'] = None
+# 集群模式下房间到节点的映射
+_cluster_ring: Optional[utils.consistent_hash.ConsistentHashRing] = None
 
 
 def init():
@@ -85,6 +100,38 @@ def iter_live_clients() -> Iterable[LiveClientType]:
     return _live_client_manager.iter_live_clients()
 
 
+def get_live_client_stats():
+    return _live_client_manager.get_stats()
+
+
+def is_live_client_ready(room_key: RoomKey):
+    """到B站的连接是否已经初始化，没有连接时也返回True"""
+    live_client = _live_client_manager.get_live_client(room_key)
+    if live_client is None or isinstance(live_client, RelayLiveClient):
+        return True
+    return live_client.room_id is not None
+
+
+def export_handoff_rooms():
+    """平滑重启时交给新进程的房间列表"""
+    res = []
+    for room in client_room_manager.iter_rooms():
+        live_client = _live_client_manager.get_live_client(room.room_key)
+        if isinstance(live_client, OpenLiveClient):
+            open_live_game_data = live_client.game_data
+        else:
+            open_live_game_data = None
+        res.append([[int(room.room_key.type), room.room_key.value], room.client_count, open_live_game_data])
+    return res
+
+
+def detach_open_live_games():
+    """平滑重启时开放平台的项目已经交给新进程了，关闭连接时不结束项目"""
+    for live_client in _live_client_manager.iter_live_clients():
+        if isinstance(live_client, OpenLiveClient):
+            live_client.detach_game()
+
+
 def make_plugin_msg_extra_from_live_client(live_client: LiveClientType):
     return {
         'roomId': live_client.room_id,  # init_room之前是None
@@ -105,17 +152,49 @@ def make_plugin_msg_extra_from_client_room(room: 'ClientRoom'):
     }
 
 
+def get_room_owner_node(room_key: RoomKey) -> Optional[str]:
+    """集群模式下返回负责连接这个房间的其他节点，本节点负责或者没开启集群模式时返回None"""
+    cfg = config.get_config()
+    if not cfg.is_cluster_enabled:
+        return None
+
+    global _cluster_ring
+    if _cluster_ring is None or _cluster_ring.nodes != frozenset(cfg.cluster_nodes):
+        _cluster_ring = utils.consistent_hash.ConsistentHashRing(cfg.cluster_nodes)
+    node = _cluster_ring.get_node(f'{int(room_key.type)}:{room_key.value}')
+    if node == cfg.cluster_self_node:
+        return None
+    return node
+
+
 class LiveClientManager:
     """管理到B站的连接"""
     def __init__(self):
         self._live_clients: Dict[RoomKey, LiveClientType] = {}
         self._close_client_futures: Set[asyncio.Future] = set()
+        self.reconnect_scheduler = ReconnectScheduler()
+
+        # 预热池，房间没有客户端后暂时保留的连接，按放入的顺序排列。value: (连接, 过期时间)
+        self._warm_live_clients: Dict[RoomKey, Tuple[LiveClientType, float]] = collections.OrderedDict()
+        self._warm_pool_timer_handle: Optional[asyncio.TimerHandle] = None
+        # 从预热池复用的次数
+        self._warm_pool_hit_count = 0
+        # 因为超时或者超过数量关闭的次数
+        self._warm_pool_evicted_count = 0
 
     async def shut_down(self):
         while len(self._live_clients) != 0:
             room_key = next(iter(self._live_clients))
             self.del_live_client(room_key)
 
+        if self._warm_pool_timer_handle is not None:
+            self._warm_pool_timer_handle.cancel()
+            self._warm_pool_timer_handle = None
+        while len(self._warm_live_clients) != 0:
+            _room_key, (live_client, _expire_time) = self._warm_live_clients.popitem(last=False)
+            self._stop_live_client(live_client)
+
+        self.reconnect_scheduler.shut_down()
         await asyncio.gather(*self._close_client_futures, return_exceptions=True)
 
     def get_live_client(self, room_key: RoomKey):
@@ -124,13 +203,39 @@ class LiveClientManager:
     def iter_live_clients(self):
         return self._live_clients.values()
 
-    def add_live_client(self, room_key: RoomKey):
+    def add_live_client(self, room_key: RoomKey, allow_relay=True, open_live_game_data: Optional[dict] = None):
+        """
+        创建到B站的连接
+
+        :param room_key: 房间
+        :param allow_relay: 集群模式下房间不归本节点负责时，是否从负责的节点转发消息。如果请求本身就是其他节点转发来的，
+                            不能再转发，防止各节点配置不一致时互相转发
+        :param open_live_game_data: 平滑重启时旧进程开启的开放平台项目，不为None时直接用，不用再开启项目
+        """
         if room_key in self._live_clients:
             return
 
+        live_client = self._take_warm_live_client(room_key)
+        if live_client is not None:
+            self._live_clients[room_key] = live_client
+            live_client.set_handler(_live_msg_handler)
+            logger.info('room=%s reused warm live client, %d live clients', room_key, len(self._live_clients))
+
+            services.plugin.broadcast_cmd_data(
+                sdk_models.Command.ADD_ROOM, {}, make_plugin_msg_extra_from_live_client(live_client)
+            )
+            # 已经初始化过了，不会再调用init_room，这里合并同一个房间的其他RoomKey
+            client_room_manager.on_live_client_init(live_client)
+            return
+
         logger.info('room=%s creating live client', room_key)
 
-        self._live_clients[room_key] = live_client = self._create_live_client(room_key)
+        owner_node = get_room_owner_node(room_key) if allow_relay else None
+        if owner_node is not None:
+            live_client = RelayLiveClient(room_key, owner_node)
+        else:
+            live_client = self._create_live_client(room_key, open_live_game_data)
+        self._live_clients[room_key] = live_client
         live_client.set_handler(_live_msg_handler)
         # 直接启动吧，这里不用管init_room失败的情况，万一失败了会在on_client_stopped里删除掉这个客户端
         live_client.start()
@@ -142,48 +247,344 @@ class LiveClientManager:
         )
 
     @staticmethod
-    def _create_live_client(room_key: RoomKey):
+    def _create_live_client(room_key: RoomKey, open_live_game_data: Optional[dict] = None):
         if room_key.type == RoomKeyType.ROOM_ID:
             return WebLiveClient(room_key)
         elif room_key.type == RoomKeyType.AUTH_CODE:
-            return OpenLiveClient(room_key)
+            return OpenLiveClient(room_key, open_live_game_data)
         raise ValueError(f'Unknown RoomKeyType={room_key.type}')
 
     def del_live_client(self, room_key: RoomKey):
+        if not self.close_live_client(room_key):
+            return
+        client_room_manager.del_room(room_key)
+
+    def close_live_client(self, room_key: RoomKey):
+        """只关闭到B站的连接，不删除房间，返回是否有这个连接"""
         live_client = self._live_clients.pop(room_key, None)
         if live_client is None:
-            return
+            return False
 
         logger.info('room=%s removing live client', room_key)
 
+        self._stop_live_client(live_client)
+
+        logger.info('room=%s live client removed, %d live clients', room_key, len(self._live_clients))
+
+        services.plugin.broadcast_cmd_data(
+            sdk_models.Command.DEL_ROOM, {}, make_plugin_msg_extra_from_live_client(live_client)
+        )
+        return True
+
+    def _stop_live_client(self, live_client: LiveClientType):
         live_client.set_handler(None)
         future = asyncio.create_task(live_client.stop_and_close())
         self._close_client_futures.add(future)
         future.add_done_callback(lambda _future: self._close_client_futures.discard(future))
 
-        logger.info('room=%s live client removed, %d live clients', room_key, len(self._live_clients))
+    def release_live_client(self, room_key: RoomKey):
+        """
+        房间没有客户端了，把到B站的连接放到预热池，一段时间内重新加入房间时直接复用。不能复用的连接直接关闭
 
-        client_room_manager.del_room(room_key)
+        转发的连接重新创建的开销很小，不放到预热池
+        """
+        cfg = config.get_config()
+        live_client = self._live_clients.get(room_key, None)
+        if (
+            live_client is None
+            or cfg.warm_live_client_pool_size <= 0
+            or isinstance(live_client, RelayLiveClient)
+            or not live_client.is_running
+        ):
+            self.close_live_client(room_key)
+            return
+
+        del self._live_clients[room_key]
+        # 在池中时不处理消息
+        live_client.set_handler(None)
+        if isinstance(live_client, WebLiveClient):
+            live_client.message_sequencer.clear()
+        expire_time = asyncio.get_running_loop().time() + cfg.warm_live_client_ttl
+        self._warm_live_clients[room_key] = (live_client, expire_time)
+        logger.info('room=%s live client moved to warm pool, %d warm live clients', room_key,
+                    len(self._warm_live_clients))
 
         services.plugin.broadcast_cmd_data(
             sdk_models.Command.DEL_ROOM, {}, make_plugin_msg_extra_from_live_client(live_client)
         )
 
+        while len(self._warm_live_clients) > cfg.warm_live_client_pool_size:
+            self._evict_warm_live_client()
+        self._schedule_warm_pool_cleanup()
+
+    def _take_warm_live_client(self, room_key: RoomKey) -> Optional[LiveClientType]:
+        item = self._warm_live_clients.pop(room_key, None)
+        if item is None:
+            return None
+        live_client, _expire_time = item
+        # 在池中时可能因为重试次数太多停止了
+        if not live_client.is_running:
+            self._stop_live_client(live_client)
+            return None
+        self._warm_pool_hit_count += 1
+        return live_client
+
+    def _evict_warm_live_client(self):
+        room_key, (live_client, _expire_time) = self._warm_live_clients.popitem(last=False)
+        logger.info('room=%s evicting warm live client', room_key)
+        self._warm_pool_evicted_count += 1
+        self._stop_live_client(live_client)
+
+    def _schedule_warm_pool_cleanup(self):
+        """只用一个定时器，在最早放入的连接过期时触发"""
+        if len(self._warm_live_clients) == 0:
+            return
+        _live_client, expire_time = next(iter(self._warm_live_clients.values()))
+        if self._warm_pool_timer_handle is not None:
+            # 修改了配置的保留时间时，后放入的连接可能更早过期
+            if self._warm_pool_timer_handle.when() <= expire_time:
+                return
+            self._warm_pool_timer_handle.cancel()
+        self._warm_pool_timer_handle = asyncio.get_running_loop().call_at(
+            expire_time, self._on_warm_pool_cleanup
+        )
+
+    def _on_warm_pool_cleanup(self):
+        self._warm_pool_timer_handle = None
+        now = asyncio.get_running_loop().time()
+        while len(self._warm_live_clients) != 0:
+            _live_client, expire_time = next(iter(self._warm_live_clients.values()))
+            if expire_time > now:
+                break
+            self._evict_warm_live_client()
+        self._schedule_warm_pool_cleanup()
+
+    def has_warm_live_client(self, room_key: RoomKey):
+        return room_key in self._warm_live_clients
+
+    def get_stats(self):
+        return {
+            'liveClientCount': len(self._live_clients),
+            'warmLiveClientCount': len(self._warm_live_clients),
+            'warmPoolHitCount': self._warm_pool_hit_count,
+            'warmPoolEvictedCount': self._warm_pool_evicted_count,
+            **self.reconnect_scheduler.get_stats(),
+        }
+
 
 class TooManyRetries(Exception):
     """重试次数太多"""
 
 
-def _get_reconnect_interval(_retry_count: int, total_retry_count: int):
-    # 防止无限重连的保险措施。30次重连大概会断线500秒，应该够了
-    if total_retry_count > 30:
-        raise TooManyRetries(f'total_retry_count={total_retry_count}')
+class _ReconnectPolicy:
+    """
+    重连间隔，用decorrelated jitter：在[BASE_INTERVAL, 上次间隔 * 3]中随机。各房间的重连时间会分散开，
+    不会像固定退避加小随机延迟那样，同时断线的房间一直同时重连
+    """
+    BASE_INTERVAL = 1.0
+    MAX_INTERVAL = 20.0
+
+    def __init__(self):
+        self._last_interval = self.BASE_INTERVAL
+
+    def __call__(self, _retry_count: int, total_retry_count: int):
+        # 防止无限重连的保险措施。30次重连平均大概会断线350秒，应该够了
+        if total_retry_count > 30:
+            raise TooManyRetries(f'total_retry_count={total_retry_count}')
+
+        # 不用retry_count了，防止意外的连接成功，导致retry_count重置
+        interval = min(random.uniform(self.BASE_INTERVAL, self._last_interval * 3), self.MAX_INTERVAL)
+        self._last_interval = interval
+        return interval
+
+
+class ReconnectScheduler:
+    """
+    进程内所有到B站的连接共用的重连预算。B站断开大量连接时，防止所有房间同时请求房间信息和连接弹幕服务器
+
+    重连前要拿到令牌，令牌不够时排队，客户端多的房间先重连
+    """
+    def __init__(self):
+        # 配置变化时重新创建
+        self._token_bucket: Optional[utils.rate_limit.TokenBucket] = None
+        self._token_bucket_rate = 0.0
+        # 等待重连的堆，元素是(-优先级, 序号, future)
+        self._queue: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq_gen = itertools.count()
+        self._timer_handle: Optional[asyncio.TimerHandle] = None
+
+        # 拿到令牌的次数
+        self._granted_count = 0
+        # 需要排队的次数
+        self._queued_count = 0
+        # 排队的总时间、最长时间
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def shut_down(self):
+        if self._timer_handle is not None:
+            self._timer_handle.cancel()
+            self._timer_handle = None
+        for _priority, _seq, future in self._queue:
+            future.cancel()
+        self._queue.clear()
+
+    async def acquire(self, priority: int):
+        """等到可以重连，priority越大越先重连"""
+        if self._try_acquire():
+            self._granted_count += 1
+            return
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._queue, (-priority, next(self._seq_gen), future))
+        self._queued_count += 1
+        self._schedule_grant()
+
+        start_time = loop.time()
+        # 连接关闭时会取消，取消的future在出队时丢弃
+        await future
+        wait_time = loop.time() - start_time
+        self._total_wait_time += wait_time
+        self._max_wait_time = max(self._max_wait_time, wait_time)
+
+    def _try_acquire(self):
+        # 有人排队时不能插队
+        if self._has_waiter():
+            return False
+        return self._try_decrease_token()
+
+    def _try_decrease_token(self):
+        cfg = config.get_config()
+        if cfg.max_reconnects_per_second <= 0:
+            return True
+        if self._token_bucket is None or self._token_bucket_rate != cfg.max_reconnects_per_second:
+            self._token_bucket = utils.rate_limit.TokenBucket(
+                cfg.max_reconnects_per_second, max(cfg.max_reconnects_per_second, 1)
+            )
+            self._token_bucket_rate = cfg.max_reconnects_per_second
+        return self._token_bucket.try_decrease_token()
+
+    def _has_waiter(self):
+        while len(self._queue) != 0 and self._queue[0][2].done():
+            heapq.heappop(self._queue)
+        return len(self._queue) != 0
+
+    def _schedule_grant(self):
+        if self._timer_handle is not None or not self._has_waiter():
+            return
+        rate = config.get_config().max_reconnects_per_second
+        interval = 1 / rate if rate > 0 else 0
+        self._timer_handle = asyncio.get_running_loop().call_later(interval, self._on_grant)
+
+    def _on_grant(self):
+        self._timer_handle = None
+        while self._has_waiter():
+            if not self._try_decrease_token():
+                break
+            _priority, _seq, future = heapq.heappop(self._queue)
+            future.set_result(None)
+            self._granted_count += 1
+        self._schedule_grant()
+
+    def get_stats(self):
+        return {
+            'reconnectQueueLength': sum(1 for _priority, _seq, future in self._queue if not future.done()),
+            'reconnectGrantedCount': self._granted_count,
+            'reconnectQueuedCount': self._queued_count,
+            'reconnectTotalWaitTime': self._total_wait_time,
+            'reconnectMaxWaitTime': self._max_wait_time,
+        }
+
+
+async def _wait_reconnect_turn(room_key: RoomKey, retry_count: int):
+    """到B站的连接重连前调用，第一次连接不用等"""
+    if retry_count == 0:
+        return
+    room = client_room_manager.get_room(room_key)
+    # 预热池中的连接没有房间，最后重连
+    priority = 0 if room is None else room.client_count + room.remote_worker_count
+    await _live_client_manager.reconnect_scheduler.acquire(priority)
 
-    # 不用retry_count了，防止意外的连接成功，导致retry_count重置
-    interval = min(1 + (total_retry_count - 1) * 2, 20)
-    # 加上随机延迟，防止同时请求导致雪崩
-    interval += random.uniform(0, 3)
-    return interval
+
+# 所有MessageSequencer的统计，进程内累计
+_sequencer_stats: Dict[str, int] = collections.Counter()
+
+
+def get_sequencer_stats():
+    return {
+        # 因为前面的消息在等待获取头像而推迟发送的消息数，没有排序的话这些消息会乱序
+        'reorderedMsgCount': _sequencer_stats['reordered'],
+        # 超时没有获取到头像，用默认头像发送的消息数
+        'enrichDeadlineMissCount': _sequencer_stats['deadline_miss'],
+    }
+
+
+class _SequencerSlot:
+    __slots__ = ('callback', 'args', 'is_ready', 'timer_handle')
+
+    def __init__(self, callback: Callable, args: tuple, is_ready: bool):
+        self.callback = callback
+        self.args = args
+        self.is_ready = is_ready
+        self.timer_handle: Optional[asyncio.TimerHandle] = None
+
+
+class MessageSequencer:
+    """
+    按收到的顺序发送一个房间的消息
+
+    有的消息需要异步获取头像，先用reserve占位，后面的消息等它完成了再发。最多等fetch_avatar_timeout秒，超时就用占位时
+    给的参数发送（默认头像），之后获取到的结果丢弃
+    """
+    def __init__(self):
+        self._slots: Deque[_SequencerSlot] = collections.deque()
+
+    def send(self, callback: Callable, *args):
+        """前面没有等待的消息时直接调用callback(*args)，否则排队"""
+        if not self._slots:
+            callback(*args)
+            return
+        self._slots.append(_SequencerSlot(callback, args, True))
+        _sequencer_stats['reordered'] += 1
+
+    def reserve(self, timeout_callback: Callable, *args) -> _SequencerSlot:
+        """为异步处理的消息占位，超时后调用timeout_callback(*args)"""
+        slot = _SequencerSlot(timeout_callback, args, False)
+        slot.timer_handle = asyncio.get_running_loop().call_later(
+            config.get_config().fetch_avatar_timeout, self._on_slot_timeout, slot
+        )
+        self._slots.append(slot)
+        return slot
+
+    def resolve(self, slot: _SequencerSlot, callback: Callable, *args):
+        """异步处理完成，已经超时的话什么都不做"""
+        if slot.is_ready:
+            return
+        slot.timer_handle.cancel()
+        slot.callback = callback
+        slot.args = args
+        slot.is_ready = True
+        self._flush()
+
+    def clear(self):
+        for slot in self._slots:
+            if slot.timer_handle is not None:
+                slot.timer_handle.cancel()
+        self._slots.clear()
+
+    def _on_slot_timeout(self, slot: _SequencerSlot):
+        slot.is_ready = True
+        _sequencer_stats['deadline_miss'] += 1
+        self._flush()
+
+    def _flush(self):
+        while self._slots and self._slots[0].is_ready:
+            slot = self._slots.popleft()
+            try:
+                slot.callback(*slot.args)
+            except Exception:  # noqa
+                logger.exception('Send message error, callback=%r', slot.callback)
 
 
 class WebLiveClient(blivedm.BLiveClient):
@@ -196,12 +597,25 @@ class WebLiveClient(blivedm.BLiveClient):
             session=utils.request.http_session,
             heartbeat_interval=self.HEARTBEAT_INTERVAL,
         )
-        self.set_reconnect_policy(_get_reconnect_interval)
+        self.set_reconnect_policy(_ReconnectPolicy())
+        self._message_sequencer = MessageSequencer()
 
     @property
     def room_key(self):
         return RoomKey(RoomKeyType.ROOM_ID, self.tmp_room_id)
 
+    @property
+    def message_sequencer(self) -> MessageSequencer:
+        return self._message_sequencer
+
+    async def stop_and_close(self):
+        self._message_sequencer.clear()
+        await super().stop_and_close()
+
+    async def _on_before_ws_connect(self, retry_count):
+        await _wait_reconnect_turn(self.room_key, retry_count)
+        await super()._on_before_ws_connect(retry_count)
+
     async def init_room(self):
         res = await super().init_room()
         if res:
@@ -214,15 +628,24 @@ class WebLiveClient(blivedm.BLiveClient):
             {'isSuccess': True},  # 降级也算成功
             make_plugin_msg_extra_from_live_client(self),
         )
+        client_room_manager.on_live_client_init(self)
 
         # 允许降级
         return True
 
+    async def _init_room_id_and_owner(self):
+        # 和获取房间信息的接口共用缓存，很多房间同时重连时也不用每个都请求
+        room_info = await services.room_info.get_room_info(self.tmp_room_id)
+        if room_info is None:
+            return False
+        self._room_id, self._room_owner_uid = room_info
+        return True
+
 
 class OpenLiveClient(blivedm.OpenLiveClient):
     HEARTBEAT_INTERVAL = 10
 
-    def __init__(self, room_key: RoomKey):
+    def __init__(self, room_key: RoomKey, game_data: Optional[dict] = None):
         assert room_key.type == RoomKeyType.AUTH_CODE
         cfg = config.get_config()
         super().__init__(
@@ -233,12 +656,29 @@ class OpenLiveClient(blivedm.OpenLiveClient):
             session=utils.request.http_session,
             heartbeat_interval=self.HEARTBEAT_INTERVAL,
         )
-        self.set_reconnect_policy(_get_reconnect_interval)
+        self.set_reconnect_policy(_ReconnectPolicy())
+        # 开启项目返回的数据，平滑重启时交给新进程
+        self._game_data: Optional[dict] = game_data
+        # 平滑重启时从旧进程继承的项目，第一次开启项目时直接用
+        self._inherited_game_data: Optional[dict] = game_data
+        # 项目已经交给新进程了，关闭时不结束项目
+        self._is_game_detached = False
 
     @property
     def room_key(self):
         return RoomKey(RoomKeyType.AUTH_CODE, self.room_owner_auth_code)
 
+    @property
+    def game_data(self) -> Optional[dict]:
+        return self._game_data
+
+    def detach_game(self):
+        self._is_game_detached = True
+
+    async def _on_before_ws_connect(self, retry_count):
+        await _wait_reconnect_turn(self.room_key, retry_count)
+        await super()._on_before_ws_connect(retry_count)
+
     async def init_room(self):
         res = await super().init_room()
         if res:
@@ -251,10 +691,18 @@ class OpenLiveClient(blivedm.OpenLiveClient):
             {'isSuccess': res},
             make_plugin_msg_extra_from_live_client(self),
         )
+        if res:
+            client_room_manager.on_live_client_init(self)
 
         return res
 
     async def _start_game(self):
+        if self._inherited_game_data is not None:
+            data, self._inherited_game_data = self._inherited_game_data, None
+            if self._parse_start_game(data):
+                logger.info('room=%s using the game inherited from the old process', self.room_key)
+                return True
+
         try:
             data = await api_open_live.request_open_live_or_common_server(
                 api_open_live.START_GAME_OPEN_LIVE_URL,
@@ -293,11 +741,12 @@ class OpenLiveClient(blivedm.OpenLiveClient):
 
         res = self._parse_start_game(data['data'])
         if res:
+            self._game_data = data['data']
             api_open_live.auth_code_room_id_cache[self._room_owner_auth_code] = self.room_id
         return res
 
     async def _end_game(self):
-        if self._game_id in (None, ''):
+        if self._game_id in (None, '') or self._is_game_detached:
             return True
 
         try:
@@ -348,15 +797,191 @@ class OpenLiveClient(blivedm.OpenLiveClient):
         return True
 
 
+class RelayLiveClient:
+    """
+    集群模式下房间归其他节点负责时，代替到B站的连接，作为客户端连接负责的节点并转发它的消息
+
+    接口和blivedm的客户端一样，所以可以放在LiveClientManager里统一管理
+    """
+    # 负责的节点每10秒发一次ping
+    RECEIVE_TIMEOUT = 15
+
+    def __init__(self, room_key: RoomKey, owner_node: str):
+        self._room_key = room_key
+        self._owner_node = owner_node
+        self._handler: Optional[blivedm.BaseHandler] = None
+        self._need_translate = False
+
+        self._run_future: Optional[asyncio.Future] = None
+        self._websocket: Optional[aiohttp.ClientWebSocketResponse] = None
+        # 主要是为了主动重新加入房间时不算作重连失败
+        self._need_rejoin = False
+        # 负责的节点发来了致命错误，不再重连
+        self._is_fatal_error = False
+        self._total_retry_count = 0
+        self._reconnect_policy = _ReconnectPolicy()
+        # 重连时让负责的节点补发这之后的消息
+        self._last_msg_id: Optional[str] = None
+
+    @property
+    def room_key(self):
+        return self._room_key
+
+    @property
+    def room_id(self):
+        # 真实房间ID只有负责的节点知道
+        return None
+
+    @property
+    def owner_node(self):
+        return self._owner_node
+
+    def set_handler(self, handler: Optional[blivedm.BaseHandler]):
+        self._handler = handler
+
+    def set_need_translate(self, need_translate):
+        if self._need_translate == need_translate:
+            return
+        self._need_translate = need_translate
+        # 重新加入房间才能通知负责的节点，断开期间的消息会补发
+        if self._websocket is not None and not self._websocket.closed:
+            self._need_rejoin = True
+            utils.async_io.create_task_with_ref(self._websocket.close())
+
+    def start(self):
+        if self._run_future is not None:
+            return
+        self._run_future = asyncio.create_task(self._run())
+
+    async def stop_and_close(self):
+        if self._run_future is None:
+            return
+        self._run_future.cancel()
+        await asyncio.gather(self._run_future, return_exceptions=True)
+        self._run_future = None
+
+    async def _run(self):
+        exception = None
+        try:
+            while True:
+                try:
+                    await self._connect_and_receive()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logger.warning('room=%s relay connection to %s failed: %r', self._room_key, self._owner_node, e)
+                if self._is_fatal_error:
+                    break
+                if self._need_rejoin:
+                    self._need_rejoin = False
+                    continue
+
+                self._total_retry_count += 1
+                await asyncio.sleep(self._reconnect_policy(0, self._total_retry_count))
+        except TooManyRetries as e:
+            exception = e
+
+        if self._handler is not None:
+            self._handler.on_client_stopped(self, exception)
+
+    async def _connect_and_receive(self):
+        url = f'ws://{self._owner_node}/api/chat'
+        async with utils.request.http_session.ws_connect(url, receive_timeout=self.RECEIVE_TIMEOUT) as websocket:
+            self._websocket = websocket
+            try:
+                await self._send_join_room(websocket)
+                logger.info('room=%s relay connected to %s', self._room_key, self._owner_node)
+
+                async for ws_msg in websocket:
+                    if ws_msg.type == aiohttp.WSMsgType.BINARY:
+                        try:
+                            self._on_message(api.chat.OutgoingMessage.from_msgpack_body(ws_msg.data))
+                        except Exception:  # noqa
+                            logger.exception('room=%s relay on_message error, body=%s', self._room_key, ws_msg.data)
+                        if self._is_fatal_error:
+                            break
+                    elif ws_msg.type == aiohttp.WSMsgType.ERROR:
+                        logger.warning('room=%s relay websocket error: %r', self._room_key, websocket.exception())
+                        break
+            finally:
+                self._websocket = None
+
+    async def _send_join_room(self, websocket: aiohttp.ClientWebSocketResponse):
+        data = {
+            'roomKey': self._room_key.to_dict(),
+            'config': {
+                'encoding': api.chat.Encoding.MSGPACK.value,
+                'autoTranslate': self._need_translate,
+                'isRelay': True,
+                'relaySecret': config.get_config().cluster_secret,
+                # aiohttp会自动回复pong，不用收发HEARTBEAT消息
+                'heartbeatMode': api.chat.HeartbeatMode.PING.value,
+            },
+        }
+        if self._last_msg_id is not None:
+            data['lastMsgId'] = self._last_msg_id
+        await websocket.send_json({'cmd': api.chat.Command.JOIN_ROOM, 'data': data})
+
+    def _on_message(self, message: 'api.chat.OutgoingMessage'):
+        if message.cmd == api.chat.Command.HEARTBEAT:
+            return
+        if message.cmd == api.chat.Command.FATAL_ERROR:
+            if message.data['type'] == api.chat.FatalErrorType.SLOW_CLIENT:
+                # 是本节点太慢了，重连后会补发
+                logger.warning('room=%s relay is too slow for %s', self._room_key, self._owner_node)
+                return
+            if message.data['type'] == api.chat.FatalErrorType.TRY_AGAIN_LATER:
+                # 负责的节点暂时拒绝连接，之后会重连
+                logger.warning('room=%s relay is rejected by %s: %s', self._room_key, self._owner_node,
+                               message.data['msg'])
+                return
+            self._is_fatal_error = True
+
+        msg_id = message.msg_id
+        if msg_id is not None:
+            self._last_msg_id = msg_id
+
+        room = client_room_manager.get_room(self._room_key)
+        if room is None:
+            return
+        if message.cmd == api.chat.Command.UPDATE_TRANSLATION:
+            room.send_auto_translate_message_no_raise(message)
+        else:
+            room.send_message_no_raise(message)
+
+
+class AdmissionRejected(Exception):
+    """超过连接数限制，拒绝客户端加入房间"""
+    def __init__(self, reason: str, msg: str, is_temporary=False):
+        super().__init__(msg)
+        # 拒绝的原因，用于统计
+        self.reason = reason
+        # 是否只是暂时拒绝，客户端过一会儿重连可能就成功了
+        self.is_temporary = is_temporary
+
+
 class ClientRoomManager:
     """管理到客户端的连接"""
     # 房间没有客户端后延迟多久删除房间，不立即删除防止短时间后重连
     DELAY_DEL_ROOM_TIMEOUT = 10
 
     def __init__(self):
+        # 房间的主RoomKey -> 房间
         self._rooms: Dict[RoomKey, ClientRoom] = {}
+        # 同一个房间的其他RoomKey（短号、长号、身份码） -> 房间的主RoomKey，这些RoomKey共用一个到B站的连接
+        self._alias_to_room_key: Dict[RoomKey, RoomKey] = {}
+        # 房间短号的RoomKey -> 长号的RoomKey，长号的房间已经存在时，用短号加入不用再创建连接
+        self._room_id_alias_cache: Dict[RoomKey, RoomKey] = cachetools.LRUCache(1024)
         self._delay_del_timer_handles: Dict[RoomKey, asyncio.TimerHandle] = {}
 
+        # 所有房间的客户端数
+        self._client_count = 0
+        # IP -> 客户端数
+        self._ip_to_client_count: Dict[str, int] = collections.Counter()
+        # 限制每分钟创建的房间数，配置变化时重新创建
+        self._new_room_token_bucket: Optional[utils.rate_limit.TokenBucket] = None
+        self._new_room_token_bucket_rate = 0
+        # 拒绝原因 -> 拒绝次数
+        self._rejected_counts: Dict[str, int] = collections.Counter()
+
     def shut_down(self):
         while len(self._rooms) != 0:
             room_key = next(iter(self._rooms))
@@ -367,49 +992,277 @@ class ClientRoomManager:
         self._delay_del_timer_handles.clear()
 
     def add_client(self, room_key: RoomKey, client: 'api.chat.ChatHandler'):
-        room = self._get_or_add_room(room_key)
+        """超过连接数限制时抛出AdmissionRejected"""
+        try:
+            self._check_admission(room_key, client)
+            room = self._get_or_add_room(room_key, allow_relay=not client.is_relay, limit_new_room_rate=True)
+        except AdmissionRejected as e:
+            self._rejected_counts[e.reason] += 1
+            raise
         room.add_client(client)
+        self._on_client_added(client)
+        self._sync_need_translate(room)
 
         self._clear_delay_del_timer(room_key)
+        self._clear_delay_del_timer(room.room_key)
+
+    def _check_admission(self, room_key: RoomKey, client: 'api.chat.ChatHandler'):
+        """只是比较计数，拒绝的开销很小"""
+        cfg = config.get_config()
+        if 0 < cfg.max_total_clients <= self._client_count:
+            raise AdmissionRejected('total', 'Too many connections on this server')
+
+        room = self.get_room(room_key)
+        if room is not None and 0 < cfg.max_clients_per_room <= room.client_count:
+            raise AdmissionRejected('room', 'Too many connections in this room')
+
+        # 转发用的连接来自其他节点，不按IP限制
+        if (
+            not client.is_relay
+            and 0 < cfg.max_clients_per_ip <= self._ip_to_client_count.get(client.request.remote_ip, 0)
+        ):
+            raise AdmissionRejected('ip', 'Too many connections from this IP')
+
+    def _check_new_room_rate(self):
+        cfg = config.get_config()
+        if cfg.max_new_rooms_per_minute <= 0:
+            return
+        if (
+            self._new_room_token_bucket is None
+            or self._new_room_token_bucket_rate != cfg.max_new_rooms_per_minute
+        ):
+            self._new_room_token_bucket = utils.rate_limit.TokenBucket(
+                cfg.max_new_rooms_per_minute / 60, cfg.max_new_rooms_per_minute
+            )
+            self._new_room_token_bucket_rate = cfg.max_new_rooms_per_minute
+        if not self._new_room_token_bucket.try_decrease_token():
+            raise AdmissionRejected(
+                'new_room', 'Too many new rooms on this server, please try again later', is_temporary=True
+            )
+
+    def _on_client_added(self, client: 'api.chat.ChatHandler'):
+        self._client_count += 1
+        self._ip_to_client_count[client.request.remote_ip] += 1
+
+    def _on_client_removed(self, client: 'api.chat.ChatHandler'):
+        self._client_count -= 1
+        ip = client.request.remote_ip
+        self._ip_to_client_count[ip] -= 1
+        if self._ip_to_client_count[ip] <= 0:
+            del self._ip_to_client_count[ip]
 
     def del_client(self, room_key: RoomKey, client: 'api.chat.ChatHandler'):
         room = self.get_room(room_key)
         if room is None:
             return
 
-        room.del_client(client)
+        if room.del_client(client):
+            self._on_client_removed(client)
+        if room.client_count != 0:
+            self._sync_need_translate(room)
 
-        if room.client_count == 0:
+        self._delay_del_room_or_key_if_unused(room, room_key)
+
+    def _delay_del_room_or_key_if_unused(self, room: 'ClientRoom', room_key: RoomKey):
+        if room.is_idle:
+            self.delay_del_room(room.room_key, self.DELAY_DEL_ROOM_TIMEOUT)
+        elif room_key.type == RoomKeyType.AUTH_CODE and room.get_key_ref_count(room_key) == 0:
+            # 房间还有其他RoomKey的客户端，但是身份码没人用了，要结束开放平台的项目
             self.delay_del_room(room_key, self.DELAY_DEL_ROOM_TIMEOUT)
 
+    def add_remote_worker(self, room_key: RoomKey, worker_id, need_translate):
+        """多进程模式下，其他worker订阅了这个房间"""
+        room = self._get_or_add_room(room_key)
+        room.add_remote_worker(worker_id, need_translate, room_key)
+        self._sync_need_translate(room)
+
+        self._clear_delay_del_timer(room_key)
+        self._clear_delay_del_timer(room.room_key)
+
+    def del_remote_worker(self, room_key: RoomKey, worker_id):
+        room = self.get_room(room_key)
+        if room is None:
+            return
+
+        room.del_remote_worker(worker_id, room_key)
+        self._sync_need_translate(room)
+
+        self._delay_del_room_or_key_if_unused(room, room_key)
+
+    @staticmethod
+    def _sync_need_translate(room: 'ClientRoom'):
+        """房间是否需要翻译可能变化了，通知消息的来源"""
+        if services.worker.is_upstream_owner():
+            live_client = _live_client_manager.get_live_client(room.room_key)
+            if isinstance(live_client, RelayLiveClient):
+                live_client.set_need_translate(room.need_translate)
+        else:
+            # 多进程模式下订阅主进程的消息
+            services.worker.subscribe_room(room.room_key, room.need_translate)
+
     def get_room(self, room_key: RoomKey):
-        return self._rooms.get(room_key, None)
+        return self._rooms.get(self._alias_to_room_key.get(room_key, room_key), None)
 
     def iter_rooms(self) -> Iterable['ClientRoom']:
         return self._rooms.values()
 
-    def _get_or_add_room(self, room_key: RoomKey):
-        room = self._rooms.get(room_key, None)
+    def _get_or_add_room(self, room_key: RoomKey, allow_relay=True, limit_new_room_rate=False):
+        room = self.get_room(room_key)
         if room is None:
+            room_id_key = self._room_id_alias_cache.get(room_key, None)
+            if room_id_key is not None:
+                room = self.get_room(room_id_key)
+                if room is not None:
+                    self._add_alias(room, room_key)
+                    return room
+                if services.worker.is_upstream_owner() and _live_client_manager.has_warm_live_client(room_id_key):
+                    # 长号的连接还在预热池中，用长号创建房间
+                    room = self._get_or_add_room(room_id_key, allow_relay, limit_new_room_rate)
+                    if self.get_room(room_key) is None:
+                        self._add_alias(room, room_key)
+                    return room
+
+            if limit_new_room_rate:
+                self._check_new_room_rate()
+
             logger.info('room=%s creating client room', room_key)
             self._rooms[room_key] = room = ClientRoom(room_key)
             logger.info('room=%s client room created, %d client rooms', room_key, len(self._rooms))
 
-            _live_client_manager.add_live_client(room_key)
+            if services.worker.is_upstream_owner():
+                _live_client_manager.add_live_client(room_key, allow_relay)
+                # 复用预热池的连接时可能已经合并到其他房间了
+                room = self.get_room(room_key)
         return room
 
-    def del_room(self, room_key: RoomKey):
+    def del_room(self, room_key: RoomKey, keep_live_client_warm=False):
+        """
+        删除房间
+
+        :param room_key: 房间的任意一个RoomKey
+        :param keep_live_client_warm: 是否把到B站的连接放到预热池，而不是立即关闭
+        """
         self._clear_delay_del_timer(room_key)
 
-        room = self._rooms.pop(room_key, None)
+        room = self.get_room(room_key)
         if room is None:
             return
+        room_key = room.room_key
+        del self._rooms[room_key]
+        self._clear_delay_del_timer(room_key)
+        for alias_key in room.alias_keys:
+            del self._alias_to_room_key[alias_key]
+            self._clear_delay_del_timer(alias_key)
 
         logger.info('room=%s removing client room', room_key)
+        for client in room.clients:
+            self._on_client_removed(client)
         room.clear_clients()
         logger.info('room=%s client room removed, %d client rooms', room_key, len(self._rooms))
 
-        _live_client_manager.del_live_client(room_key)
+        if services.worker.is_upstream_owner():
+            services.worker.send_del_room(room.room_keys, room.clear_remote_workers())
+            if keep_live_client_warm:
+                _live_client_manager.release_live_client(room_key)
+            else:
+                _live_client_manager.del_live_client(room_key)
+        else:
+            services.worker.unsubscribe_room(room_key)
+
+    def on_live_client_init(self, live_client: Union['WebLiveClient', 'OpenLiveClient']):
+        """
+        到B站的连接初始化后知道了真实的房间ID，把同一个房间的其他RoomKey合并到这个房间，共用一个到B站的连接
+
+        每个身份码有自己的开放平台项目，所以有身份码的房间不会合并到一起。身份码的房间合并了用房间ID的房间时，
+        到B站的连接用身份码的，身份码没人用了以后再换回用房间ID连接
+        """
+        room = self.get_room(live_client.room_key)
+        if room is None or live_client.room_id is None:
+            return
+        room_id_key = RoomKey(RoomKeyType.ROOM_ID, live_client.room_id)
+        if room_id_key == room.room_key or room_id_key in room.alias_keys:
+            return
+        if isinstance(live_client, WebLiveClient):
+            self._room_id_alias_cache[live_client.room_key] = room_id_key
+
+        other_room = self.get_room(room_id_key)
+        if other_room is None:
+            self._add_alias(room, room_id_key)
+            return
+
+        other_live_client = _live_client_manager.get_live_client(other_room.room_key)
+        if isinstance(live_client, OpenLiveClient):
+            if not isinstance(other_live_client, WebLiveClient):
+                return
+            self._merge_room(room, other_room)
+        else:
+            if isinstance(other_live_client, RelayLiveClient):
+                return
+            self._merge_room(other_room, room)
+
+    def _add_alias(self, room: 'ClientRoom', alias_key: RoomKey):
+        logger.info('room=%s added alias %s', room.room_key, alias_key)
+        self._alias_to_room_key[alias_key] = room.room_key
+        room.add_alias_key(alias_key)
+
+    def _merge_room(self, room: 'ClientRoom', other_room: 'ClientRoom'):
+        """把other_room合并到room，关闭other_room到B站的连接"""
+        logger.info('room=%s merging room=%s', room.room_key, other_room.room_key)
+        other_room_key = other_room.room_key
+        del self._rooms[other_room_key]
+        self._clear_delay_del_timer(other_room_key)
+        for alias_key in other_room.room_keys:
+            self._add_alias(room, alias_key)
+
+        room.merge_room(other_room)
+        _live_client_manager.close_live_client(other_room_key)
+        self._sync_need_translate(room)
+
+    def _release_room_key(self, room: 'ClientRoom', room_key: RoomKey):
+        """身份码没人用了，从房间中删除，结束开放平台的项目"""
+        if room_key != room.room_key:
+            logger.info('room=%s removed alias %s', room.room_key, room_key)
+            del self._alias_to_room_key[room_key]
+            room.del_alias_key(room_key)
+            return
+
+        # 身份码是这个房间到B站的连接，换成用房间ID连接
+        live_client = _live_client_manager.get_live_client(room_key)
+        new_room_key = None
+        if live_client is not None and live_client.room_id is not None:
+            new_room_key = RoomKey(RoomKeyType.ROOM_ID, live_client.room_id)
+        if new_room_key not in room.alias_keys:
+            new_room_key = next((key for key in room.alias_keys if key.type == RoomKeyType.ROOM_ID), None)
+            if new_room_key is None:
+                return
+        logger.info('room=%s switching live client to %s', room_key, new_room_key)
+
+        _live_client_manager.close_live_client(room_key)
+        del self._rooms[room_key]
+        room.del_alias_key(new_room_key)
+        room.set_room_key(new_room_key)
+        self._rooms[new_room_key] = room
+        del self._alias_to_room_key[new_room_key]
+        for alias_key in room.alias_keys:
+            self._alias_to_room_key[alias_key] = new_room_key
+        _live_client_manager.add_live_client(new_room_key)
+
+    def add_handoff_room(self, room_key: RoomKey, timeout, open_live_game_data: Optional[dict] = None):
+        """平滑重启时预先创建旧进程的房间并连接B站，timeout秒内没有客户端加入就删除"""
+        if self.get_room(room_key) is not None:
+            return
+        _live_client_manager.add_live_client(room_key, open_live_game_data=open_live_game_data)
+        self._get_or_add_room(room_key)
+        self.delay_del_room(room_key, timeout)
+
+    def get_stats(self):
+        return {
+            'clientCount': self._client_count,
+            'ipCount': len(self._ip_to_client_count),
+            'roomCount': len(self._rooms),
+            # 拒绝原因 -> 拒绝次数，原因有total、room、ip、new_room
+            'rejectedCounts': dict(self._rejected_counts),
+        }
 
     def delay_del_room(self, room_key: RoomKey, timeout):
         self._clear_delay_del_timer(room_key)
@@ -424,48 +1277,432 @@ class ClientRoomManager:
 
     def _on_delay_del_room(self, room_key: RoomKey):
         self._delay_del_timer_handles.pop(room_key, None)
-        self.del_room(room_key)
+        room = self.get_room(room_key)
+        if room is None:
+            return
+        if room.is_idle:
+            self.del_room(room_key, keep_live_client_warm=True)
+        elif room_key.type == RoomKeyType.AUTH_CODE and room.get_key_ref_count(room_key) == 0:
+            self._release_room_key(room, room_key)
+
+
+class MessageFilter(NamedTuple):
+    """客户端要求在服务器过滤消息的规则，由客户端加入房间时传入"""
+    # 屏蔽包含这些关键词的弹幕、醒目留言
+    block_keywords: FrozenSet[str] = frozenset()
+    # 屏蔽价格低于这个值（元）的礼物、醒目留言
+    min_gift_price: float = 0.0
+    # 屏蔽粉丝牌等级低于这个值的弹幕
+    block_medal_level: int = 0
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            block_keywords=frozenset(
+                keyword for keyword in map(str, data.get('blockKeywords', ())) if keyword != ''
+            ),
+            min_gift_price=float(data.get('minGiftPrice', 0.0)),
+            block_medal_level=int(data.get('blockMedalLevel', 0)),
+        )
+
+    @property
+    def is_empty(self):
+        return not self.block_keywords and self.min_gift_price <= 0.0 and self.block_medal_level <= 0
+
+    def is_blocked(self, context: 'MessageFilterContext'):
+        cmd = context.message.cmd
+        data = context.message.data
+        if cmd == api.chat.Command.ADD_TEXT:
+            if 0 < self.block_medal_level and data[10] < self.block_medal_level:
+                return True
+            return self._is_blocked_by_keywords(context)
+        elif cmd == api.chat.Command.ADD_GIFT:
+            return data['totalCoin'] / 1000 < self.min_gift_price
+        elif cmd == api.chat.Command.ADD_SUPER_CHAT:
+            if data['price'] < self.min_gift_price:
+                return True
+            return self._is_blocked_by_keywords(context)
+        return False
+
+    def _is_blocked_by_keywords(self, context: 'MessageFilterContext'):
+        if not self.block_keywords:
+            return False
+        return not self.block_keywords.isdisjoint(context.matched_keywords)
+
+
+class MessageFilterContext:
+    """一条消息在一个房间里过滤时共用的信息，所有客户端的关键词只匹配一次"""
+    def __init__(self, message: 'api.chat.OutgoingMessage', keyword_matcher: utils.aho_corasick.AhoCorasick):
+        self.message = message
+        self._keyword_matcher = keyword_matcher
+        self._matched_keywords: Optional[Set[str]] = None
+
+    @property
+    def matched_keywords(self) -> Set[str]:
+        if self._matched_keywords is None:
+            cmd = self.message.cmd
+            if cmd == api.chat.Command.ADD_TEXT:
+                content = self.message.data[4]
+            elif cmd == api.chat.Command.ADD_SUPER_CHAT:
+                content = self.message.data['content']
+            else:
+                content = ''
+            self._matched_keywords = self._keyword_matcher.find_all(content)
+        return self._matched_keywords
+
+
+class TextSampler:
+    """弹幕超过客户端要求的速率时，在不同发送者之间公平地采样"""
+    # 统计每个发送者发送数的窗口
+    WINDOW = 1.0
+
+    def __init__(self, max_rate: float):
+        self._max_rate = max_rate
+        self._token_bucket = utils.rate_limit.TokenBucket(max_rate, max(max_rate, 1.0))
+        self._window_start_time = time.monotonic()
+        # 这个窗口内 uid -> 已经发送的数量
+        self._author_sent_counts: Dict[str, int] = {}
+        self.skipped_count = 0
+
+    def should_send(self, data: list):
+        # 舰队、房管、主播的弹幕总是发送
+        if data[3] != 0:
+            return True
+
+        cur_time = time.monotonic()
+        if cur_time - self._window_start_time >= self.WINDOW:
+            self._window_start_time = cur_time
+            self._author_sent_counts.clear()
+
+        # 每个发送者一个窗口内最多发送平均的份额，防止刷屏的人占满速率
+        uid = data[16]
+        sent_count = self._author_sent_counts.get(uid, 0)
+        author_count = len(self._author_sent_counts) + (1 if sent_count == 0 else 0)
+        quota = max(math.ceil(self._max_rate * self.WINDOW / author_count), 1)
+        if sent_count >= quota or not self._token_bucket.try_decrease_token():
+            self.skipped_count += 1
+            return False
+
+        self._author_sent_counts[uid] = sent_count + 1
+        return True
+
+
+class ClientGroupKey(NamedTuple):
+    """消息格式，决定了发给客户端的帧"""
+    encoding: 'api.chat.Encoding'
+    enable_bundle: bool
+    enable_compression: bool
+    subscribed_cmds: FrozenSet['api.chat.Command']
+    message_filter: MessageFilter
+    # 每秒最多发送多少条普通弹幕，0表示不限制
+    max_text_rate: float
+
+    @classmethod
+    def from_client(cls, client: 'api.chat.ChatHandler'):
+        return cls(
+            encoding=client.encoding,
+            enable_bundle=client.enable_bundle,
+            enable_compression=client.enable_compression,
+            subscribed_cmds=client.subscribed_cmds,
+            message_filter=client.message_filter,
+            max_text_rate=client.max_text_rate,
+        )
+
+
+class ClientGroup:
+    """房间中消息格式相同的一组客户端"""
+    # 合并消息的最长等待时间
+    BUNDLE_INTERVAL = 0.05
+    # 合并消息的最大条数，达到后立即发送
+    BUNDLE_MAX_SIZE = 100
+
+    def __init__(self, key: ClientGroupKey):
+        self._key = key
+        self._clients: List[api.chat.ChatHandler] = []
+        # 开启了自动翻译的客户端，发翻译时不用遍历所有客户端
+        self._auto_translate_clients: List[api.chat.ChatHandler] = []
+        # 没有过滤规则时是None，省去判断
+        self.message_filter = key.message_filter if not key.message_filter.is_empty else None
+        self.text_sampler = TextSampler(key.max_text_rate) if key.max_text_rate > 0 else None
+
+        # 等待合并发送的消息体
+        self._bundle_bodies: List[bytes] = []
+        self._is_bundle_droppable = True
+        self._bundle_timer_handle: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def key(self) -> ClientGroupKey:
+        return self._key
+
+    @property
+    def clients(self) -> List['api.chat.ChatHandler']:
+        return self._clients
+
+    @property
+    def client_count(self):
+        return len(self._clients)
+
+    @property
+    def auto_translate_clients(self) -> List['api.chat.ChatHandler']:
+        return self._auto_translate_clients
+
+    def add_client(self, client: 'api.chat.ChatHandler'):
+        self._clients.append(client)
+        if client.auto_translate:
+            self._auto_translate_clients.append(client)
+
+    def del_client(self, client: 'api.chat.ChatHandler'):
+        self._clients.remove(client)
+        if client.auto_translate:
+            self._auto_translate_clients.remove(client)
+
+    def clear(self):
+        self._clients.clear()
+        self._auto_translate_clients.clear()
+        self._clear_bundle()
+
+    def send_frame_no_raise(self, frame: bytes, droppable=False):
+        for client in self._clients:
+            client.send_frame_no_raise(frame, droppable)
+
+    def push_to_bundle(self, body: bytes, droppable):
+        self._bundle_bodies.append(body)
+        self._is_bundle_droppable = self._is_bundle_droppable and droppable
+
+        if len(self._bundle_bodies) >= self.BUNDLE_MAX_SIZE:
+            self.flush_bundle()
+        elif self._bundle_timer_handle is None:
+            self._bundle_timer_handle = asyncio.get_running_loop().call_later(
+                self.BUNDLE_INTERVAL, self._on_bundle_timeout
+            )
+
+    def _on_bundle_timeout(self):
+        self._bundle_timer_handle = None
+        self.flush_bundle()
+
+    def flush_bundle(self):
+        """把等待合并的消息发出去"""
+        if not self._bundle_bodies:
+            return
+        bodies = self._bundle_bodies
+        droppable = self._is_bundle_droppable
+        self._clear_bundle()
+
+        encoding = self._key.encoding
+        if len(bodies) == 1:
+            body = bodies[0]
+        else:
+            body = api.chat.make_bundle_message_body(bodies, encoding)
+        frame = api.chat.make_frame(body, encoding in api.chat.BINARY_ENCODINGS, self._key.enable_compression)
+        self.send_frame_no_raise(frame, droppable)
+
+    def _clear_bundle(self):
+        if self._bundle_timer_handle is not None:
+            self._bundle_timer_handle.cancel()
+            self._bundle_timer_handle = None
+        self._bundle_bodies = []
+        self._is_bundle_droppable = True
+
+
+class ReplayBuffer:
+    """最近广播的消息，客户端重连时补发。保存的是OutgoingMessage，补发时不用重新序列化"""
+    def __init__(self, max_size):
+        self._messages: Deque[api.chat.OutgoingMessage] = collections.deque(maxlen=max_size)
+        # 下一条消息的序号
+        self._next_seq = 0
+        # msg_id -> 序号
+        self._msg_id_to_seq: Dict[str, int] = {}
+
+    def add_message(self, message: 'api.chat.OutgoingMessage'):
+        if self._messages.maxlen == 0:
+            return
+        if len(self._messages) == self._messages.maxlen:
+            oldest_msg_id = self._messages[0].msg_id
+            oldest_seq = self._next_seq - len(self._messages)
+            # ID重复时映射的是更新的消息，不能删
+            if oldest_msg_id is not None and self._msg_id_to_seq.get(oldest_msg_id, None) == oldest_seq:
+                del self._msg_id_to_seq[oldest_msg_id]
+
+        self._messages.append(message)
+        msg_id = message.msg_id
+        if msg_id is not None:
+            self._msg_id_to_seq[msg_id] = self._next_seq
+        self._next_seq += 1
+
+    def get_messages_after(self, msg_id: str) -> List['api.chat.OutgoingMessage']:
+        """返回msg_id之后的消息，找不到msg_id时返回空列表"""
+        seq = self._msg_id_to_seq.get(msg_id, None)
+        if seq is None:
+            return self._get_messages_after_by_order(msg_id)
+        first_seq = self._next_seq - len(self._messages)
+        return list(itertools.islice(self._messages, seq - first_seq + 1, None))
+
+    @property
+    def messages(self) -> Iterable['api.chat.OutgoingMessage']:
+        return self._messages
+
+    def import_messages(self, messages: List['api.chat.OutgoingMessage']):
+        """
+        平滑重启时导入旧进程的消息，放在自己的消息前面
+
+        自己的消息中ID和导入的相同、或者早于导入的最后一条的，旧进程已经发过了，丢弃
+        """
+        imported_msg_ids = {message.msg_id for message in messages if message.msg_id is not None}
+        last_msg_id = next(
+            (message.msg_id for message in reversed(messages) if utils.id_gen.is_valid_id(message.msg_id)), None
+        )
+        own_messages = [
+            message for message in self._messages
+            if not (
+                message.msg_id in imported_msg_ids
+                or (
+                    last_msg_id is not None
+                    and utils.id_gen.is_valid_id(message.msg_id)
+                    and message.msg_id <= last_msg_id
+                )
+            )
+        ]
+
+        self._messages.clear()
+        self._msg_id_to_seq.clear()
+        self._next_seq = 0
+        for message in itertools.chain(messages, own_messages):
+            self.add_message(message)
+
+    def _get_messages_after_by_order(self, msg_id: str) -> List['api.chat.OutgoingMessage']:
+        """
+        msg_id已经被挤出缓冲区，或者是服务器重启前的消息时，用ID的顺序找之后的消息
+
+        只有自己生成的ID能比较先后，开放平台的消息ID不行，所以从第一条比msg_id新的消息开始全部返回
+        """
+        if not utils.id_gen.is_valid_id(msg_id):
+            return []
+        for index, message in enumerate(self._messages):
+            cur_msg_id = message.msg_id
+            if utils.id_gen.is_valid_id(cur_msg_id) and cur_msg_id > msg_id:
+                return list(itertools.islice(self._messages, index, None))
+        return []
 
 
 class ClientRoom:
     def __init__(self, room_key: RoomKey):
         self._room_key = room_key
         self._clients: List[api.chat.ChatHandler] = []
+        # 按消息格式分组，同一组的客户端共用同一个帧
+        self._client_groups: Dict[ClientGroupKey, ClientGroup] = {}
+        # 订阅了某种消息的客户端组，广播时只遍历订阅了的客户端
+        self._cmd_to_groups: Dict[api.chat.Command, List[ClientGroup]] = {}
+        # 所有客户端组的屏蔽关键词编译成一个自动机，每条消息只匹配一次
+        self._keyword_matcher = utils.aho_corasick.AhoCorasick(())
         self._auto_translate_count = 0
+        self._replay_buffer = ReplayBuffer(config.get_config().replay_buffer_size)
+        # 多进程模式下订阅了这个房间的其他worker ID -> 是否需要翻译
+        self._remote_workers: Dict[int, bool] = {}
+        # 同一个房间的其他RoomKey
+        self._alias_keys: Set[RoomKey] = set()
+        # 客户端和其他worker加入时用的RoomKey -> 数量，用来判断身份码是否还有人用
+        self._key_ref_counts: Dict[RoomKey, int] = collections.Counter()
+        # 订阅了这个房间的(其他worker ID, RoomKey)
+        self._remote_worker_keys: Set[Tuple[int, RoomKey]] = set()
 
     @property
     def room_key(self) -> RoomKey:
+        """主RoomKey，到B站的连接用这个"""
         return self._room_key
 
+    def set_room_key(self, room_key: RoomKey):
+        self._room_key = room_key
+
+    @property
+    def alias_keys(self) -> Set[RoomKey]:
+        return self._alias_keys
+
+    @property
+    def room_keys(self) -> List[RoomKey]:
+        return [self._room_key, *self._alias_keys]
+
+    def add_alias_key(self, room_key: RoomKey):
+        self._alias_keys.add(room_key)
+
+    def del_alias_key(self, room_key: RoomKey):
+        self._alias_keys.discard(room_key)
+
+    def get_key_ref_count(self, room_key: RoomKey):
+        return self._key_ref_counts.get(room_key, 0)
+
+    def _add_key_ref(self, room_key: RoomKey):
+        self._key_ref_counts[room_key] += 1
+
+    def _del_key_ref(self, room_key: RoomKey):
+        self._key_ref_counts[room_key] -= 1
+        if self._key_ref_counts[room_key] <= 0:
+            del self._key_ref_counts[room_key]
+
+    @property
+    def clients(self) -> List['api.chat.ChatHandler']:
+        return self._clients
+
     @property
     def client_count(self):
         return len(self._clients)
 
+    @property
+    def remote_worker_count(self):
+        return len(self._remote_workers)
+
+    @property
+    def is_idle(self):
+        """没有客户端，也没有其他worker订阅"""
+        return self.client_count == 0 and self.remote_worker_count == 0
+
     @property
     def need_translate(self):
-        return self._auto_translate_count > 0
+        return self._auto_translate_count > 0 or any(self._remote_workers.values())
 
     def add_client(self, client: 'api.chat.ChatHandler'):
         logger.info('room=%s addding client %s', self._room_key, client.request.remote_ip)
 
         self._clients.append(client)
+        group_key = ClientGroupKey.from_client(client)
+        group = self._client_groups.get(group_key, None)
+        if group is None:
+            self._client_groups[group_key] = group = ClientGroup(group_key)
+            self._update_group_indexes()
+        else:
+            # 加入之前的消息不发给新客户端，需要的话由replay_messages补发
+            group.flush_bundle()
+        group.add_client(client)
         if client.auto_translate:
             self._auto_translate_count += 1
+        self._add_key_ref(client.room_key)
 
         logger.info('room=%s added client %s, %d clients', self._room_key, client.request.remote_ip,
                     self.client_count)
 
     def del_client(self, client: 'api.chat.ChatHandler'):
+        """返回客户端是否在房间中"""
         client.close()
+        return self._remove_client(client)
+
+    def _remove_client(self, client: 'api.chat.ChatHandler'):
         try:
             self._clients.remove(client)
         except ValueError:
-            return
+            return False
+        group_key = ClientGroupKey.from_client(client)
+        group = self._client_groups[group_key]
+        group.del_client(client)
+        if group.client_count == 0:
+            group.clear()
+            del self._client_groups[group_key]
+            self._update_group_indexes()
         if client.auto_translate:
             self._auto_translate_count -= 1
+        self._del_key_ref(client.room_key)
 
         logger.info('room=%s removed client %s, %d clients', self._room_key, client.request.remote_ip,
                     self.client_count)
+        return True
 
     def clear_clients(self):
         logger.info('room=%s clearing %d clients', self._room_key, self.client_count)
@@ -473,21 +1710,173 @@ class ClientRoom:
         for client in self._clients:
             client.close()
         self._clients.clear()
+        for group in self._client_groups.values():
+            group.clear()
+        self._client_groups.clear()
+        self._update_group_indexes()
         self._auto_translate_count = 0
+        self._key_ref_counts.clear()
+
+    def add_remote_worker(self, worker_id, need_translate, room_key: RoomKey):
+        if worker_id not in self._remote_workers:
+            logger.info('room=%s added remote worker %d', self._room_key, worker_id)
+        self._remote_workers[worker_id] = need_translate
+        if (worker_id, room_key) not in self._remote_worker_keys:
+            self._remote_worker_keys.add((worker_id, room_key))
+            self._add_key_ref(room_key)
+
+    def del_remote_worker(self, worker_id, room_key: RoomKey):
+        if (worker_id, room_key) not in self._remote_worker_keys:
+            return
+        self._remote_worker_keys.remove((worker_id, room_key))
+        self._del_key_ref(room_key)
+        # 同一个worker可能用多个RoomKey订阅了这个房间
+        if any(worker_id_ == worker_id for worker_id_, _ in self._remote_worker_keys):
+            return
+        if self._remote_workers.pop(worker_id, None) is not None:
+            logger.info('room=%s removed remote worker %d', self._room_key, worker_id)
+
+    def clear_remote_workers(self) -> List[int]:
+        res = list(self._remote_workers)
+        self._remote_workers.clear()
+        for _, room_key in self._remote_worker_keys:
+            self._del_key_ref(room_key)
+        self._remote_worker_keys.clear()
+        return res
+
+    def merge_room(self, other: 'ClientRoom'):
+        """把other的客户端和其他worker移到这个房间"""
+        for client in list(other._clients):
+            other._remove_client(client)
+            self.add_client(client)
+        for worker_id, room_key in other._remote_worker_keys:
+            self.add_remote_worker(worker_id, other._remote_workers[worker_id], room_key)
+        other.clear_remote_workers()
+        other.clear_clients()
+
+    def _update_group_indexes(self):
+        # 客户端组只在第一个客户端加入、最后一个客户端离开时变化，所以每次全部重建
+        self._cmd_to_groups = {
+            cmd: [group for group in self._client_groups.values() if cmd in group.key.subscribed_cmds]
+            for cmd in api.chat.Command
+        }
+
+        block_keywords = set()
+        for group in self._client_groups.values():
+            block_keywords.update(group.key.message_filter.block_keywords)
+        self._keyword_matcher = utils.aho_corasick.AhoCorasick(block_keywords)
 
     def send_cmd_data(self, cmd, data):
-        body = api.chat.make_message_body(cmd, data)
-        for client in self._clients:
-            client.send_body_no_raise(body)
+        self.send_message_no_raise(api.chat.OutgoingMessage(cmd, data))
+
+    def send_auto_translate_message_no_raise(self, message: 'api.chat.OutgoingMessage'):
+        """只发给开启了自动翻译的客户端"""
+        if self._auto_translate_count > 0:
+            for group in self._cmd_to_groups.get(message.cmd, ()):
+                clients = group.auto_translate_clients
+                if not clients:
+                    continue
+                # 先把合并的消息发出去，保证顺序
+                group.flush_bundle()
+                frame = message.get_frame(group.key.encoding, group.key.enable_compression)
+                for client in clients:
+                    client.send_frame_no_raise(frame, message.droppable)
+
+        if self._remote_workers:
+            services.worker.forward_room_message(
+                self.room_keys,
+                [worker_id for worker_id, need_translate in self._remote_workers.items() if need_translate],
+                message,
+                auto_translate_only=True,
+            )
 
-    def send_cmd_data_if(self, filterer: Callable[['api.chat.ChatHandler'], bool], cmd, data):
-        body = api.chat.make_message_body(cmd, data)
-        for client in filter(filterer, self._clients):
-            client.send_body_no_raise(body)
+    def send_message_no_raise(self, message: 'api.chat.OutgoingMessage'):
+        """广播消息，每种格式只序列化、打包一次，同一组的客户端共用同一个bytes对象"""
+        if message.cmd in api.chat.REPLAYABLE_COMMANDS:
+            self._replay_buffer.add_message(message)
+
+        filter_context = MessageFilterContext(message, self._keyword_matcher)
+        for group in self._cmd_to_groups.get(message.cmd, ()):
+            if group.message_filter is not None and group.message_filter.is_blocked(filter_context):
+                continue
+            if (
+                group.text_sampler is not None
+                and message.cmd == api.chat.Command.ADD_TEXT
+                and not group.text_sampler.should_send(message.data)
+            ):
+                continue
+            if group.key.enable_bundle:
+                group.push_to_bundle(message.get_body(group.key.encoding), message.droppable)
+            else:
+                group.send_frame_no_raise(
+                    message.get_frame(group.key.encoding, group.key.enable_compression), message.droppable
+                )
 
-    def send_body_no_raise(self, body):
-        for client in self._clients:
-            client.send_body_no_raise(body)
+        if self._remote_workers:
+            services.worker.forward_room_message(self.room_keys, self._remote_workers, message)
+
+    @property
+    def replay_buffer_messages(self) -> Iterable['api.chat.OutgoingMessage']:
+        return self._replay_buffer.messages
+
+    def import_replay_messages(self, messages: List['api.chat.OutgoingMessage']):
+        self._replay_buffer.import_messages(messages)
+
+    def replay_messages(self, client: 'api.chat.ChatHandler', last_msg_id: str):
+        """给重连的客户端补发last_msg_id之后的消息，返回补发的消息数"""
+        message_filter = client.message_filter if not client.message_filter.is_empty else None
+        messages = [
+            message for message in self._replay_buffer.get_messages_after(last_msg_id)
+            if (
+                message.cmd in client.subscribed_cmds
+                and (
+                    message_filter is None
+                    or not message_filter.is_blocked(MessageFilterContext(message, self._keyword_matcher))
+                )
+            )
+        ]
+        if not messages:
+            return 0
+
+        if client.enable_bundle:
+            # 一次发完
+            body = api.chat.make_bundle_message_body(
+                [message.get_body(client.encoding) for message in messages], client.encoding
+            )
+            frame = api.chat.make_frame(body, client.encoding in api.chat.BINARY_ENCODINGS, client.enable_compression)
+            client.send_frame_no_raise(frame, all(message.droppable for message in messages))
+        else:
+            for message in messages:
+                client.send_message_no_raise(message)
+        return len(messages)
+
+    def get_stats(self):
+        client_stats = [
+            {
+                'remoteIp': client.request.remote_ip,
+                'sendQueueSize': client.send_queue_size,
+                'sendQueueBytes': client.send_queue_bytes,
+                'droppedMsgCount': client.dropped_msg_count,
+            }
+            for client in self._clients
+        ]
+        # 慢的客户端排在前面
+        client_stats.sort(key=lambda stats: stats['sendQueueBytes'], reverse=True)
+        return {
+            'roomKey': str(self._room_key),  # 身份码要脱敏
+            'aliasKeys': [str(room_key) for room_key in self._alias_keys],
+            'clientCount': self.client_count,
+            'remoteWorkerCount': self.remote_worker_count,
+            'sendQueueSize': sum(stats['sendQueueSize'] for stats in client_stats),
+            'sendQueueBytes': sum(stats['sendQueueBytes'] for stats in client_stats),
+            'droppedMsgCount': sum(stats['droppedMsgCount'] for stats in client_stats),
+            # 超过客户端要求的速率而没有发送的弹幕数，同一组的客户端只算一次
+            'skippedTextCount': sum(
+                group.text_sampler.skipped_count for group in self._client_groups.values()
+                if group.text_sampler is not None
+            ),
+            'clients': client_stats,
+        }
 
 
 class LiveMsgHandler(blivedm.BaseHandler):
@@ -503,14 +1892,25 @@ class LiveMsgHandler(blivedm.BaseHandler):
         _live_client_manager.del_live_client(client.room_key)
 
     def _on_danmaku(self, client: WebLiveClient, message: dm_web_models.DanmakuMessage):
-        utils.async_io.create_task_with_ref(self.__on_danmaku(client, message))
-
-    async def __on_danmaku(self, client: WebLiveClient, message: dm_web_models.DanmakuMessage):
-        # 先异步调用再获取房间，因为返回时房间可能已经不存在了
         avatar_url = message.face
-        if avatar_url == '':
-            avatar_url = await services.avatar.get_avatar_url(message.uid, message.uname)
+        if avatar_url != '':
+            # 大部分弹幕自带头像，直接发送，不用创建协程和task
+            client.message_sequencer.send(self._send_danmaku, client, message, avatar_url)
+        else:
+            slot = client.message_sequencer.reserve(
+                self._send_danmaku, client, message,
+                services.avatar.get_default_avatar_url(message.uid, message.uname)
+            )
+            utils.async_io.create_task_with_ref(self.__on_danmaku_without_avatar(client, message, slot))
+
+    async def __on_danmaku_without_avatar(
+        self, client: WebLiveClient, message: dm_web_models.DanmakuMessage, slot: _SequencerSlot
+    ):
+        avatar_url = await services.avatar.get_avatar_url(message.uid, message.uname)
+        client.message_sequencer.resolve(slot, self._send_danmaku, client, message, avatar_url)
 
+    def _send_danmaku(self, client: WebLiveClient, message: dm_web_models.DanmakuMessage, avatar_url: str):
+        # 异步获取头像之后才获取房间，因为返回时房间可能已经不存在了
         room = client_room_manager.get_room(client.room_key)
         if room is None:
             return
@@ -551,7 +1951,7 @@ class LiveMsgHandler(blivedm.BaseHandler):
         else:
             translation = ''
 
-        msg_id = uuid.uuid4().hex
+        msg_id = utils.id_gen.new_id()
         data = api.chat.make_text_message_data(
             avatar_url=avatar_url,
             timestamp=int(message.timestamp / 1000),
@@ -572,15 +1972,20 @@ class LiveMsgHandler(blivedm.BaseHandler):
             uid=str(message.uid) if message.uid != 0 else message.uname,
             medal_name='' if message.medal_room_id != client.room_id else message.medal_name,
         )
-        room.send_cmd_data(api.chat.Command.ADD_TEXT, data)
-        services.plugin.broadcast_cmd_data(
-            sdk_models.Command.ADD_TEXT, data, make_plugin_msg_extra_from_live_client(client)
+        msg_to_send = api.chat.OutgoingMessage(
+            api.chat.Command.ADD_TEXT, data, make_plugin_msg_extra_from_live_client(client)
         )
+        room.send_message_no_raise(msg_to_send)
+        services.plugin.broadcast_message(msg_to_send)
 
         if need_translate:
-            await self._translate_and_response(message.msg, room.room_key, msg_id)
+            utils.async_io.create_task_with_ref(self._translate_and_response(message.msg, room.room_key, msg_id))
 
     def _on_gift(self, client: WebLiveClient, message: dm_web_models.GiftMessage):
+        client.message_sequencer.send(self._send_gift, client, message)
+
+    @staticmethod
+    def _send_gift(client: WebLiveClient, message: dm_web_models.GiftMessage):
         avatar_url = services.avatar.process_avatar_url(message.face)
         services.avatar.update_avatar_cache_if_expired(message.uid, avatar_url)
 
@@ -590,7 +1995,7 @@ class LiveMsgHandler(blivedm.BaseHandler):
 
         is_paid_gift = message.coin_type == 'gold'
         data = {
-            'id': uuid.uuid4().hex,
+            'id': utils.id_gen.new_id(),
             'avatarUrl': avatar_url,
             'timestamp': message.timestamp,
             'authorName': message.uname,
@@ -606,25 +2011,34 @@ class LiveMsgHandler(blivedm.BaseHandler):
             'medalLevel': 0 if message.medal_ruid != client.room_owner_uid else message.medal_level,
             'medalName': '' if message.medal_ruid != client.room_owner_uid else message.medal_name,
         }
-        room.send_cmd_data(api.chat.Command.ADD_GIFT, data)
-        services.plugin.broadcast_cmd_data(
-            sdk_models.Command.ADD_GIFT, data, make_plugin_msg_extra_from_live_client(client)
+        msg_to_send = api.chat.OutgoingMessage(
+            api.chat.Command.ADD_GIFT, data, make_plugin_msg_extra_from_live_client(client)
         )
+        room.send_message_no_raise(msg_to_send)
+        services.plugin.broadcast_message(msg_to_send)
 
     def _on_user_toast_v2(self, client: WebLiveClient, message: dm_web_models.UserToastV2Message):
-        utils.async_io.create_task_with_ref(self.__on_buy_guard(client, message))
+        slot = client.message_sequencer.reserve(
+            self._send_buy_guard, client, message,
+            services.avatar.get_default_avatar_url(message.uid, message.username)
+        )
+        utils.async_io.create_task_with_ref(self.__on_buy_guard(client, message, slot))
 
-    @staticmethod
-    async def __on_buy_guard(client: WebLiveClient, message: dm_web_models.UserToastV2Message):
-        # 先异步调用再获取房间，因为返回时房间可能已经不存在了
+    async def __on_buy_guard(
+        self, client: WebLiveClient, message: dm_web_models.UserToastV2Message, slot: _SequencerSlot
+    ):
         avatar_url = await services.avatar.get_avatar_url(message.uid, message.username)
+        client.message_sequencer.resolve(slot, self._send_buy_guard, client, message, avatar_url)
 
+    @staticmethod
+    def _send_buy_guard(client: WebLiveClient, message: dm_web_models.UserToastV2Message, avatar_url: str):
+        # 异步获取头像之后才获取房间，因为返回时房间可能已经不存在了
         room = client_room_manager.get_room(client.room_key)
         if room is None:
             return
 
         data = {
-            'id': uuid.uuid4().hex,
+            'id': utils.id_gen.new_id(),
             'avatarUrl': avatar_url,
             'timestamp': message.start_time,
             'authorName': message.username,
@@ -637,12 +2051,16 @@ class LiveMsgHandler(blivedm.BaseHandler):
             'medalLevel': 0,
             'medalName': '',
         }
-        room.send_cmd_data(api.chat.Command.ADD_MEMBER, data)
-        services.plugin.broadcast_cmd_data(
-            sdk_models.Command.ADD_MEMBER, data, make_plugin_msg_extra_from_live_client(client)
+        msg_to_send = api.chat.OutgoingMessage(
+            api.chat.Command.ADD_MEMBER, data, make_plugin_msg_extra_from_live_client(client)
         )
+        room.send_message_no_raise(msg_to_send)
+        services.plugin.broadcast_message(msg_to_send)
 
     def _on_super_chat(self, client: WebLiveClient, message: dm_web_models.SuperChatMessage):
+        client.message_sequencer.send(self._send_super_chat, client, message)
+
+    def _send_super_chat(self, client: WebLiveClient, message: dm_web_models.SuperChatMessage):
         avatar_url = services.avatar.process_avatar_url(message.face)
         services.avatar.update_avatar_cache_if_expired(message.uid, avatar_url)
 
@@ -676,10 +2094,11 @@ class LiveMsgHandler(blivedm.BaseHandler):
             'medalLevel': 0 if message.medal_room_id != client.room_id else message.medal_level,
             'medalName': '' if message.medal_room_id != client.room_id else message.medal_name,
         }
-        room.send_cmd_data(api.chat.Command.ADD_SUPER_CHAT, data)
-        services.plugin.broadcast_cmd_data(
-            sdk_models.Command.ADD_SUPER_CHAT, data, make_plugin_msg_extra_from_live_client(client)
+        msg_to_send = api.chat.OutgoingMessage(
+            api.chat.Command.ADD_SUPER_CHAT, data, make_plugin_msg_extra_from_live_client(client)
         )
+        room.send_message_no_raise(msg_to_send)
+        services.plugin.broadcast_message(msg_to_send)
 
         if need_translate:
             utils.async_io.create_task_with_ref(self._translate_and_response(
@@ -687,6 +2106,10 @@ class LiveMsgHandler(blivedm.BaseHandler):
             ))
 
     def _on_super_chat_delete(self, client: WebLiveClient, message: dm_web_models.SuperChatDeleteMessage):
+        client.message_sequencer.send(self._send_super_chat_delete, client, message)
+
+    @staticmethod
+    def _send_super_chat_delete(client: WebLiveClient, message: dm_web_models.SuperChatDeleteMessage):
         room = client_room_manager.get_room(client.room_key)
         if room is None:
             return
@@ -694,10 +2117,11 @@ class LiveMsgHandler(blivedm.BaseHandler):
         data = {
             'ids': list(map(str, message.ids))
         }
-        room.send_cmd_data(api.chat.Command.DEL_SUPER_CHAT, data)
-        services.plugin.broadcast_cmd_data(
-            sdk_models.Command.DEL_SUPER_CHAT, data, make_plugin_msg_extra_from_live_client(client)
+        msg_to_send = api.chat.OutgoingMessage(
+            api.chat.Command.DEL_SUPER_CHAT, data, make_plugin_msg_extra_from_live_client(client)
         )
+        room.send_message_no_raise(msg_to_send)
+        services.plugin.broadcast_message(msg_to_send)
 
     @staticmethod
     def _need_translate(text, room: ClientRoom, client: LiveClientType):
@@ -719,16 +2143,13 @@ class LiveMsgHandler(blivedm.BaseHandler):
         if room is None:
             return
 
-        data = api.chat.make_translation_message_data(msg_id, translation)
-        room.send_cmd_data_if(
-            lambda client: client.auto_translate,
+        msg_to_send = api.chat.OutgoingMessage(
             api.chat.Command.UPDATE_TRANSLATION,
-            data
-        )
-
-        services.plugin.broadcast_cmd_data(
-            sdk_models.Command.UPDATE_TRANSLATION, data, make_plugin_msg_extra_from_client_room(room)
+            api.chat.make_translation_message_data(msg_id, translation),
+            make_plugin_msg_extra_from_client_room(room),
         )
+        room.send_auto_translate_message_no_raise(msg_to_send)
+        services.plugin.broadcast_message(msg_to_send)
 
     #
     # 开放平台消息
@@ -788,10 +2209,11 @@ class LiveMsgHandler(blivedm.BaseHandler):
             uid=message.open_id,
             medal_name='' if not message.fans_medal_wearing_status else message.fans_medal_name,
         )
-        room.send_cmd_data(api.chat.Command.ADD_TEXT, data)
-        services.plugin.broadcast_cmd_data(
-            sdk_models.Command.ADD_TEXT, data, make_plugin_msg_extra_from_live_client(client)
+        msg_to_send = api.chat.OutgoingMessage(
+            api.chat.Command.ADD_TEXT, data, make_plugin_msg_extra_from_live_client(client)
         )
+        room.send_message_no_raise(msg_to_send)
+        services.plugin.broadcast_message(msg_to_send)
 
         if need_translate:
             utils.async_io.create_task_with_ref(self._translate_and_response(
@@ -821,10 +2243,11 @@ class LiveMsgHandler(blivedm.BaseHandler):
             'medalLevel': 0 if not message.fans_medal_wearing_status else message.fans_medal_level,
             'medalName': '' if not message.fans_medal_wearing_status else message.fans_medal_name,
         }
-        room.send_cmd_data(api.chat.Command.ADD_GIFT, data)
-        services.plugin.broadcast_cmd_data(
-            sdk_models.Command.ADD_GIFT, data, make_plugin_msg_extra_from_live_client(client)
+        msg_to_send = api.chat.OutgoingMessage(
+            api.chat.Command.ADD_GIFT, data, make_plugin_msg_extra_from_live_client(client)
         )
+        room.send_message_no_raise(msg_to_send)
+        services.plugin.broadcast_message(msg_to_send)
 
     def _on_open_live_buy_guard(self, client: OpenLiveClient, message: dm_open_models.GuardBuyMessage):
         room = client_room_manager.get_room(client.room_key)
@@ -845,10 +2268,11 @@ class LiveMsgHandler(blivedm.BaseHandler):
             'medalLevel': 0 if not message.fans_medal_wearing_status else message.fans_medal_level,
             'medalName': '' if not message.fans_medal_wearing_status else message.fans_medal_name,
         }
-        room.send_cmd_data(api.chat.Command.ADD_MEMBER, data)
-        services.plugin.broadcast_cmd_data(
-            sdk_models.Command.ADD_MEMBER, data, make_plugin_msg_extra_from_live_client(client)
+        msg_to_send = api.chat.OutgoingMessage(
+            api.chat.Command.ADD_MEMBER, data, make_plugin_msg_extra_from_live_client(client)
         )
+        room.send_message_no_raise(msg_to_send)
+        services.plugin.broadcast_message(msg_to_send)
 
     def _on_open_live_super_chat(self, client: OpenLiveClient, message: dm_open_models.SuperChatMessage):
         room = client_room_manager.get_room(client.room_key)
@@ -881,10 +2305,11 @@ class LiveMsgHandler(blivedm.BaseHandler):
             'medalLevel': 0 if not message.fans_medal_wearing_status else message.fans_medal_level,
             'medalName': '' if not message.fans_medal_wearing_status else message.fans_medal_name,
         }
-        room.send_cmd_data(api.chat.Command.ADD_SUPER_CHAT, data)
-        services.plugin.broadcast_cmd_data(
-            sdk_models.Command.ADD_SUPER_CHAT, data, make_plugin_msg_extra_from_live_client(client)
+        msg_to_send = api.chat.OutgoingMessage(
+            api.chat.Command.ADD_SUPER_CHAT, data, make_plugin_msg_extra_from_live_client(client)
         )
+        room.send_message_no_raise(msg_to_send)
+        services.plugin.broadcast_message(msg_to_send)
 
         if need_translate:
             utils.async_io.create_task_with_ref(self._translate_and_response(
@@ -899,7 +2324,8 @@ class LiveMsgHandler(blivedm.BaseHandler):
         data = {
             'ids': list(map(str, message.message_ids))
         }
-        room.send_cmd_data(api.chat.Command.DEL_SUPER_CHAT, data)
-        services.plugin.broadcast_cmd_data(
-            sdk_models.Command.DEL_SUPER_CHAT, data, make_plugin_msg_extra_from_live_client(client)
+        msg_to_send = api.chat.OutgoingMessage(
+            api.chat.Command.DEL_SUPER_CHAT, data, make_plugin_msg_extra_from_live_client(client)
         )
+        room.send_message_no_raise(msg_to_send)
+        services.plugin.broadcast_message(msg_to_send)
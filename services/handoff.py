@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import enum
+import logging
+import math
+import os
+import random
+import socket
+import stat
+import struct
+import sys
+import tempfile
+from typing import *
+
+import msgpack
+
+import api.chat
+import config
+import services.chat
+
+logger = logging.getLogger(__name__)
+
+# 平滑重启：新进程用--handoff启动，连接旧进程，继承监听socket和房间列表，预先连接B站后通知旧进程。
+# 旧进程停止接受连接，把补发缓冲区交给新进程，然后分批断开客户端，客户端重连到新进程后用lastMsgId补发消息
+
+
+class HandoffCommand(enum.IntEnum):
+    # 新进程 -> 旧进程
+    HELLO = 1
+    READY = 2
+    # 旧进程 -> 新进程
+    LISTEN_SOCKETS = 3
+    ROOM_LIST = 4
+    ROOM_STATES = 5
+
+
+# 一次最多传多少个监听socket
+_MAX_FDS = 16
+# 新进程每秒预先连接多少个房间，防止重启时同时请求B站
+PREOPEN_ROOMS_PER_SECOND = 20
+# 新进程最多等多久预先连接完成，超时也继续交接
+PREOPEN_TIMEOUT = 30
+# 旧进程用多长时间分批断开客户端，防止同时重连
+DRAIN_DURATION = 5
+# 预先创建的房间等多久客户端重连过来，超时没有客户端就删除
+HANDOFF_ROOM_TIMEOUT = 60
+
+# 旧进程中等待新进程连接
+_source: Optional['HandoffSource'] = None
+# 新进程中到旧进程的连接
+_receiver: Optional['HandoffReceiver'] = None
+
+
+def is_supported():
+    return sys.platform != 'win32' and hasattr(socket, 'send_fds')
+
+
+def _get_ipc_path():
+    """IPC socket的路径，所在目录不安全时抛出OSError"""
+    # 放在只有当前用户能访问的目录，防止其他用户抢先创建socket冒充旧进程
+    ipc_dir = os.path.join(tempfile.gettempdir(), f'blivechat-{os.getuid()}')
+    os.makedirs(ipc_dir, 0o700, exist_ok=True)
+    dir_stat = os.lstat(ipc_dir)
+    if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid() or dir_stat.st_mode & 0o077:
+        raise OSError(f'Unsafe handoff directory: {ipc_dir}')
+    # 按端口区分，同一台机器上可以运行多个实例
+    return os.path.join(ipc_dir, f'handoff-{config.get_config().port}.sock')
+
+
+def _check_peer_uid(sock: socket.socket):
+    """对方不是同一个用户的进程时抛出ValueError"""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        # 不是Linux，只靠目录的权限
+        return
+    cred = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _pid, uid, _gid = struct.unpack('3i', cred)
+    if uid != os.getuid():
+        raise ValueError(f'Handoff peer uid={uid} is not the current user')
+
+
+def _room_key_to_ipc(room_key: 'services.chat.RoomKey'):
+    return [int(room_key.type), room_key.value]
+
+
+def _room_key_from_ipc(data: list):
+    return services.chat.RoomKey(services.chat.RoomKeyType(data[0]), data[1])
+
+
+class _Channel:
+    """交接用的连接，消息用msgpack打包，可以附带文件描述符"""
+    def __init__(self, sock: socket.socket):
+        sock.setblocking(False)
+        self._sock = sock
+        self._unpacker = msgpack.Unpacker()
+        self.received_fds: List[int] = []
+
+    @property
+    def sock(self):
+        return self._sock
+
+    def close(self):
+        self._sock.close()
+
+    async def recv(self) -> list:
+        loop = asyncio.get_running_loop()
+        while True:
+            for msg in self._unpacker:
+                return msg
+
+            future = loop.create_future()
+            loop.add_reader(self._sock.fileno(), lambda: future.done() or future.set_result(None))
+            try:
+                await future
+            finally:
+                loop.remove_reader(self._sock.fileno())
+            try:
+                data, fds, _flags, _addr = socket.recv_fds(self._sock, 65536, _MAX_FDS)
+            except BlockingIOError:
+                continue
+            if not data:
+                raise ConnectionResetError('Connection closed by peer')
+            self.received_fds.extend(fds)
+            self._unpacker.feed(data)
+
+    async def send(self, *msg, fds: Sequence[int] = ()):
+        data = msgpack.packb(msg)
+        if fds:
+            # 这条消息很短，不会发不完
+            socket.send_fds(self._sock, [data], fds)
+        else:
+            await asyncio.get_running_loop().sock_sendall(self._sock, data)
+
+
+#
+# 旧进程
+#
+
+def init_source(
+    listen_sockets: List[socket.socket], stop_accepting: Callable[[], None], on_handed_off: Callable[[], None]
+):
+    """
+    等待新进程来交接
+
+    :param listen_sockets: 要交给新进程的监听socket
+    :param stop_accepting: 新进程准备好后调用，停止接受新连接
+    :param on_handed_off: 交接完成后调用，这时应该退出进程
+    """
+    if not is_supported():
+        return
+    global _source
+    _source = HandoffSource(listen_sockets, stop_accepting, on_handed_off)
+    _source.start()
+
+
+def shut_down():
+    if _source is not None:
+        _source.close()
+    if _receiver is not None:
+        _receiver.close()
+
+
+class HandoffSource:
+    def __init__(
+        self, listen_sockets: List[socket.socket], stop_accepting: Callable[[], None],
+        on_handed_off: Callable[[], None]
+    ):
+        self._listen_sockets = listen_sockets
+        self._stop_accepting = stop_accepting
+        self._on_handed_off = on_handed_off
+        self._ipc_path: Optional[str] = None
+        self._ipc_sock: Optional[socket.socket] = None
+        self._accept_future: Optional[asyncio.Future] = None
+
+    def start(self):
+        try:
+            self._ipc_path = _get_ipc_path()
+        except OSError:
+            logger.exception('Failed to get handoff socket path')
+            return
+
+        # 可能是上次异常退出留下的
+        try:
+            os.unlink(self._ipc_path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logger.exception('Failed to remove handoff socket, path=%s', self._ipc_path)
+            return
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self._ipc_path)
+            # 监听socket可以交给其他进程，只允许同一个用户连接
+            os.chmod(self._ipc_path, 0o600)
+            sock.listen(1)
+        except OSError:
+            logger.exception('Failed to listen handoff socket, path=%s', self._ipc_path)
+            sock.close()
+            return
+        sock.setblocking(False)
+        self._ipc_sock = sock
+        self._accept_future = asyncio.create_task(self._accept_loop())
+        logger.info('Waiting for handoff at %s', self._ipc_path)
+
+    def close(self):
+        if self._accept_future is not None:
+            self._accept_future.cancel()
+            self._accept_future = None
+        self._close_ipc_sock()
+
+    def _close_ipc_sock(self):
+        if self._ipc_sock is not None:
+            self._ipc_sock.close()
+            self._ipc_sock = None
+            try:
+                os.unlink(self._ipc_path)
+            except OSError:
+                pass
+
+    async def _accept_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            sock, _ = await loop.sock_accept(self._ipc_sock)
+            channel = _Channel(sock)
+            try:
+                is_handed_off = await self._handoff(channel)
+            except (OSError, ValueError, asyncio.TimeoutError):
+                logger.exception('Handoff failed')
+                is_handed_off = False
+            finally:
+                channel.close()
+            if is_handed_off:
+                break
+        self._accept_future = None
+
+        await self._drain_clients()
+        logger.info('Handoff finished')
+        self._on_handed_off()
+
+    async def _handoff(self, channel: _Channel):
+        # 除了目录和socket文件的权限，再检查一次对方的用户
+        _check_peer_uid(channel.sock)
+        msg = await asyncio.wait_for(channel.recv(), 10)
+        if msg[0] != HandoffCommand.HELLO:
+            raise ValueError(f'Unexpected handoff cmd={msg[0]}')
+        logger.info('New process pid=%s connected, starting handoff', msg[1])
+
+        await channel.send(
+            HandoffCommand.LISTEN_SOCKETS, fds=[sock.fileno() for sock in self._listen_sockets]
+        )
+        await channel.send(HandoffCommand.ROOM_LIST, services.chat.export_handoff_rooms())
+
+        # 房间多时预先连接要很久，不设超时，新进程异常退出时连接会断开
+        msg = await channel.recv()
+        if msg[0] != HandoffCommand.READY:
+            raise ValueError(f'Unexpected handoff cmd={msg[0]}')
+
+        # 从这里开始不能回退了。新连接都由新进程接受，新进程继续用开放平台的项目
+        self._stop_accepting()
+        self._close_ipc_sock()
+        services.chat.detach_open_live_games()
+
+        # 之后客户端收到的消息新进程也收到了，补发时按ID的顺序找
+        try:
+            await channel.send(HandoffCommand.ROOM_STATES, [
+                [_room_key_to_ipc(room.room_key), [
+                    message.get_body(api.chat.Encoding.MSGPACK) for message in room.replay_buffer_messages
+                ]]
+                for room in services.chat.client_room_manager.iter_rooms()
+            ])
+        except Exception:  # noqa
+            # 已经不能回退了，还是要断开客户端并退出。新进程没有补发缓冲区，客户端重连时只是少补发一些消息
+            logger.exception('Failed to send room states')
+        return True
+
+    @staticmethod
+    async def _drain_clients():
+        clients = [
+            client
+            for room in services.chat.client_room_manager.iter_rooms()
+            for client in room.clients
+        ]
+        logger.info('Draining %d clients', len(clients))
+        random.shuffle(clients)
+
+        batch_num = DRAIN_DURATION * 10
+        batch_size = max(math.ceil(len(clients) / batch_num), 1)
+        for index in range(0, len(clients), batch_size):
+            for client in clients[index:index + batch_size]:
+                # 客户端会重连到新进程
+                client.close()
+            await asyncio.sleep(0.1)
+
+
+#
+# 新进程
+#
+
+async def receive_listen_sockets() -> Optional[List[socket.socket]]:
+    """连接旧进程，返回继承的监听socket，失败时返回None"""
+    if not is_supported():
+        logger.warning('Handoff is not supported on this platform')
+        return None
+    global _receiver
+    _receiver = HandoffReceiver()
+    listen_sockets = await _receiver.start()
+    if listen_sockets is None:
+        _receiver.close()
+        _receiver = None
+    return listen_sockets
+
+
+async def take_over_rooms():
+    """预先连接旧进程的房间，然后通知旧进程断开客户端"""
+    global _receiver
+    if _receiver is None:
+        return
+    try:
+        await _receiver.take_over_rooms()
+    finally:
+        _receiver.close()
+        _receiver = None
+
+
+class HandoffReceiver:
+    def __init__(self):
+        self._channel: Optional[_Channel] = None
+        # [room_key, 客户端数, 开放平台项目的数据]
+        self._rooms: List[list] = []
+
+    def close(self):
+        if self._channel is not None:
+            self._channel.close()
+            self._channel = None
+
+    async def start(self):
+        try:
+            ipc_path = _get_ipc_path()
+        except OSError:
+            logger.exception('Failed to get handoff socket path')
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._channel = _Channel(sock)
+        try:
+            await asyncio.get_running_loop().sock_connect(sock, ipc_path)
+            # 继承的监听socket和开放平台项目的数据只能来自同一个用户的旧进程
+            _check_peer_uid(sock)
+            await self._channel.send(HandoffCommand.HELLO, os.getpid())
+
+            msg = await asyncio.wait_for(self._channel.recv(), 10)
+            if msg[0] != HandoffCommand.LISTEN_SOCKETS:
+                raise ValueError(f'Unexpected handoff cmd={msg[0]}')
+            msg = await asyncio.wait_for(self._channel.recv(), 10)
+            if msg[0] != HandoffCommand.ROOM_LIST:
+                raise ValueError(f'Unexpected handoff cmd={msg[0]}')
+            self._rooms = msg[1]
+        except (OSError, ValueError, asyncio.TimeoutError):
+            logger.exception('Failed to connect to old process, path=%s', ipc_path)
+            for fd in self._channel.received_fds:
+                os.close(fd)
+            return None
+
+        listen_sockets = [socket.socket(fileno=fd) for fd in self._channel.received_fds]
+        for sock in listen_sockets:
+            sock.setblocking(False)
+        logger.info('Inherited %d listening sockets and %d rooms', len(listen_sockets), len(self._rooms))
+        return listen_sockets
+
+    async def take_over_rooms(self):
+        room_keys = await self._preopen_rooms()
+
+        try:
+            await self._channel.send(HandoffCommand.READY)
+            msg = await asyncio.wait_for(self._channel.recv(), 10)
+            if msg[0] != HandoffCommand.ROOM_STATES:
+                raise ValueError(f'Unexpected handoff cmd={msg[0]}')
+        except (OSError, ValueError, asyncio.TimeoutError):
+            # 旧进程可能已经停止接受连接了，这里只能继续
+            logger.exception('Failed to receive room states')
+            return
+
+        for room_key_data, bodies in msg[1]:
+            room = services.chat.client_room_manager.get_room(_room_key_from_ipc(room_key_data))
+            if room is None:
+                continue
+            room.import_replay_messages([api.chat.OutgoingMessage.from_msgpack_body(body) for body in bodies])
+        logger.info('Handoff finished, %d rooms preopened', len(room_keys))
+
+    async def _preopen_rooms(self):
+        # 客户端多的房间先连接
+        self._rooms.sort(key=lambda room: room[1], reverse=True)
+        room_keys = []
+        for index, (room_key_data, _client_count, open_live_game_data) in enumerate(self._rooms):
+            if index != 0 and index % PREOPEN_ROOMS_PER_SECOND == 0:
+                await asyncio.sleep(1)
+            room_key = _room_key_from_ipc(room_key_data)
+            services.chat.client_room_manager.add_handoff_room(
+                room_key, HANDOFF_ROOM_TIMEOUT, open_live_game_data
+            )
+            room_keys.append(room_key)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + PREOPEN_TIMEOUT
+        while not all(services.chat.is_live_client_ready(room_key) for room_key in room_keys):
+            if loop.time() >= deadline:
+                logger.warning('Preopening rooms timed out')
+                break
+            await asyncio.sleep(0.2)
+        return room_keys
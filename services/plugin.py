@@ -9,6 +9,7 @@ import string
 import subprocess
 from typing import *
 
+import api.chat
 import api.plugin
 import blcsdk
 import blcsdk.models as sdk_models
@@ -20,9 +21,14 @@ logger = logging.getLogger(__name__)
 PLUGINS_PATH = os.path.join(config.DATA_PATH, 'plugins')
 
 _plugins: Dict[str, 'Plugin'] = {}
+# 插件连接的端口，默认和配置中的一样
+_blc_port: Optional[int] = None
 
 
-def init():
+def init(blc_port: Optional[int] = None):
+    global _blc_port
+    _blc_port = blc_port
+
     plugin_ids = _discover_plugin_ids()
     if not plugin_ids:
         return
@@ -92,6 +98,17 @@ def broadcast_cmd_data(cmd, data, extra: Optional[dict] = None):
         plugin.send_body_no_raise(body)
 
 
+def broadcast_message(message: 'api.chat.OutgoingMessage', extra: Optional[dict] = None):
+    """广播房间内的消息，没有插件连接时不序列化。extra不为None时代替message.plugin_extra"""
+    body = None
+    for plugin in _plugins.values():
+        if not plugin.is_connected:
+            continue
+        if body is None:
+            body = message.get_plugin_body(extra)
+        plugin.send_body_no_raise(body)
+
+
 @dataclasses.dataclass
 class PluginConfig:
     name: str = ''
@@ -212,7 +229,7 @@ class Plugin:
         cfg = config.get_config()
         env = {
             **os.environ,
-            'BLC_PORT': str(cfg.port),
+            'BLC_PORT': str(_blc_port if _blc_port is not None else cfg.port),
             'BLC_TOKEN': self._token,
         }
         try:
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import logging
+from typing import *
+
+import aiohttp
+import yarl
+
+import blivedm.blivedm.clients.web as dm_web_cli
+import utils.cache
+import utils.request
+
+logger = logging.getLogger(__name__)
+
+# 分享了房间链接时会有大量相同的请求，缓存B站接口的结果，每个房间每个周期只请求一次B站
+
+# 房间ID和主播UID不会变，可以缓存久一点
+ROOM_INFO_TTL = 10 * 60
+ROOM_INFO_STALE_TTL = 60 * 60
+# 服务器列表的token可能会过期
+HOST_SERVER_TTL = 60
+HOST_SERVER_STALE_TTL = 5 * 60
+
+# 房间ID -> (真实房间ID, 主播UID)
+_room_info_cache: Optional[utils.cache.SingleFlightTTLCache[int, Tuple[int, int]]] = None
+# (房间ID, UA的哈希) -> (服务器列表, token)
+_host_server_cache: Optional[utils.cache.SingleFlightTTLCache[Tuple[int, str], Tuple[List[dict], Optional[str]]]] = None
+# 只是为了同时只请求一次，结果在cookie里
+_buvid_cache: Optional[utils.cache.SingleFlightTTLCache[str, str]] = None
+
+
+def init():
+    global _room_info_cache, _host_server_cache, _buvid_cache
+    _room_info_cache = utils.cache.SingleFlightTTLCache(10000, ROOM_INFO_TTL, ROOM_INFO_STALE_TTL)
+    _host_server_cache = utils.cache.SingleFlightTTLCache(10000, HOST_SERVER_TTL, HOST_SERVER_STALE_TTL)
+    _buvid_cache = utils.cache.SingleFlightTTLCache(1, 60)
+
+
+async def get_room_info(room_id: int) -> Optional[Tuple[int, int]]:
+    """返回(真实房间ID, 主播UID)，失败时返回None"""
+    return await _room_info_cache.get(room_id, lambda: _fetch_room_info(room_id))
+
+
+async def _fetch_room_info(room_id: int) -> Optional[Tuple[int, int]]:
+    try:
+        async with utils.request.http_session.get(
+            dm_web_cli.ROOM_INIT_URL,
+            headers={
+                **utils.request.BILIBILI_COMMON_HEADERS,
+                'Origin': 'https://live.bilibili.com',
+                'Referer': f'https://live.bilibili.com/{room_id}'
+            },
+            params={
+                'room_id': room_id
+            }
+        ) as res:
+            if res.status != 200:
+                logger.warning('room=%d _fetch_room_info failed: %d %s', room_id,
+                               res.status, res.reason)
+                return None
+            data = await res.json()
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        logger.exception('room=%d _fetch_room_info failed', room_id)
+        return None
+
+    if data['code'] != 0:
+        logger.warning('room=%d _fetch_room_info failed: %s', room_id, data['message'])
+        return None
+
+    data = data['data']
+    return data['room_id'], data['uid']
+
+
+async def get_host_server_list_and_token(room_id: int, user_agent: str) -> Optional[Tuple[List[dict], Optional[str]]]:
+    """
+    返回(服务器列表, token)，失败时返回None
+
+    :param room_id: 房间ID
+    :param user_agent: token会对UA签名，要使用和客户端一样的UA
+    """
+    ua_hash = hashlib.md5(user_agent.encode('utf-8')).hexdigest()
+    return await _host_server_cache.get(
+        (room_id, ua_hash), lambda: _fetch_host_server_list_and_token(room_id, user_agent)
+    )
+
+
+async def _fetch_host_server_list_and_token(
+    room_id: int, user_agent: str
+) -> Optional[Tuple[List[dict], Optional[str]]]:
+    try:
+        async with utils.request.http_session.get(
+            dm_web_cli.DANMAKU_SERVER_CONF_URL,
+            headers={
+                'User-Agent': user_agent
+            },
+            params={
+                'id': room_id,
+                'type': 0
+            }
+        ) as res:
+            if res.status != 200:
+                logger.warning('room %d _fetch_host_server_list failed: %d %s', room_id,
+                               res.status, res.reason)
+                return None
+            data = await res.json()
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        logger.exception('room %d _fetch_host_server_list failed', room_id)
+        return None
+
+    if data['code'] != 0:
+        logger.warning('room %d _fetch_host_server_list failed: %s', room_id, data['message'])
+        return None
+
+    data = data['data']
+    host_server_list = data['host_list']
+    if not host_server_list:
+        logger.warning('room %d _fetch_host_server_list failed: host_server_list is empty', room_id)
+        return None
+
+    host_server_token = data.get('token', None)
+    return host_server_list, host_server_token
+
+
+async def get_buvid() -> str:
+    buvid = _get_buvid_from_cookie()
+    if buvid != '':
+        return buvid
+    buvid = await _buvid_cache.get('', _fetch_buvid)
+    return buvid if buvid is not None else ''
+
+
+async def _fetch_buvid() -> Optional[str]:
+    try:
+        async with utils.request.http_session.get(dm_web_cli.BUVID_INIT_URL):
+            pass
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        return None
+    buvid = _get_buvid_from_cookie()
+    return buvid if buvid != '' else None
+
+
+def _get_buvid_from_cookie():
+    cookies = utils.request.http_session.cookie_jar.filter_cookies(yarl.URL(dm_web_cli.BUVID_INIT_URL))
+    buvid_cookie = cookies.get('buvid3', None)
+    if buvid_cookie is None:
+        return ''
+    return buvid_cookie.value
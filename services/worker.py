@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import enum
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import *
+
+import msgpack
+
+import api.chat
+import services.chat
+
+logger = logging.getLogger(__name__)
+
+# 多进程模式：多个worker进程共用监听端口，主进程（worker 0）持有所有到B站的连接，
+# 其他worker订阅房间后，由主进程把编码好的消息通过UNIX socket转发过去，再由各worker发给自己的客户端
+
+
+class IpcCommand(enum.IntEnum):
+    # worker -> 主进程
+    HELLO = 1
+    SUBSCRIBE_ROOM = 2
+    UNSUBSCRIBE_ROOM = 3
+    # 主进程 -> worker
+    ROOM_MESSAGE = 4
+    DEL_ROOM = 5
+
+
+# 当前进程的worker ID，单进程模式和主进程是0
+worker_id = 0
+# 主进程中管理其他worker
+_worker_manager: Optional['WorkerManager'] = None
+# 其他worker中到主进程的连接
+_master_connection: Optional['MasterConnection'] = None
+
+
+def is_upstream_owner():
+    """当前进程是否负责连接B站"""
+    return _master_connection is None
+
+
+async def init_master(worker_num, worker_args: List[str]):
+    """启动其他worker，worker_args是启动worker时额外的命令行参数"""
+    global _worker_manager
+    _worker_manager = WorkerManager()
+    return await _worker_manager.start(worker_num, worker_args)
+
+
+async def init_worker(worker_id_, ipc_path, on_master_lost: Callable[[], None]):
+    global worker_id, _master_connection
+    worker_id = worker_id_
+    _master_connection = MasterConnection(ipc_path, on_master_lost)
+    return await _master_connection.start()
+
+
+async def shut_down():
+    if _worker_manager is not None:
+        await _worker_manager.shut_down()
+    if _master_connection is not None:
+        _master_connection.close()
+
+
+def _room_key_to_ipc(room_key: 'services.chat.RoomKey'):
+    return [int(room_key.type), room_key.value]
+
+
+def _room_key_from_ipc(data: list):
+    return services.chat.RoomKey(services.chat.RoomKeyType(data[0]), data[1])
+
+
+#
+# 主进程
+#
+
+def forward_room_message(
+    room_keys: Iterable['services.chat.RoomKey'], worker_ids: Iterable[int], message: 'api.chat.OutgoingMessage',
+    auto_translate_only=False
+):
+    """
+    把房间的消息转发给订阅了的worker，每条消息只打包一次
+
+    :param room_keys: 房间的所有RoomKey，worker可能用其中任意一个订阅
+    """
+    if _worker_manager is None:
+        return
+    packed = msgpack.packb([
+        IpcCommand.ROOM_MESSAGE,
+        [_room_key_to_ipc(room_key) for room_key in room_keys],
+        message.get_body(api.chat.Encoding.MSGPACK),
+        auto_translate_only,
+    ])
+    for worker_id_ in worker_ids:
+        _worker_manager.send_no_raise(worker_id_, packed, droppable=True)
+
+
+def send_del_room(room_keys: Iterable['services.chat.RoomKey'], worker_ids: Iterable[int]):
+    if _worker_manager is None:
+        return
+    packed = msgpack.packb([IpcCommand.DEL_ROOM, [_room_key_to_ipc(room_key) for room_key in room_keys]])
+    for worker_id_ in worker_ids:
+        _worker_manager.send_no_raise(worker_id_, packed)
+
+
+class WorkerManager:
+    """主进程中启动、管理其他worker"""
+    def __init__(self):
+        self._ipc_dir: Optional[str] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._processes: List[subprocess.Popen] = []
+        self._connections: Dict[int, WorkerConnection] = {}
+
+    async def start(self, worker_num, worker_args: List[str]):
+        self._ipc_dir = tempfile.mkdtemp(prefix='blivechat-')
+        ipc_path = os.path.join(self._ipc_dir, 'master.sock')
+        try:
+            self._server = await asyncio.start_unix_server(self._on_worker_connect, ipc_path)
+        except OSError:
+            logger.exception('Failed to start IPC server, path=%s', ipc_path)
+            return False
+
+        main_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+        for worker_id_ in range(1, worker_num):
+            args = [
+                sys.executable, main_path, *worker_args,
+                '--worker-id', str(worker_id_),
+                '--worker-ipc-path', ipc_path,
+            ]
+            try:
+                self._processes.append(subprocess.Popen(args))
+            except OSError:
+                logger.exception('Failed to start worker %d', worker_id_)
+                return False
+        logger.info('Started %d workers', worker_num - 1)
+        return True
+
+    async def shut_down(self):
+        if self._server is not None:
+            self._server.close()
+        for connection in list(self._connections.values()):
+            connection.close()
+
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            try:
+                await asyncio.to_thread(process.wait, 10)
+            except subprocess.TimeoutExpired:
+                logger.warning('Worker pid=%d did not exit in time, killing', process.pid)
+                process.kill()
+        self._processes.clear()
+
+        if self._ipc_dir is not None:
+            shutil.rmtree(self._ipc_dir, ignore_errors=True)
+            self._ipc_dir = None
+
+    async def _on_worker_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = WorkerConnection(reader, writer)
+        try:
+            await connection.run(self._on_worker_hello)
+        finally:
+            connection.close()
+            if self._connections.get(connection.worker_id, None) is connection:
+                del self._connections[connection.worker_id]
+                logger.warning('Worker %d disconnected', connection.worker_id)
+
+    def _on_worker_hello(self, connection: 'WorkerConnection'):
+        old_connection = self._connections.get(connection.worker_id, None)
+        if old_connection is not None:
+            old_connection.close()
+        self._connections[connection.worker_id] = connection
+        logger.info('Worker %d connected', connection.worker_id)
+
+    def send_no_raise(self, worker_id_, packed: bytes, droppable=False):
+        connection = self._connections.get(worker_id_, None)
+        if connection is not None:
+            connection.send_no_raise(packed, droppable)
+
+
+class WorkerConnection:
+    """主进程中到一个worker的连接"""
+    # worker卡住时发送缓冲区最多积压多少字节，超过后丢弃房间消息，防止主进程内存无限增长
+    MAX_WRITE_BUFFER_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self.worker_id: Optional[int] = None
+        # 这个worker订阅的房间
+        self._room_keys: Set['services.chat.RoomKey'] = set()
+        # 正在丢弃消息，只在开始和结束时打日志
+        self._is_dropping = False
+        self._dropped_msg_count = 0
+
+    async def run(self, on_hello: Callable[['WorkerConnection'], None]):
+        unpacker = msgpack.Unpacker()
+        try:
+            while True:
+                data = await self._reader.read(65536)
+                if not data:
+                    break
+                unpacker.feed(data)
+                for msg in unpacker:
+                    try:
+                        self._handle_msg(msg, on_hello)
+                    except Exception:  # noqa
+                        logger.exception('Worker %s handle IPC message error, msg=%s', self.worker_id, msg)
+        except (OSError, ValueError):
+            # ValueError是数据不完整或者格式错误
+            logger.exception('Worker %s IPC connection error:', self.worker_id)
+        finally:
+            for room_key in self._room_keys:
+                services.chat.client_room_manager.del_remote_worker(room_key, self.worker_id)
+            self._room_keys.clear()
+
+    def _handle_msg(self, msg: list, on_hello: Callable[['WorkerConnection'], None]):
+        cmd = msg[0]
+        if cmd == IpcCommand.HELLO:
+            self.worker_id = int(msg[1])
+            on_hello(self)
+        elif cmd == IpcCommand.SUBSCRIBE_ROOM:
+            room_key = _room_key_from_ipc(msg[1])
+            self._room_keys.add(room_key)
+            services.chat.client_room_manager.add_remote_worker(room_key, self.worker_id, bool(msg[2]))
+        elif cmd == IpcCommand.UNSUBSCRIBE_ROOM:
+            room_key = _room_key_from_ipc(msg[1])
+            self._room_keys.discard(room_key)
+            services.chat.client_room_manager.del_remote_worker(room_key, self.worker_id)
+        else:
+            logger.warning('Worker %s unknown IPC cmd=%s', self.worker_id, cmd)
+
+    def send_no_raise(self, packed: bytes, droppable=False):
+        """
+        :param packed: 打包好的IPC消息
+        :param droppable: 发送缓冲区积压太多时是否可以丢弃。房间消息可以丢弃，删除房间之类的控制消息不能丢弃
+        """
+        if self._writer.is_closing():
+            return
+        if droppable:
+            if self._writer.transport.get_write_buffer_size() > self.MAX_WRITE_BUFFER_SIZE:
+                if not self._is_dropping:
+                    self._is_dropping = True
+                    logger.warning('Worker %s is too slow, dropping room messages', self.worker_id)
+                self._dropped_msg_count += 1
+                return
+            if self._is_dropping:
+                self._is_dropping = False
+                logger.warning('Worker %s recovered, dropped %d room messages', self.worker_id,
+                               self._dropped_msg_count)
+                self._dropped_msg_count = 0
+        self._writer.write(packed)
+
+    def close(self):
+        self._writer.close()
+
+
+#
+# 其他worker
+#
+
+def subscribe_room(room_key: 'services.chat.RoomKey', need_translate):
+    """让主进程连接这个房间，并把消息转发过来。need_translate变化时也要调用"""
+    if _master_connection is not None:
+        _master_connection.subscribe_room(room_key, need_translate)
+
+
+def unsubscribe_room(room_key: 'services.chat.RoomKey'):
+    if _master_connection is not None:
+        _master_connection.unsubscribe_room(room_key)
+
+
+class MasterConnection:
+    """worker中到主进程的连接"""
+    def __init__(self, ipc_path, on_master_lost: Callable[[], None]):
+        self._ipc_path = ipc_path
+        self._on_master_lost = on_master_lost
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._run_future: Optional[asyncio.Future] = None
+        # 已订阅的房间 -> 上次发给主进程的need_translate
+        self._room_key_to_need_translate: Dict['services.chat.RoomKey', bool] = {}
+
+    async def start(self):
+        try:
+            reader, self._writer = await asyncio.open_unix_connection(self._ipc_path)
+        except OSError:
+            logger.exception('Failed to connect to master, path=%s', self._ipc_path)
+            return False
+        self._send(IpcCommand.HELLO, worker_id)
+        self._run_future = asyncio.create_task(self._run(reader))
+        return True
+
+    def close(self):
+        if self._run_future is not None:
+            self._run_future.cancel()
+            self._run_future = None
+        if self._writer is not None:
+            self._writer.close()
+
+    async def _run(self, reader: asyncio.StreamReader):
+        unpacker = msgpack.Unpacker()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                unpacker.feed(data)
+                for msg in unpacker:
+                    try:
+                        self._handle_msg(msg)
+                    except Exception:  # noqa
+                        logger.exception('Handle IPC message error, msg=%s', msg)
+        except (OSError, ValueError):
+            logger.exception('IPC connection error:')
+        logger.error('Lost connection to master')
+        self._run_future = None
+        self._on_master_lost()
+
+    def _handle_msg(self, msg: list):
+        cmd = msg[0]
+        if cmd == IpcCommand.ROOM_MESSAGE:
+            # worker中不合并房间，用不同RoomKey订阅的是不同的房间
+            message = None
+            for room_key_data in msg[1]:
+                room = services.chat.client_room_manager.get_room(_room_key_from_ipc(room_key_data))
+                if room is None:
+                    continue
+                if message is None:
+                    message = api.chat.OutgoingMessage.from_msgpack_body(msg[2])
+                if msg[3]:
+                    room.send_auto_translate_message_no_raise(message)
+                else:
+                    room.send_message_no_raise(message)
+        elif cmd == IpcCommand.DEL_ROOM:
+            for room_key_data in msg[1]:
+                room_key = _room_key_from_ipc(room_key_data)
+                self._room_key_to_need_translate.pop(room_key, None)
+                services.chat.client_room_manager.del_room(room_key)
+        else:
+            logger.warning('Unknown IPC cmd=%s', cmd)
+
+    def _send(self, *msg):
+        if self._writer is None or self._writer.is_closing():
+            return
+        self._writer.write(msgpack.packb(msg))
+
+    def subscribe_room(self, room_key: 'services.chat.RoomKey', need_translate):
+        if self._room_key_to_need_translate.get(room_key, None) == need_translate:
+            return
+        self._room_key_to_need_translate[room_key] = need_translate
+        self._send(IpcCommand.SUBSCRIBE_ROOM, _room_key_to_ipc(room_key), need_translate)
+
+    def unsubscribe_room(self, room_key: 'services.chat.RoomKey'):
+        if self._room_key_to_need_translate.pop(room_key, None) is None:
+            return
+        self._send(IpcCommand.UNSUBSCRIBE_ROOM, _room_key_to_ipc(room_key))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import collections
+from typing import *
+
+
+class AhoCorasick:
+    """多模式字符串匹配，匹配时间只和文本长度有关，和模式的数量无关"""
+    def __init__(self, patterns: Iterable[str]):
+        # 状态 -> {字符 -> 下一个状态}，0是根节点
+        self._goto: List[Dict[str, int]] = [{}]
+        # 状态 -> 失配时跳转的状态
+        self._fail: List[int] = [0]
+        # 状态 -> 到达这个状态时匹配到的模式
+        self._outputs: List[Tuple[str, ...]] = [()]
+
+        for pattern in patterns:
+            if pattern != '':
+                self._add_pattern(pattern)
+        self._build_fail()
+
+    @property
+    def is_empty(self):
+        return len(self._goto) == 1
+
+    def _add_pattern(self, pattern: str):
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char, None)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append(())
+            state = next_state
+        if pattern not in self._outputs[state]:
+            self._outputs[state] += (pattern,)
+
+    def _build_fail(self):
+        # 广度优先，保证处理一个状态时，比它浅的状态的fail都已经算好了
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+
+                fail_state = self._fail[state]
+                while fail_state != 0 and char not in self._goto[fail_state]:
+                    fail_state = self._fail[fail_state]
+                fail_state = self._goto[fail_state].get(char, 0)
+                self._fail[next_state] = fail_state
+                self._outputs[next_state] += self._outputs[fail_state]
+
+    def find_all(self, text: str) -> Set[str]:
+        """返回文本中出现的所有模式"""
+        res = set()
+        goto = self._goto
+        fail = self._fail
+        outputs = self._outputs
+        state = 0
+        for char in text:
+            while state != 0 and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if outputs[state]:
+                res.update(outputs[state])
+        return res
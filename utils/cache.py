@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import time
+from typing import *
+
+import cachetools
+
+logger = logging.getLogger(__name__)
+
+_KT = TypeVar('_KT')
+_VT = TypeVar('_VT')
+
+
+class SingleFlightTTLCache(Generic[_KT, _VT]):
+    """
+    异步获取的缓存，同一个key同时只获取一次，其他调用者等待同一个结果
+
+    结果缓存ttl秒，过期后stale_ttl秒内先返回旧值，同时在后台刷新。获取失败时返回None，不缓存，旧值继续用到stale_ttl结束
+    """
+    def __init__(self, maxsize, ttl, stale_ttl=0.0):
+        self._ttl = ttl
+        # key -> (value, 需要刷新的时间)
+        self._cache: Dict[_KT, Tuple[_VT, float]] = cachetools.TTLCache(maxsize, ttl + stale_ttl)
+        # 正在获取的key -> Future
+        self._fetch_futures: Dict[_KT, asyncio.Future] = {}
+
+    async def get(self, key: _KT, fetch: Callable[[], Awaitable[Optional[_VT]]]) -> Optional[_VT]:
+        """
+        :param key: 缓存的key
+        :param fetch: 缓存不存在或者过期时调用，失败时返回None
+        """
+        entry = self._cache.get(key, None)
+        if entry is not None:
+            value, refresh_time = entry
+            if time.monotonic() >= refresh_time and key not in self._fetch_futures:
+                self._start_fetch(key, fetch)
+            return value
+
+        future = self._fetch_futures.get(key, None)
+        if future is None:
+            future = self._start_fetch(key, fetch)
+        # 一个调用者取消了不能影响其他调用者
+        return await asyncio.shield(future)
+
+    def _start_fetch(self, key: _KT, fetch: Callable[[], Awaitable[Optional[_VT]]]):
+        future = asyncio.create_task(self._fetch(key, fetch))
+        self._fetch_futures[key] = future
+        return future
+
+    async def _fetch(self, key: _KT, fetch: Callable[[], Awaitable[Optional[_VT]]]) -> Optional[_VT]:
+        try:
+            value = await fetch()
+        except Exception:  # noqa
+            logger.exception('Fetch error, key=%r', key)
+            value = None
+        finally:
+            self._fetch_futures.pop(key, None)
+
+        if value is not None:
+            self._cache[key] = (value, time.monotonic() + self._ttl)
+        return value
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import bisect
+import hashlib
+from typing import *
+
+
+def _hash(key: str) -> int:
+    # 不能用hash()，每个进程的结果不一样
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class ConsistentHashRing:
+    """一致性哈希，节点增减时只有少部分key的归属会变化"""
+    def __init__(self, nodes: Iterable[str], virtual_node_num=100):
+        self._nodes = frozenset(nodes)
+        # 每个节点放virtual_node_num个虚拟节点，让key分布更均匀
+        points = sorted(
+            (_hash(f'{node}#{i}'), node)
+            for node in self._nodes
+            for i in range(virtual_node_num)
+        )
+        self._hashes = [point[0] for point in points]
+        self._point_nodes = [point[1] for point in points]
+
+    @property
+    def nodes(self) -> FrozenSet[str]:
+        return self._nodes
+
+    def get_node(self, key: str) -> Optional[str]:
+        """返回key所属的节点，没有节点时返回None"""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key))
+        if index == len(self._hashes):
+            index = 0
+        return self._point_nodes[index]
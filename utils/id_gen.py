@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import random
+import time
+from typing import *
+
+# 按ASCII顺序排列，所以编码后的字符串顺序和数值顺序一样
+_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+_ALPHABET_SET = frozenset(_ALPHABET)
+_BASE = len(_ALPHABET)
+
+# 2020-01-01 00:00:00 UTC
+_EPOCH_MS = 1577836800000
+# 毫秒时间戳，7位可以用100多年
+_TIME_LEN = 7
+# 每个进程随机的前缀，区分重启、多进程和集群中的不同节点
+_PREFIX_LEN = 4
+# 同一毫秒内的序号
+_SEQ_LEN = 3
+_MAX_SEQ = _BASE ** _SEQ_LEN
+
+ID_LEN = _TIME_LEN + _PREFIX_LEN + _SEQ_LEN
+
+# 所有2位的编码，序号查表编码，不用每次算
+_PAIRS = tuple(a + b for a in _ALPHABET for b in _ALPHABET)
+
+
+def _encode(value: int, length: int) -> str:
+    chars = []
+    for _ in range(length):
+        value, index = divmod(value, _BASE)
+        chars.append(_ALPHABET[index])
+    return ''.join(reversed(chars))
+
+
+class IdGenerator:
+    """
+    生成短的、有序的消息ID，用来代替uuid4().hex
+
+    格式是毫秒时间戳 + 进程前缀 + 序号，共14个字符。同一个进程生成的ID严格递增，时钟回拨时也是；
+    不同进程的ID大致按时间排序
+    """
+    def __init__(self):
+        self._prefix = _encode(random.SystemRandom().randrange(_BASE ** _PREFIX_LEN), _PREFIX_LEN)
+        self._last_time = -1
+        # 时间戳和前缀的编码，同一毫秒内不用重新编码
+        self._time_prefix = ''
+        self._seq = 0
+
+    def new_id(self) -> str:
+        cur_time = int(time.time() * 1000) - _EPOCH_MS
+        if cur_time > self._last_time:
+            self._last_time = cur_time
+            self._time_prefix = _encode(cur_time, _TIME_LEN) + self._prefix
+            self._seq = 0
+        else:
+            # 同一毫秒内，或者时钟回拨了，继续用上次的时间
+            self._seq += 1
+            if self._seq >= _MAX_SEQ:
+                self._last_time += 1
+                self._time_prefix = _encode(self._last_time, _TIME_LEN) + self._prefix
+                self._seq = 0
+        high, low = divmod(self._seq, _BASE * _BASE)
+        return self._time_prefix + _ALPHABET[high] + _PAIRS[low]
+
+
+def is_valid_id(id_: Any) -> bool:
+    """是否是IdGenerator生成的ID，只有这种ID可以比较先后"""
+    return isinstance(id_, str) and len(id_) == ID_LEN and _ALPHABET_SET.issuperset(id_)
+
+
+_default_generator = IdGenerator()
+
+
+def new_id() -> str:
+    return _default_generator.new_id()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+热点路径上的JSON序列化
+
+安装了orjson时用orjson，否则用标准库json，输出和以前直接调用json.dumps的完全一样。
+orjson的输出没有空格、不转义非ASCII字符，内容等价但字节不一样
+
+插件SDK中有一份一样的实现blcsdk/json_codec.py，修改时要同步修改
+"""
+import json
+from typing import *
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(obj) -> bytes:
+    return json.dumps(obj).encode('utf-8')
+
+
+def _json_loads(s: Union[str, bytes]):
+    return json.loads(s)
+
+
+if orjson is not None:
+    BACKEND_NAME = 'orjson'
+
+    def dumps(obj) -> bytes:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # 比如超过64位的整数，orjson不支持
+            return _json_dumps(obj)
+
+    def loads(s: Union[str, bytes]):
+        return orjson.loads(s)
+else:
+    BACKEND_NAME = 'json'
+    dumps = _json_dumps
+    loads = _json_loads
+
+
+def dumps_str(obj) -> str:
+    """给需要str的接口用，比如aiohttp的send_json"""
+    return dumps(obj).decode('utf-8')
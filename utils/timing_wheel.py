@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import math
+from typing import *
+
+logger = logging.getLogger(__name__)
+
+
+class TimerHandle:
+    __slots__ = ('_callback', '_args', '_rounds')
+
+    def __init__(self, callback: Callable, args: tuple, rounds: int):
+        self._callback = callback
+        self._args = args
+        # 还要转几圈才到期
+        self._rounds = rounds
+
+    @property
+    def cancelled(self):
+        return self._callback is None
+
+    def cancel(self):
+        # 不从槽中删除，转到这个槽时再丢弃
+        self._callback = None
+        self._args = None
+
+
+class TimingWheel:
+    """
+    哈希时间轮，用于大量精度要求不高的定时器，比如每个连接的心跳、超时
+
+    所有定时器共用一个事件循环定时器，添加、取消都是O(1)，不会在事件循环的堆里堆积大量定时器。
+    定时器不会提前触发，最多推迟tick_interval秒
+    """
+    def __init__(self, tick_interval=1.0, slot_num=64):
+        self._tick_interval = tick_interval
+        self._slots: List[List[TimerHandle]] = [[] for _ in range(slot_num)]
+        self._cur_slot_index = 0
+        # 包括已取消但还没丢弃的定时器
+        self._timer_count = 0
+        self._tick_timer_handle: Optional[asyncio.TimerHandle] = None
+        self._next_tick_time = 0.0
+
+    @property
+    def timer_count(self):
+        return self._timer_count
+
+    def call_later(self, delay, callback: Callable, *args) -> TimerHandle:
+        loop = asyncio.get_running_loop()
+        if self._tick_timer_handle is None:
+            self._next_tick_time = loop.time() + self._tick_interval
+            self._tick_timer_handle = loop.call_at(self._next_tick_time, self._on_tick)
+
+        # 在第几个tick触发，第1个tick是self._next_tick_time
+        ticks = max(math.ceil((loop.time() + delay - self._next_tick_time) / self._tick_interval) + 1, 1)
+        slot_num = len(self._slots)
+        handle = TimerHandle(callback, args, (ticks - 1) // slot_num)
+        self._slots[(self._cur_slot_index + ticks) % slot_num].append(handle)
+        self._timer_count += 1
+        return handle
+
+    def _on_tick(self):
+        self._cur_slot_index = (self._cur_slot_index + 1) % len(self._slots)
+        slot = self._slots[self._cur_slot_index]
+        expired_handles = []
+        remaining_handles = []
+        for handle in slot:
+            if handle.cancelled:
+                continue
+            if handle._rounds > 0:  # noqa
+                handle._rounds -= 1  # noqa
+                remaining_handles.append(handle)
+            else:
+                expired_handles.append(handle)
+        self._timer_count -= len(slot) - len(remaining_handles)
+        self._slots[self._cur_slot_index] = remaining_handles
+        # 按预定时间推进，事件循环卡顿时也不会累计误差。要在回调之前推进，回调里添加的定时器才能算对槽
+        self._next_tick_time += self._tick_interval
+
+        for handle in expired_handles:
+            # 可能被前面的回调取消了
+            if handle.cancelled:
+                continue
+            callback, args = handle._callback, handle._args  # noqa
+            handle.cancel()
+            try:
+                callback(*args)
+            except Exception:  # noqa
+                logger.exception('Timer callback error, callback=%r', callback)
+
+        if self._timer_count == 0:
+            self._tick_timer_handle = None
+            return
+        self._tick_timer_handle = asyncio.get_running_loop().call_at(self._next_tick_time, self._on_tick)
+
+
+# 连接心跳、超时共用的时间轮
+_default_wheel: Optional[TimingWheel] = None
+
+
+def call_later(delay, callback: Callable, *args) -> TimerHandle:
+    """和loop.call_later一样，但是用共用的时间轮，精度是1秒"""
+    global _default_wheel
+    if _default_wheel is None:
+        _default_wheel = TimingWheel()
+    return _default_wheel.call_later(delay, callback, *args)